@@ -1,4 +1,3 @@
-import json
 from typing import Any
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,13 +5,24 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
-import pandas as pd
-import numpy as np
 # 导入路由和服务
 from app.routers import file_router, chat_router
-from app.services.file_cleanup_service import start_cleanup_scheduler
+from app.services.file_cleanup_service import start_cleanup_scheduler, get_cleanup_report
+from app.services.dataframe_cache import dataframe_cache
+from app.services.file_service import MAX_UPLOAD_SIZE
+from app.services.code_executor import code_executor
+from app.services.admission_service import chat_admission
+from app.services.agent_service import close_agents
+from app.services.response_cache import llm_response_cache
+from app.services.exec_cache import exec_cache
+from app.services.access_store import access_store
+from app.services.quota_service import quota_stats
+from app.services.result_writer import result_writer
+from app.services.cpu_pool import cpu_pool, loop_lag_monitor
+from app.services.json_serializer import CustomJSONResponse
 
 # 加载环境变量
 load_dotenv()
@@ -142,38 +152,6 @@ def ensure_swagger_files_exist():
 # 确保Swagger UI文件存在
 ensure_swagger_files_exist()
 
-class CustomJSONResponse(JSONResponse):
-    def render(self, content: Any) -> bytes:
-        def json_safe_default(obj):
-            if pd.isna(obj) or obj is pd.NA or obj is None:
-                return None
-            if isinstance(obj, float) and (np.isnan(obj) or np.isinf(obj)):
-                return None
-            if isinstance(obj, (pd.Series, pd.DataFrame)):
-                # 确保DataFrame中不含有非法的JSON值
-                return obj.replace({np.inf: None, -np.inf: None, np.nan: None, pd.NA: None}).where(pd.notnull, None).to_dict()
-            return str(obj)
-            
-        # 递归处理内容中的所有浮点值
-        def sanitize_content(data):
-            if isinstance(data, dict):
-                return {k: sanitize_content(v) for k, v in data.items()}
-            elif isinstance(data, list):
-                return [sanitize_content(item) for item in data]
-            elif isinstance(data, float) and (np.isnan(data) or np.isinf(data)):
-                return None
-            return data
-            
-        # 处理内容中可能存在的非法JSON值
-        sanitized_content = sanitize_content(content)
-            
-        return json.dumps(
-            sanitized_content,
-            ensure_ascii=False,
-            allow_nan=False,
-            default=json_safe_default
-        ).encode("utf-8")
-
 # 创建FastAPI应用
 app = FastAPI(
     title="AI表格处理工具",
@@ -223,10 +201,23 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import Response
 
+# multipart请求中边界、各部分的头和其他表单字段占用的额外字节数
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024
+# 按Content-Length拒绝请求的上限，文件本身的大小在写入时逐块统计
+MAX_REQUEST_SIZE = MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD_BYTES
+
 class LargeRequestMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        # 将请求体大小限制设置为100MB
-        request.scope["max_body_size"] = 100 * 1024 * 1024  # 100MB
+        # 将请求体大小限制设置为上传上限加上multipart的额外开销
+        request.scope["max_body_size"] = MAX_REQUEST_SIZE
+        # 声明的请求体明显超过限制时直接拒绝，不再读取请求体；
+        # 接近上限的请求交给save_upload_file按实际写入的文件字节数判断
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"请求体超过大小限制 {MAX_UPLOAD_SIZE // (1024 * 1024)}MB"}
+            )
         response = await call_next(request)
         return response
 
@@ -236,9 +227,24 @@ app.add_middleware(LargeRequestMiddleware)
 async def startup_event():
     """应用启动时的初始化操作"""
     # 启动文件清理调度器
-    import asyncio
     asyncio.create_task(start_cleanup_scheduler())
     logger.info("文件清理调度器已启动")
+    # 在后台预热代码执行进程
+    asyncio.create_task(code_executor.start())
+    # 监控事件循环是否被阻塞
+    asyncio.create_task(loop_lag_monitor.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时释放资源"""
+    await code_executor.shutdown()
+    await close_agents()
+    # 等待后台写入线程保存尚未写入的处理结果
+    await asyncio.get_running_loop().run_in_executor(None, result_writer.close)
+    cpu_pool.shutdown()
+    # 写入尚未保存的访问记录
+    access_store.close()
+    logger.info("代码执行进程和AI客户端已关闭")
 
 @app.get("/", tags=["健康检查"], 
          summary="API健康检查", 
@@ -295,6 +301,30 @@ async def custom_swagger_ui_html():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/api/metrics", tags=["健康检查"],
+         summary="运行指标",
+         description="返回当前工作进程的运行指标，如DataFrame缓存、AI回复缓存和执行结果缓存的命中/未命中次数、聊天请求的排队情况、最近一次文件清理回收的空间、配额的使用情况、后台结果写入的排队情况、CPU线程池各阶段的耗时，以及事件循环的阻塞情况")
+async def metrics():
+    loop = asyncio.get_running_loop()
+    # 扫描缓存目录、读取清理报告和查询数据库会阻塞，在线程池中执行
+    exec_cache_stats, cleanup_report, usage_summary = await asyncio.gather(
+        loop.run_in_executor(None, exec_cache.stats),
+        loop.run_in_executor(None, get_cleanup_report),
+        loop.run_in_executor(None, access_store.get_usage_summary),
+    )
+    return {
+        "dataframe_cache": dataframe_cache.stats(),
+        "chat_admission": chat_admission.stats(),
+        "llm_response_cache": llm_response_cache.stats(),
+        "exec_cache": exec_cache_stats,
+        "file_access": access_store.stats(),
+        "cleanup": cleanup_report,
+        "quotas": {**quota_stats(), "usage": usage_summary},
+        "result_writer": result_writer.stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "loop_lag": loop_lag_monitor.stats(),
+    }
+
 if __name__ == "__main__":
     import uvicorn
     logger.info(f"应用启动 - 静态文件目录: {STATIC_DIR}")
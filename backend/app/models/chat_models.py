@@ -7,7 +7,7 @@ class ChatMessage(BaseModel):
     content: str
     
 class ChatRequest(BaseModel):
-    """聊天请求模型"""
+    """聊天请求模型，不提供history时使用服务端保存的会话历史"""
     message: str
     history: Optional[List[ChatMessage]] = None
     
@@ -24,4 +24,40 @@ class ChatResponse(BaseModel):
     response: str
     code: Optional[str] = None
     result: Optional[ProcessResult] = None
-    image_url: Optional[str] = None 
\ No newline at end of file
+    image_url: Optional[str] = None
+
+class ChatSessionResponse(BaseModel):
+    """服务端会话响应模型"""
+    file_id: str
+    summary: Optional[str] = None
+    history: List[ChatMessage]
+    created_at: str
+    updated_at: str
+
+class ProcessStep(BaseModel):
+    """会话中的一个处理步骤"""
+    step: int
+    code: str
+    columns: List[str]
+    rows_count: int
+    created_at: str
+
+class ProcessStepsResponse(BaseModel):
+    """会话处理步骤响应模型，current_step为0表示位于原始表"""
+    file_id: str
+    current_step: int
+    steps: List[ProcessStep]
+
+class JobResponse(BaseModel):
+    """分析任务状态响应模型"""
+    job_id: str
+    file_id: str
+    status: str
+    phase: Optional[str] = None
+    created_at: str
+    updated_at: str
+    result: Optional[ChatResponse] = None
+    error: Optional[str] = None
+    # 超出配额时的结构化错误信息，与同步接口的detail相同
+    error_detail: Optional[Dict[str, Any]] = None
+    retry_after: Optional[int] = None
@@ -8,8 +8,33 @@ class FileResponse(BaseModel):
     file_path: str
 
 class FilePreviewResponse(BaseModel):
-    """文件预览响应模型"""
+    """文件预览响应模型，data按orient参数为按行的对象列表或按列的值列表"""
     columns: List[str]
-    data: List[Dict[str, Any]]
+    data: Union[List[Dict[str, Any]], Dict[str, List[Any]]]
     rows_count: int
-    file_type: str 
\ No newline at end of file
+    file_type: str
+
+class FileRowsResponse(BaseModel):
+    """表格分页数据响应模型，data按orient参数为按行的对象列表或按列的值列表"""
+    columns: List[str]
+    data: Union[List[Dict[str, Any]], Dict[str, List[Any]]]
+    offset: int
+    limit: int
+    rows_count: int
+    table: str
+
+class TableSchemaResponse(BaseModel):
+    """列类型方案响应模型，changes为 列名 -> [原类型, 优化后类型]，executor_columns为执行生成的代码时的列类型"""
+    columns: Dict[str, str]
+    executor_columns: Dict[str, str]
+    changes: Dict[str, List[str]]
+    memory_before: int
+    memory_after: int
+    saved_bytes: int
+
+class StorageUsageResponse(BaseModel):
+    """客户端存储占用响应模型，limit_bytes为0表示不限制"""
+    client_id: str
+    files: int
+    used_bytes: int
+    limit_bytes: int
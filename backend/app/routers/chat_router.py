@@ -1,16 +1,19 @@
-from fastapi import APIRouter, HTTPException, Depends, Body, Path as FastAPIPath
+from fastapi import APIRouter, HTTPException, Depends, Body, Path as FastAPIPath, Query
+from fastapi.responses import StreamingResponse
 from typing import List, Dict, Any, Optional
 import logging
 import os
-from pathlib import Path
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-
-from app.models.chat_models import ChatMessage, ChatRequest, ChatResponse, ProcessResult
-from app.services.agent_service import get_agent, process_dataframe_with_code
+import weakref
+from starlette.background import BackgroundTask
+
+from app.models.chat_models import ChatMessage, ChatRequest, ChatResponse, ProcessResult, JobResponse, ChatSessionResponse, ProcessStepsResponse
+from app.services.chat_service import run_chat, prepare_chat, stream_chat, format_sse_event
 from app.services.file_service import get_file_path_by_id
+from app.services.job_service import create_job, get_job, stream_job_events
+from app.services.admission_service import chat_admission, AdmissionRejected
+from app.services.session_service import load_session, reset_session
+from app.services.lineage_service import undo_to_step, describe_steps
+from app.services.quota_service import QuotaExceededError
 
 # 获取根目录位置
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -32,8 +35,10 @@ os.makedirs(IMAGES_DIR, exist_ok=True)
     
     - 需要提供已上传文件的ID
     - 用户发送消息,系统返回AI回复和可能的处理结果
-    - 支持历史消息上下文
+    - 支持历史消息上下文;不提供history时由服务端保存会话历史,客户端每轮只需发送新的问题
     - 可能返回处理后的数据预览和可视化图像
+    - 服务繁忙时返回429,并通过Retry-After头提示重试时间
+    - 数据表或处理结果超出大小上限时返回413
     """,
     response_description="返回AI回复、生成的代码、处理结果和图表URL"
 )
@@ -42,156 +47,228 @@ async def chat_with_agent(
     request: ChatRequest = Body(..., description="聊天请求,包含用户消息和历史记录"),
 ):
     """用户与AI聊天以处理表格数据"""
+    # 并发已满时排队等待，队列已满或等待超时时返回429
     try:
-        # 获取文件路径
-        file_path = await get_file_path_by_id(file_id)
-        if not file_path:
-            raise HTTPException(status_code=404, detail="文件不存在")
-        
-        # 读取数据并分析基本信息
-        try:
-            if file_path.endswith('.csv'):
-                df = pd.read_csv(file_path)
-            else:  # Excel
-                df = pd.read_excel(file_path)
-                
-            # 分析表格基本信息
-            df_info = {
-                "columns": df.columns.tolist(),
-                "dtypes": {col: str(df[col].dtype) for col in df.columns},
-                "shape": df.shape,
-                "missing_values": df.isna().sum().to_dict(),
-                "sample_data": df.head(5).to_dict(orient="records")
-            }
-        except Exception as e:
-            logger.exception(f"读取或分析文件时出错: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"读取或分析文件数据失败: {str(e)}")
-        
-        # 获取Agent
-        agent = get_agent()
-        
-        # 增加系统消息上下文
-        system_message = f"""你是一位专业的数据分析师,帮助用户处理表格数据。用户上传的文件为: {os.path.basename(file_path)}。
-
-表格基本信息:
-- 列名: {df_info['columns']}
-- 数据类型: {df_info['dtypes']}
-- 表格大小: {df_info['shape'][0]}行 × {df_info['shape'][1]}列
-- 缺失值统计: {df_info['missing_values']}
-- 数据样例:
-{pd.DataFrame(df_info['sample_data']).to_string(index=False)}
-
-请按照以下要求生成Python代码:
-1. 使用pandas库处理数据,已经预先导入为df变量
-2. 所有处理后的结果必须存储在名为'result'的DataFrame变量中
-3. 如果需要可视化,使用matplotlib库(已预先导入为plt)
-4. 生成的代码必须可以直接运行,不需要额外的导入语句
-5. 代码应简洁且易于理解,添加适当的注释
-6. 不要使用可能影响系统安全的操作(如os、subprocess等)
-
-示例格式:
-```python
-# 处理数据
-result = df.copy()  # 创建一个副本进行操作
-
-# 对特定列进行操作
-result['新列'] = result['现有列'] * 2
-
-# 结果必须存储在名为result的DataFrame中
-```"""
-        
-        # 获取历史消息
-        history = request.history if request.history else []
-        
-        # 构建LangChain消息列表
-        messages = [SystemMessage(content=system_message)]
-        
-        # 添加历史消息
-        for msg in history:
-            if msg.role == "user":
-                messages.append(HumanMessage(content=msg.content))
-            elif msg.role == "assistant":
-                messages.append(AIMessage(content=msg.content))
-        
-        # 添加当前用户消息
-        messages.append(HumanMessage(content=request.message))
-        
-        # 调用AI生成代码
-        response = await agent.ainvoke(messages)
-        ai_response = response.content
-        
-        # 提取Python代码
-        code_blocks = extract_code_blocks(ai_response)
-        python_code = ""
-        for block in code_blocks:
-            if block.get("language", "").lower() == "python":
-                python_code = block.get("code", "")
-                break
-        
-        # 如果找到可执行的Python代码,执行它
-        result = None
-        image_url = None
-        if python_code:
-            # 执行代码并获取结果
-            result_df, image_path = await process_dataframe_with_code(df, python_code, file_id)
-            
-            # 如果有结果DataFrame,转换为字符串表示预览
-            if result_df is not None:
-                # 处理特殊浮点值
-                result_df = result_df.replace([float('inf'), float('-inf'), np.inf, -np.inf], None)
-                result_df = result_df.where(pd.notnull(result_df), None)
-                
-                result = {
-                    "success": True,
-                    "preview": result_df.head(20).to_dict(orient="records"),
-                    "columns": result_df.columns.tolist(),
-                    "rows_count": len(result_df)
-                }
-                
-                # 如果生成了图像,提供图像URL
-                if image_path:
-                    # 将路径转换为URL
-                    image_url = f"/static/images/{os.path.basename(image_path)}"
-        
-        return {
-            "response": ai_response,
-            "code": python_code if python_code else None,
-            "result": result,
-            "image_url": image_url
-        }
-        
+        admitted_at = await chat_admission.acquire(file_id)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    
+    try:
+        return await run_chat(file_id, request.message, request.history)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
     except Exception as e:
         logger.exception(f"处理聊天请求时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"处理聊天请求失败: {str(e)}")
+    finally:
+        chat_admission.release(file_id, admitted_at)
+
+
+@router.post(
+    "/{file_id}/stream",
+    summary="AI对话分析数据(流式)",
+    description="""
+    与同步对话接口相同,但以Server-Sent Events逐步返回AI回复。
+    
+    - token 事件: AI回复的增量文本
+    - code 事件: 代码块生成完毕,代码已开始执行(无需等待回复结束)
+    - result 事件: 最终结果,数据与同步接口的响应相同
+    - error 事件: 处理失败
+    """,
+    response_description="text/event-stream 事件流"
+)
+async def stream_chat_with_agent(
+    file_id: str = FastAPIPath(..., description="要分析的文件ID"),
+    request: ChatRequest = Body(..., description="聊天请求,包含用户消息和历史记录"),
+):
+    """流式返回AI回复和处理结果"""
+    try:
+        admitted_at = await chat_admission.acquire(file_id)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    release = chat_admission.releaser(file_id, admitted_at)
+    
+    try:
+        file_path, messages, cache_key = await prepare_chat(file_id, request.message, request.history)
+    except FileNotFoundError:
+        release()
+        raise HTTPException(status_code=404, detail="文件不存在")
+    except QuotaExceededError as e:
+        release()
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
+    except Exception as e:
+        release()
+        logger.exception(f"处理聊天请求时出错: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"处理聊天请求失败: {str(e)}")
+    
+    async def event_stream():
+        try:
+            async for event, data in stream_chat(
+                file_id, file_path, messages, cache_key,
+                session_message=request.message if request.history is None else None
+            ):
+                yield format_sse_event(event, data)
+        except QuotaExceededError as e:
+            yield format_sse_event("error", e.to_detail())
+        except Exception as e:
+            logger.exception(f"流式处理聊天请求时出错: {str(e)}")
+            yield format_sse_event("error", {"error": f"处理聊天请求失败: {str(e)}"})
+        finally:
+            release()
+    
+    # 客户端在响应开始前断开时生成器不会执行，由响应结束后的后台任务归还许可；
+    # 响应没有被发送就被丢弃时，在回收响应对象时归还
+    response = StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release),
+    )
+    weakref.finalize(response, release)
+    return response
+
+@router.get(
+    "/{file_id}/session",
+    response_model=ChatSessionResponse,
+    summary="查看服务端会话",
+    description="""
+    返回服务端为该文件保存的对话历史。
+    
+    - 历史超出token预算时较早的对话会被移除,其中的问题保留在摘要中
+    """,
+    response_description="返回会话摘要和历史消息"
+)
+async def get_chat_session(file_id: str = FastAPIPath(..., description="文件ID")):
+    """查看服务端会话"""
+    if not await get_file_path_by_id(file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return load_session(file_id)
+
+
+@router.delete(
+    "/{file_id}/session",
+    summary="清空服务端会话",
+    description="清空服务端为该文件保存的对话历史和处理步骤,之后的对话将重新开始",
+    response_description="返回操作结果"
+)
+async def delete_chat_session(file_id: str = FastAPIPath(..., description="文件ID")):
+    """清空服务端会话"""
+    if not await get_file_path_by_id(file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    await reset_session(file_id)
+    return {"message": "会话已清空"}
 
 
-def extract_code_blocks(text: str) -> List[Dict[str, str]]:
-    """从Markdown文本中提取代码块"""
-    blocks = []
-    lines = text.split('\n')
+@router.get(
+    "/{file_id}/steps",
+    response_model=ProcessStepsResponse,
+    summary="查看处理步骤",
+    description="""
+    返回服务端会话中的处理步骤(原始表 → 第1步 → 第2步…)。
+    
+    - 使用服务端会话时,每轮对话的代码都作用于当前步骤的结果,并产生新的步骤
+    - current_step为0表示当前位于原始表
+    """,
+    response_description="返回当前步骤和所有步骤"
+)
+async def get_process_steps(file_id: str = FastAPIPath(..., description="文件ID")):
+    """查看处理步骤"""
+    if not await get_file_path_by_id(file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return describe_steps(load_session(file_id))
+
+
+@router.post(
+    "/{file_id}/steps/undo",
+    response_model=ProcessStepsResponse,
+    summary="撤销处理步骤",
+    description="""
+    回到之前的处理步骤,之后的对话将基于该步骤的结果继续处理。
+    
+    - 不指定step时回到上一步,step为0时回到原始表
+    - 在回退后的步骤上继续处理时,原来之后的步骤会被丢弃
+    - 处理结果文件同步更新为该步骤的结果
+    """,
+    response_description="返回更新后的处理步骤"
+)
+async def undo_process_step(
+    file_id: str = FastAPIPath(..., description="文件ID"),
+    step: Optional[int] = Query(None, ge=0, description="要回到的步骤,默认为上一步"),
+):
+    """撤销处理步骤"""
+    if not await get_file_path_by_id(file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    try:
+        return describe_steps(await undo_to_step(file_id, step))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post(
+    "/{file_id}/jobs",
+    response_model=JobResponse,
+    status_code=202,
+    summary="创建异步分析任务",
+    description="""
+    提交一次AI对话分析并立即返回任务ID,适用于耗时较长的分析。
     
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        
-        # 查找代码块开始
-        if line.startswith('```'):
-            language = line[3:].strip()
-            code_lines = []
-            i += 1
-            
-            # 收集代码块内容直到结束标记
-            while i < len(lines) and not lines[i].startswith('```'):
-                code_lines.append(lines[i])
-                i += 1
-                
-            # 添加找到的代码块
-            if i < len(lines):  # 确保找到了结束标记
-                blocks.append({
-                    "language": language,
-                    "code": '\n'.join(code_lines)
-                })
-                
-        i += 1
-        
-    return blocks 
\ No newline at end of file
+    - 请求体与同步对话接口相同
+    - 通过任务状态接口轮询结果,或通过事件流接口接收进度推送
+    - 任务依次经历 load(读取)、llm(生成代码)、exec(执行)、save(保存结果) 阶段
+    """,
+    response_description="返回任务ID和初始状态"
+)
+async def create_chat_job(
+    file_id: str = FastAPIPath(..., description="要分析的文件ID"),
+    request: ChatRequest = Body(..., description="聊天请求,包含用户消息和历史记录"),
+):
+    """创建异步分析任务"""
+    if not await get_file_path_by_id(file_id):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return create_job(file_id, request.message, request.history)
+
+
+@router.get(
+    "/{file_id}/jobs/{job_id}",
+    response_model=JobResponse,
+    summary="查询分析任务状态",
+    description="返回任务的当前状态和阶段,任务完成后包含AI回复、代码、处理结果和图表URL",
+    response_description="返回任务状态和结果"
+)
+async def get_chat_job(
+    file_id: str = FastAPIPath(..., description="文件ID"),
+    job_id: str = FastAPIPath(..., description="任务ID"),
+):
+    """查询分析任务状态"""
+    job = get_job(file_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.get(
+    "/{file_id}/jobs/{job_id}/events",
+    summary="订阅分析任务进度",
+    description="""
+    以Server-Sent Events推送任务进度。
+    
+    - progress 事件: 任务状态或阶段发生变化
+    - done 事件: 任务结束,数据为完整的任务记录
+    - failed 事件: 任务长时间没有进展(如执行任务的工作进程已退出),数据为标记为失败的任务记录
+    """,
+    response_description="text/event-stream 事件流"
+)
+async def stream_chat_job(
+    file_id: str = FastAPIPath(..., description="文件ID"),
+    job_id: str = FastAPIPath(..., description="任务ID"),
+):
+    """订阅分析任务进度"""
+    if get_job(file_id, job_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return StreamingResponse(
+        stream_job_events(file_id, job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,16 +1,28 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Form, Request, Path as FastAPIPath
+from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Form, Request, Query, Path as FastAPIPath
 from fastapi.responses import JSONResponse, FileResponse as FastAPIFileResponse
 import os
 import json
 import uuid
+import asyncio
 import pandas as pd
 import logging
 from typing import List, Optional, Any
 from pathlib import Path
 
-from app.models.file_models import FileResponse, FilePreviewResponse
-from app.services.file_service import save_upload_file, read_file_preview, export_file
-from app.services.file_cleanup_service import update_file_access
+from app.models.file_models import FileResponse, FilePreviewResponse, FileRowsResponse, StorageUsageResponse, TableSchemaResponse
+from app.services.file_service import (
+    save_upload_file, read_file_preview, read_table_rows,
+    build_columnar_sidecar, read_preview_frame, select_table_rows, get_table_schema, UploadTooLargeError,
+    is_valid_file_id
+)
+from app.services.file_cleanup_service import update_file_access, purge_file
+from app.services.profile_service import get_table_profile
+from app.services.access_store import access_store
+from app.services.quota_service import QuotaExceededError, get_client_id, QUOTA_CLIENT_MAX_BYTES
+from app.services.json_serializer import CustomJSONResponse
+from app.services.arrow_service import negotiate_format, to_arrow_table, table_response, FORMAT_JSON
+from app.services.export_service import export_response
+from app.services.cpu_pool import run_cpu
 
 # 获取根目录位置
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -32,10 +44,13 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
     
     - 支持的文件格式: .csv, .xlsx, .xls
     - 返回唯一的文件ID,用于后续操作
+    - 按客户端IP(经可信代理转发时按X-Client-Id请求头或X-Forwarded-For)统计存储占用,超出存储配额时返回507
+    - 表格行数或单元格数超出上限时返回413
     """,
     response_description="返回文件ID和路径信息"
 )
 async def upload_file(
+    request: Request,
     file: UploadFile = File(..., description="要上传的CSV或Excel文件"),
     background_tasks: BackgroundTasks = None
 ):
@@ -48,11 +63,18 @@ async def upload_file(
         
         # 生成唯一文件ID和保存路径
         file_id = str(uuid.uuid4())
-        saved_file_path = await save_upload_file(file, file_id, file_extension)
+        saved_file_path, content_hash = await save_upload_file(
+            file, file_id, file_extension, client_id=get_client_id(request)
+        )
         
         # 更新文件访问记录
         update_file_access(file_id)
         
+        # 响应返回后在后台生成列式副本和表格概况，后续的预览和分析直接使用
+        if background_tasks is not None:
+            background_tasks.add_task(run_cpu, "sidecar", build_columnar_sidecar, file_id, saved_file_path)
+            background_tasks.add_task(get_table_profile, file_id)
+        
         response_data = {
             "file_id": file_id,  # 强制转为字符串
             "original_filename": file.filename,
@@ -60,6 +82,13 @@ async def upload_file(
         }
         logger.debug(f"返回的数据: {response_data}")  # 调试日志
         return response_data
+    except HTTPException:
+        raise
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
+    except UploadTooLargeError as e:
+        logger.warning(f"上传文件过大: {str(e)}")
+        raise HTTPException(status_code=413, detail=str(e))
     except ValueError as ve:
         logger.error(f"值错误: {str(ve)}")
         raise HTTPException(status_code=400, detail=f"无效输入: {str(ve)}")
@@ -67,6 +96,23 @@ async def upload_file(
         logger.exception("文件上传失败")
         raise HTTPException(status_code=500, detail=f"文件上传失败: {str(e)}")
 
+@router.get(
+    "/usage",
+    response_model=StorageUsageResponse,
+    summary="查看存储占用",
+    description="""
+    返回当前客户端已上传文件占用的存储空间和配额。
+    
+    - 客户端由IP标识,经可信代理转发时使用X-Client-Id请求头或X-Forwarded-For
+    """,
+    response_description="返回文件数、已用字节数和配额"
+)
+async def get_storage_usage(request: Request):
+    """查看存储占用"""
+    client_id = get_client_id(request)
+    files, used_bytes = await asyncio.get_running_loop().run_in_executor(None, access_store.get_client_usage, client_id)
+    return {"client_id": client_id, "files": files, "used_bytes": used_bytes, "limit_bytes": QUOTA_CLIENT_MAX_BYTES}
+
 @router.get(
     "/preview/{file_id}",
     response_model=FilePreviewResponse,
@@ -76,53 +122,161 @@ async def upload_file(
     
     - 返回指定行数的数据预览
     - 包含列信息和总行数
+    - orient 为 records(按行的对象列表)或 columns(按列的值列表,数据量大时更紧凑)
+    - Accept 为 application/vnd.apache.arrow.stream 或 application/vnd.apache.parquet 时返回保留数据类型的
+      Arrow IPC 流或 Parquet 文件,总行数在 X-Total-Rows 响应头中
     """,
     response_description="返回文件预览数据"
 )
 async def get_preview(
+    request: Request,
     file_id: str = FastAPIPath(..., description="文件唯一ID"),
-    rows: int = 20
+    rows: int = 20,
+    orient: str = Query("records", pattern="^(records|columns)$", description="records 或 columns")
 ):
     """获取文件预览"""
     try:
         # 更新文件访问记录
         update_file_access(file_id)
-        preview_data = await read_file_preview(file_id, rows)
-        return preview_data
+        fmt = negotiate_format(request.headers.get("accept"))
+        if fmt != FORMAT_JSON:
+            head, rows_count = await read_preview_frame(file_id, rows)
+            return await table_response(to_arrow_table(head), fmt, {"X-Total-Rows": str(rows_count)})
+        preview_data = await read_file_preview(file_id, rows, orient)
+        # 数据已是可直接序列化的形式，跳过响应模型的逐行校验
+        return CustomJSONResponse(content=preview_data, headers={"Vary": "Accept"})
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="文件不存在")
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
     except Exception as e:
         logger.exception("获取文件预览失败")
         raise HTTPException(status_code=500, detail=f"获取文件预览失败: {str(e)}")
 
+@router.get(
+    "/{file_id}/rows",
+    response_model=FileRowsResponse,
+    summary="分页获取表格数据",
+    description="""
+    按窗口读取原始表格或AI处理结果表格的数据行。
+    
+    - offset/limit 指定起始行和行数
+    - columns 为逗号分隔的列名,只返回这些列
+    - sort 为逗号分隔的排序列,列名前加 - 表示降序,如 -收入,年龄
+    - table 为 original(原始表格)或 processed(处理结果)
+    - orient 为 records(按行的对象列表)或 columns(按列的值列表,数据量大时更紧凑)
+    - Accept 为 application/vnd.apache.arrow.stream 或 application/vnd.apache.parquet 时返回当前页的
+      Arrow IPC 流或 Parquet 文件,总行数在 X-Total-Rows 响应头中
+    """,
+    response_description="返回当前页的数据和总行数"
+)
+async def get_rows(
+    request: Request,
+    file_id: str = FastAPIPath(..., description="文件唯一ID"),
+    offset: int = Query(0, ge=0, description="起始行号"),
+    limit: int = Query(100, ge=1, le=1000, description="返回的最大行数"),
+    columns: Optional[str] = Query(None, description="逗号分隔的列名"),
+    sort: Optional[str] = Query(None, description="逗号分隔的排序列,前缀 - 表示降序"),
+    table: str = Query("original", pattern="^(original|processed)$", description="original 或 processed"),
+    orient: str = Query("records", pattern="^(records|columns)$", description="records 或 columns")
+):
+    """分页获取表格数据"""
+    try:
+        # 更新文件访问记录
+        update_file_access(file_id)
+        column_list = [col.strip() for col in columns.split(",") if col.strip()] if columns else None
+        fmt = negotiate_format(request.headers.get("accept"))
+        if fmt != FORMAT_JSON:
+            page, rows_count = await select_table_rows(
+                file_id, offset, limit,
+                columns=column_list,
+                sort=sort,
+                processed=(table == "processed")
+            )
+            return await table_response(to_arrow_table(page), fmt, {"X-Total-Rows": str(rows_count)})
+        rows_data = await read_table_rows(
+            file_id, offset, limit,
+            columns=column_list,
+            sort=sort,
+            processed=(table == "processed"),
+            orient=orient
+        )
+        return CustomJSONResponse(content=rows_data, headers={"Vary": "Accept"})
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"无效输入: {str(ve)}")
+    except Exception as e:
+        logger.exception("获取表格数据失败")
+        raise HTTPException(status_code=500, detail=f"获取表格数据失败: {str(e)}")
+
+@router.get(
+    "/{file_id}/schema",
+    response_model=TableSchemaResponse,
+    summary="查看列类型",
+    description="""
+    返回上传时为表格推断的列类型,以及相比默认类型节省的内存。
+    
+    - 重复值多的字符串列转换为category,其余字符串列使用Arrow字符串
+    - 执行生成的代码时category列改为Arrow字符串,整数列保持int64,executor_columns为此时的列类型
+    - ISO格式的日期字符串列解析为日期
+    - 每次读取表格和执行代码时都按该类型方案转换列类型
+    """,
+    response_description="返回列类型、发生变化的列和内存占用"
+)
+async def get_schema(file_id: str = FastAPIPath(..., description="文件唯一ID")):
+    """查看列类型"""
+    try:
+        update_file_access(file_id)
+        return await get_table_schema(file_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.to_detail())
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"无效输入: {str(ve)}")
+    except Exception as e:
+        logger.exception("获取列类型失败")
+        raise HTTPException(status_code=500, detail=f"获取列类型失败: {str(e)}")
+
 @router.get(
     "/export/{file_id}",
     summary="导出处理结果",
     description="""
-    导出已处理的表格数据。
+    导出已处理的表格数据,没有处理结果时导出原始表格。
     
-    - 支持指定导出文件名
-    - 返回文件下载响应
+    - format 为 csv、xlsx、parquet、jsonl 或 arrow,默认与原始文件格式相同
+    - compression 为 gzip 或 zstd,可用于 csv、jsonl 和 arrow
+    - filename 指定下载文件名,扩展名按导出格式自动设置
+    - 未指定 format 时,Accept 为 application/vnd.apache.arrow.stream 或 application/vnd.apache.parquet
+      分别导出为 Arrow IPC 流或 Parquet 文件
+    - 按块转换并以流式响应返回,支持 ETag/If-None-Match 和 Range 断点续传
     """,
     response_description="返回文件下载响应"
 )
 async def export_data(
+    request: Request,
     file_id: str = FastAPIPath(..., description="文件唯一ID"), 
-    filename: Optional[str] = None
+    filename: Optional[str] = None,
+    format: Optional[str] = Query(None, pattern="^(csv|xlsx|parquet|jsonl|arrow)$",
+                                  description="csv、xlsx、parquet、jsonl 或 arrow"),
+    compression: Optional[str] = Query(None, pattern="^(gzip|zstd)$", description="gzip 或 zstd")
 ):
     """导出已处理的文件"""
     try:
         # 更新文件访问记录
         update_file_access(file_id)
-        file_path = await export_file(file_id, filename)
-        # 使用FastAPI的FileResponse返回文件下载
-        return FastAPIFileResponse(
-            path=file_path,
-            filename=os.path.basename(file_path),
-            media_type="application/octet-stream"
-        )
+        if format is None:
+            negotiated = negotiate_format(request.headers.get("accept"))
+            if negotiated != FORMAT_JSON:
+                format = negotiated
+        return await export_response(request, file_id, format, compression, filename)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="文件不存在")
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"无效输入: {str(ve)}")
     except Exception as e:
         logger.exception("文件导出失败")
         raise HTTPException(status_code=500, detail=f"文件导出失败: {str(e)}")
@@ -133,15 +287,19 @@ async def export_data(
     description="""
     删除已上传的文件及其相关处理结果。
     
-    - 删除文件夹中与file_id相关的所有文件
+    - 删除文件夹中与file_id相关的所有文件,以及该文件生成的图表
+    - 相同内容的文件只保存一份,最后一个引用删除时才释放存储
+    - file_id不是上传时返回的文件ID格式时返回400
     """,
     response_description="返回删除操作结果"
 )
 async def delete_file(file_id: str = FastAPIPath(..., description="要删除的文件唯一ID")):
     """删除上传的文件"""
+    if not is_valid_file_id(file_id):
+        raise HTTPException(status_code=400, detail="无效的文件ID")
     try:
-        for file_path in Path(UPLOAD_DIR).glob(f"{file_id}*"):
-            file_path.unlink()
+        # 删除文件和访问记录会阻塞，在线程池中执行
+        await asyncio.get_running_loop().run_in_executor(None, purge_file, file_id)
         return {"message": "文件已删除"}
     except Exception as e:
         logger.exception("文件删除失败")
@@ -0,0 +1,281 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("access_store")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 服务自身的共享状态（访问记录数据库、清理锁等）保存的目录，与上传文件分开，不会被按file_id删除文件时误删
+STATE_DIR = os.getenv("STATE_DIR") or os.path.join(BASE_DIR, "state")
+# 所有工作进程共享的访问记录数据库
+ACCESS_DB_PATH = os.getenv("ACCESS_DB_PATH") or os.path.join(STATE_DIR, "file_access.db")
+# 旧版本保存在上传目录中的访问记录数据库，首次打开数据库时移动到新位置
+LEGACY_ACCESS_DB_PATH = os.path.join(BASE_DIR, "uploads", "file_access.db")
+# 旧版本的文本访问记录，首次打开数据库时导入
+LEGACY_ACCESS_RECORD_FILE = os.path.join(BASE_DIR, "file_access_records.txt")
+
+# 访问时间在内存中合并，最多延迟多少秒写入数据库
+ACCESS_FLUSH_INTERVAL = float(os.getenv("ACCESS_FLUSH_INTERVAL", 5))
+
+
+class AccessStore:
+    """基于SQLite（WAL模式）的文件访问记录，所有工作进程共享同一份记录
+
+    访问时间先在内存中按file_id合并，定期批量写入；写入时只会把时间往后更新。
+    """
+
+    def __init__(self, db_path: str, flush_interval: float):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # file_id -> 尚未写入的最后访问时间
+        self._pending: Dict[str, float] = {}
+        self._pending_lock = threading.Lock()
+        self._flush_scheduled = False
+        self.flushes = 0
+        self.coalesced = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._move_legacy_db()
+            db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS file_access ("
+                "file_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+            )
+            # 文件产生的派生文件（如图表）索引，文件过期时一并删除
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS file_artifacts ("
+                "path TEXT PRIMARY KEY, file_id TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_file_artifacts_file_id ON file_artifacts (file_id)")
+            # 每个文件的归属客户端和占用字节数，用于存储配额
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS file_usage ("
+                "file_id TEXT PRIMARY KEY, client_id TEXT NOT NULL, bytes INTEGER NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_file_usage_client_id ON file_usage (client_id)")
+            db.commit()
+            self._db = db
+            self._migrate_legacy_records()
+        return self._db
+
+    def _move_legacy_db(self) -> None:
+        """将旧版本上传目录中的数据库移动到当前位置，已存在数据库时不处理"""
+        if os.path.exists(self.db_path) or not os.path.exists(LEGACY_ACCESS_DB_PATH):
+            return
+        # 先移动日志文件，数据库文件最后移动，其他进程看到新数据库时日志已经就位
+        for suffix in ("-wal", "-shm", ""):
+            try:
+                os.replace(f"{LEGACY_ACCESS_DB_PATH}{suffix}", f"{self.db_path}{suffix}")
+            except FileNotFoundError:
+                pass
+        logger.info(f"访问记录数据库已移动到 {self.db_path}")
+
+    def _migrate_legacy_records(self) -> None:
+        """导入旧版本的文本访问记录，导入后重命名原文件"""
+        if not os.path.exists(LEGACY_ACCESS_RECORD_FILE):
+            return
+        records = []
+        try:
+            with open(LEGACY_ACCESS_RECORD_FILE, "r") as f:
+                for line in f:
+                    parts = line.strip().split(",")
+                    if len(parts) != 2:
+                        continue
+                    try:
+                        records.append((parts[0], datetime.fromisoformat(parts[1]).timestamp()))
+                    except ValueError:
+                        logger.error(f"无效的时间戳格式: {parts[1]}")
+            self._upsert(records)
+            os.replace(LEGACY_ACCESS_RECORD_FILE, f"{LEGACY_ACCESS_RECORD_FILE}.migrated")
+            logger.info(f"已将 {len(records)} 条旧版访问记录导入数据库")
+        except FileNotFoundError:
+            # 其他工作进程已经完成导入
+            pass
+        except Exception as e:
+            logger.error(f"导入旧版访问记录失败: {str(e)}")
+
+    def _upsert(self, records: List) -> None:
+        self._db.executemany(
+            "INSERT INTO file_access (file_id, last_access) VALUES (?, ?) "
+            "ON CONFLICT(file_id) DO UPDATE SET last_access = MAX(last_access, excluded.last_access)",
+            records,
+        )
+        self._db.commit()
+
+    def touch(self, file_id: str) -> None:
+        """记录一次访问，稍后与其他访问合并写入数据库"""
+        with self._pending_lock:
+            if file_id in self._pending:
+                self.coalesced += 1
+            self._pending[file_id] = time.time()
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（如脚本调用）时立即写入
+            self.flush()
+            return
+        loop.call_later(self.flush_interval, lambda: loop.run_in_executor(None, self.flush))
+
+    def flush(self) -> int:
+        """将合并后的访问时间批量写入数据库，返回写入条数"""
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = {}
+            self._flush_scheduled = False
+        if not pending:
+            return 0
+        try:
+            with self._db_lock:
+                self._connect()
+                self._upsert(list(pending.items()))
+            self.flushes += 1
+            return len(pending)
+        except sqlite3.Error as e:
+            logger.error(f"写入访问记录失败: {str(e)}")
+            # 放回待写入的记录，下次再试
+            with self._pending_lock:
+                for file_id, accessed in pending.items():
+                    self._pending[file_id] = max(accessed, self._pending.get(file_id, 0))
+            return 0
+
+    def get_expired(self, cutoff: float) -> List[str]:
+        """返回最后访问时间早于cutoff的file_id"""
+        self.flush()
+        with self._db_lock:
+            rows = self._connect().execute(
+                "SELECT file_id FROM file_access WHERE last_access < ?", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def claim_expired(self, file_id: str, cutoff: float) -> bool:
+        """在仍然过期的前提下删除访问记录，返回是否删除成功
+
+        删除与检查在同一条语句中完成，其他工作进程刚刚访问过的文件不会被清理，
+        多个进程同时清理时也只有一个进程会得到该文件。
+        """
+        with self._db_lock:
+            db = self._connect()
+            cursor = db.execute(
+                "DELETE FROM file_access WHERE file_id = ? AND last_access < ?", (file_id, cutoff)
+            )
+            db.commit()
+        return cursor.rowcount == 1
+
+    def forget(self, file_id: str) -> None:
+        """删除文件的访问记录"""
+        with self._pending_lock:
+            self._pending.pop(file_id, None)
+        with self._db_lock:
+            db = self._connect()
+            db.execute("DELETE FROM file_access WHERE file_id = ?", (file_id,))
+            db.execute("DELETE FROM file_usage WHERE file_id = ?", (file_id,))
+            db.commit()
+
+    def record_usage(self, file_id: str, client_id: str, size: int) -> None:
+        """记录文件的归属客户端和占用字节数"""
+        with self._db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO file_usage (file_id, client_id, bytes) VALUES (?, ?, ?)",
+                (file_id, client_id, size),
+            )
+            db.commit()
+
+    def get_client_usage(self, client_id: str) -> Tuple[int, int]:
+        """返回客户端的 (文件数, 占用字节数)"""
+        with self._db_lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM file_usage WHERE client_id = ?", (client_id,)
+            ).fetchone()
+        return int(row[0]), int(row[1])
+
+    def get_usage_summary(self) -> Dict[str, int]:
+        """返回有文件的客户端数量和总占用字节数"""
+        with self._db_lock:
+            row = self._connect().execute(
+                "SELECT COUNT(DISTINCT client_id), COALESCE(SUM(bytes), 0) FROM file_usage"
+            ).fetchone()
+        return {"clients": int(row[0]), "bytes": int(row[1])}
+
+    def get_lru(self) -> List[str]:
+        """按最后访问时间从早到晚返回所有file_id"""
+        self.flush()
+        with self._db_lock:
+            rows = self._connect().execute("SELECT file_id FROM file_access ORDER BY last_access").fetchall()
+        return [row[0] for row in rows]
+
+    def get_tracked_ids(self) -> Set[str]:
+        """返回有访问记录的file_id"""
+        self.flush()
+        with self._db_lock:
+            rows = self._connect().execute("SELECT file_id FROM file_access").fetchall()
+        return {row[0] for row in rows}
+
+    def add_artifact(self, file_id: str, path: str) -> None:
+        """记录file_id产生的派生文件"""
+        with self._db_lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO file_artifacts (path, file_id, created_at) VALUES (?, ?, ?)",
+                (path, file_id, time.time()),
+            )
+            db.commit()
+
+    def pop_artifacts(self, file_id: str) -> List[str]:
+        """取出并删除file_id的派生文件记录"""
+        with self._db_lock:
+            db = self._connect()
+            rows = db.execute("SELECT path FROM file_artifacts WHERE file_id = ?", (file_id,)).fetchall()
+            db.execute("DELETE FROM file_artifacts WHERE file_id = ?", (file_id,))
+            db.commit()
+        return [row[0] for row in rows]
+
+    def get_artifact_paths_for(self, file_id: str) -> List[str]:
+        """返回file_id的派生文件路径"""
+        with self._db_lock:
+            rows = self._connect().execute("SELECT path FROM file_artifacts WHERE file_id = ?", (file_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_artifact_paths(self) -> Set[str]:
+        """返回所有已记录的派生文件路径"""
+        with self._db_lock:
+            rows = self._connect().execute("SELECT path FROM file_artifacts").fetchall()
+        return {row[0] for row in rows}
+
+    def count(self) -> int:
+        with self._db_lock:
+            return self._connect().execute("SELECT COUNT(*) FROM file_access").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        """返回访问记录写入统计"""
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"pending": pending, "flushes": self.flushes, "coalesced": self.coalesced}
+
+    def close(self) -> None:
+        """写入剩余的记录并关闭数据库"""
+        self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# 进程内共享的访问记录
+access_store = AccessStore(ACCESS_DB_PATH, ACCESS_FLUSH_INTERVAL)
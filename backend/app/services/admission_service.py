@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import logging
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger("admission_service")
+
+# 每个工作进程同时处理的聊天请求上限
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", 4))
+# 同一文件同时处理的聊天请求上限
+CHAT_MAX_CONCURRENCY_PER_FILE = int(os.getenv("CHAT_MAX_CONCURRENCY_PER_FILE", 2))
+# 排队等待的请求上限，超过后直接拒绝
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", 16))
+# 排队的最长等待时间（秒）
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", 30))
+
+
+class AdmissionRejected(Exception):
+    """请求因并发或排队已满被拒绝"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """限制同时处理的请求数，超出的请求在有界队列中按先后顺序等待"""
+
+    def __init__(self, max_concurrency: int, max_per_key: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_per_key = max_per_key
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._active_per_key: Dict[str, int] = defaultdict(int)
+        self._waiters: Deque[Tuple[str, asyncio.Future]] = deque()
+        # 统计指标
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_queue_depth = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._avg_service_seconds = 10.0
+
+    def _has_capacity(self, key: str) -> bool:
+        return self._active < self.max_concurrency and self._active_per_key.get(key, 0) < self.max_per_key
+
+    def _grant(self, key: str) -> None:
+        self._active += 1
+        self._active_per_key[key] += 1
+
+    def _retry_after(self) -> int:
+        """根据平均处理时间估算客户端应等待的秒数"""
+        backlog = len(self._waiters) + 1
+        return max(1, int(self._avg_service_seconds * backlog / max(self.max_concurrency, 1)))
+
+    async def acquire(self, key: str) -> float:
+        """获取执行许可，必要时排队等待，返回获得许可的时间"""
+        started = time.monotonic()
+        # 队列中剩下的请求都在等待各自文件的并发名额，不影响其他文件的请求
+        if self._has_capacity(key) and not any(waiter_key == key for waiter_key, _ in self._waiters):
+            self._grant(key)
+            self.admitted += 1
+            return started
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"请求队列已满({len(self._waiters)})，拒绝请求: {key}")
+            raise AdmissionRejected("服务繁忙，请稍后重试", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((key, future))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._remove_waiter(future)
+                self.timed_out += 1
+                self.rejected += 1
+                logger.warning(f"请求排队超过 {self.queue_timeout} 秒，拒绝请求: {key}")
+                raise AdmissionRejected("排队等待超时，请稍后重试", self._retry_after())
+        except asyncio.CancelledError:
+            # 客户端断开连接：已获得许可则归还，否则退出队列
+            if future.done():
+                self.release(key)
+            else:
+                self._remove_waiter(future)
+            raise
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return time.monotonic()
+
+    def release(self, key: str, started: Optional[float] = None) -> None:
+        """归还执行许可并唤醒可以执行的排队请求"""
+        if started is not None:
+            # 平滑更新平均处理时间，用于估算 Retry-After
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * (time.monotonic() - started)
+        self._active -= 1
+        self._active_per_key[key] -= 1
+        if self._active_per_key[key] <= 0:
+            del self._active_per_key[key]
+
+        # 按先后顺序唤醒，跳过所在文件已达到并发上限的请求
+        for waiter_key, future in list(self._waiters):
+            if self._active >= self.max_concurrency:
+                break
+            if self._has_capacity(waiter_key):
+                self._waiters.remove((waiter_key, future))
+                self._grant(waiter_key)
+                future.set_result(True)
+
+    def releaser(self, key: str, started: Optional[float] = None) -> Callable[[], None]:
+        """返回归还许可的函数，可以在多条路径上调用，只会归还一次"""
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.release(key, started)
+
+        return release
+
+    def _remove_waiter(self, future: asyncio.Future) -> None:
+        for item in list(self._waiters):
+            if item[1] is future:
+                self._waiters.remove(item)
+                break
+
+    def stats(self) -> Dict[str, Any]:
+        """返回排队和并发指标"""
+        return {
+            "active": self._active,
+            "queue_depth": len(self._waiters),
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_seconds": round(self.total_wait_seconds / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 4),
+            "max_concurrency": self.max_concurrency,
+            "max_concurrency_per_file": self.max_per_key,
+            "max_queue": self.max_queue,
+        }
+
+
+# 聊天请求的准入控制
+chat_admission = AdmissionController(
+    CHAT_MAX_CONCURRENCY,
+    CHAT_MAX_CONCURRENCY_PER_FILE,
+    CHAT_MAX_QUEUE,
+    CHAT_QUEUE_TIMEOUT,
+)
@@ -1,17 +1,25 @@
 import os
+import json
 import logging
-import sys
-import traceback
-import uuid
+import functools
+import threading
+import httpx
+import openai
 import pandas as pd
-import matplotlib.pyplot as plt
-import asyncio
 import numpy as np
-from typing import Dict, List, Any, Optional, Tuple
-from io import StringIO
+from typing import Callable, Dict, List, Any, Optional, Tuple
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from concurrent.futures import ThreadPoolExecutor
+
+from app.services.code_executor import code_executor
+from app.services.dataframe_cache import dataframe_cache
+from app.services.file_service import (
+    find_file_path, write_table_snapshot, get_processed_base_path, get_processed_key_path,
+    remove_processed_files, mark_processed_pending, clear_processed_pending
+)
+from app.services.result_writer import result_writer
+from app.services.quota_service import QuotaExceededError, check_result_size
+from app.services.cpu_pool import run_cpu
 
 logger = logging.getLogger("agent_service")
 
@@ -28,97 +36,202 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# 线程池执行器，用于运行代码
-executor = ThreadPoolExecutor(max_workers=2)
+# LLM客户端配置
+# 默认使用的模型
+LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-chat")
+# 连接池：最大连接数、最大空闲连接数、空闲连接保留时间（秒）
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 20))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 10))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+# 是否启用HTTP/2（需要安装h2）
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "False").lower() == "true"
+# 遇到429/5xx时的最大重试次数，重试间隔为带随机抖动的指数退避，并遵循Retry-After
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+# 单次请求超时（秒）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+# 按模型覆盖的配置（JSON），如 {"deepseek-reasoner": {"temperature": 0.6, "timeout": 120}}
+LLM_MODEL_CONFIG: Dict[str, Dict[str, Any]] = json.loads(os.getenv("LLM_MODEL_CONFIG", "{}"))
 
-def get_agent():
-    """初始化并返回LangChain代理"""
-    try:
-        # 从环境变量中获取API密钥
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("未找到DeepSeek API密钥,请在.env文件中设置OPENAI_API_KEY")
-        
-        # 获取API基础URL
-        base_url = os.getenv("OPENAI_API_BASE", "https://api.deepseek.com")
-        
-        # 初始化DeepSeek聊天模型 (使用OpenAI兼容接口)
-        llm = ChatOpenAI(
-            api_key=api_key,
-            model="deepseek-chat",  # 使用DeepSeek-V3模型
-            temperature=0.2,
-            timeout=60.0,
-            base_url=base_url
-        )
-        
+# 模型名 -> 共享的聊天模型实例
+_llm_registry: Dict[str, ChatOpenAI] = {}
+# 需要在关闭时释放的HTTP客户端
+_http_clients: List[Any] = []
+_registry_lock = threading.Lock()
+
+def _get_model_config(model: str) -> Dict[str, Any]:
+    """合并默认配置和该模型的覆盖配置"""
+    config = {
+        "api_key": os.getenv("OPENAI_API_KEY"),
+        "base_url": os.getenv("OPENAI_API_BASE", "https://api.deepseek.com"),
+        "temperature": 0.2,
+        "timeout": LLM_TIMEOUT,
+        "max_retries": LLM_MAX_RETRIES,
+    }
+    config.update(LLM_MODEL_CONFIG.get(model, {}))
+    return config
+
+def _create_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """创建带连接池的HTTP客户端，复用长连接避免每次请求重新握手"""
+    limits = httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+    http2 = LLM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("未安装h2，无法启用HTTP/2，将使用HTTP/1.1")
+            http2 = False
+    return httpx.Client(limits=limits, http2=http2), httpx.AsyncClient(limits=limits, http2=http2)
+
+def get_agent(model: Optional[str] = None) -> ChatOpenAI:
+    """返回进程内共享的LangChain聊天模型
+
+    同一模型只创建一次，所有请求复用同一个HTTP连接池。
+    OPENAI_API_BASE 可以指向任何OpenAI兼容的服务（包括本地测试桩）。
+    """
+    model = model or LLM_MODEL
+    llm = _llm_registry.get(model)
+    if llm is not None:
         return llm
-        
-    except Exception as e:
-        logger.exception("初始化AI代理失败")
-        raise e
-
-def _execute_code_in_thread(df: pd.DataFrame, code: str) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
-    """在单独的线程中执行代码"""
-    # 函数内部的重定向和代码执行
-    result_df = None
-    error_message = None
-    image_path = None
-    
-    # 保存原始的标准输出和标准错误
-    original_stdout = sys.stdout
-    original_stderr = sys.stderr
-    
-    # 创建字符串IO对象捕获输出
-    stdout_capture = StringIO()
-    stderr_capture = StringIO()
     
+    with _registry_lock:
+        llm = _llm_registry.get(model)
+        if llm is not None:
+            return llm
+        try:
+            config = _get_model_config(model)
+            if not config["api_key"]:
+                raise ValueError("未找到DeepSeek API密钥,请在.env文件中设置OPENAI_API_KEY")
+            
+            http_client, async_http_client = _create_http_clients()
+            client_params = {
+                "api_key": config["api_key"],
+                "base_url": config["base_url"],
+                "timeout": config["timeout"],
+                # 由OpenAI SDK对429/5xx进行带抖动的指数退避重试
+                "max_retries": config["max_retries"],
+            }
+            
+            # 初始化DeepSeek聊天模型 (使用OpenAI兼容接口)
+            llm = ChatOpenAI(
+                api_key=config["api_key"],
+                model=model,
+                temperature=config["temperature"],
+                timeout=config["timeout"],
+                max_retries=config["max_retries"],
+                base_url=config["base_url"],
+                client=openai.OpenAI(http_client=http_client, **client_params).chat.completions,
+                async_client=openai.AsyncOpenAI(http_client=async_http_client, **client_params).chat.completions,
+            )
+            _http_clients.extend([http_client, async_http_client])
+            _llm_registry[model] = llm
+            logger.info(f"已创建模型 {model} 的共享客户端")
+            return llm
+            
+        except Exception as e:
+            logger.exception("初始化AI代理失败")
+            raise e
+
+async def close_agents() -> None:
+    """关闭所有共享的HTTP客户端"""
+    with _registry_lock:
+        clients = list(_http_clients)
+        _http_clients.clear()
+        _llm_registry.clear()
+    for client in clients:
+        if isinstance(client, httpx.AsyncClient):
+            await client.aclose()
+        else:
+            client.close()
+
+def _write_processed_file(result_df: Optional[pd.DataFrame], file_id: str, exec_key: Optional[str], token: str) -> None:
+    """在后台写入线程中保存处理结果快照，result_df为None时删除处理结果
+
+    token为提交时写入标记的令牌，之后又有写入提交时由最后一次写入删除标记。
+    """
+    key_path = get_processed_key_path(file_id)
     try:
-        # 重定向标准输出和标准错误
-        sys.stdout = stdout_capture
-        sys.stderr = stderr_capture
-        
-        # 创建本地环境执行用户代码
-        local_env = {"df": df.copy(), "pd": pd, "plt": plt}
-        
-        # 执行代码
-        exec(code, local_env)
+        if find_file_path(file_id) is None:
+            # 文件在等待写入期间已被删除
+            return
+        if result_df is None:
+            remove_processed_files(file_id)
+            processed_file_path = None
+        else:
+            processed_file_path = write_table_snapshot(result_df, get_processed_base_path(file_id))
+            # 删除其他格式的旧结果和由旧结果渲染的导出文件
+            remove_processed_files(file_id, keep=processed_file_path)
+            # 结果表直接放入缓存，查看处理结果和导出时无需重新读取
+            dataframe_cache.put(f"{file_id}_processed", os.path.getmtime(processed_file_path), result_df)
         
-        # 检查本地环境中是否有处理后的DataFrame
-        if "result" in local_env and isinstance(local_env["result"], pd.DataFrame):
-            result_df = local_env["result"]
-        
-        # 检查是否有图表生成
-        if plt.get_fignums():
-            # 生成唯一的图像文件名
-            image_name = f"plot_{uuid.uuid4()}.png"
-            image_path = os.path.join(IMAGES_DIR, image_name)
-            
-            # 保存图表
-            plt.savefig(image_path)
-            plt.close('all')  # 关闭所有图表
-    
-    except Exception as e:
-        error_message = f"代码执行错误: {str(e)}\n{traceback.format_exc()}"
-        logger.error(error_message)
-    
+        if exec_key is not None:
+            with open(key_path, "w") as f:
+                f.write(exec_key)
+        elif os.path.exists(key_path):
+            os.remove(key_path)
+        if find_file_path(file_id) is None:
+            # 写入期间原始文件被删除，清理刚写入的结果
+            remove_processed_files(file_id)
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            dataframe_cache.invalidate(f"{file_id}_processed")
+            return
+        if processed_file_path:
+            logger.info(f"处理后的文件已保存: {processed_file_path}")
     finally:
-        # 恢复标准输出和标准错误
-        sys.stdout = original_stdout
-        sys.stderr = original_stderr
+        clear_processed_pending(file_id, token)
+
+def _submit_processed_write(result_df: Optional[pd.DataFrame], file_id: str, exec_key: Optional[str]) -> None:
+    # 先写入标记，其他工作进程读取处理结果时会等待写入完成
+    token = mark_processed_pending(file_id)
+    result_writer.submit(f"processed:{file_id}",
+                         functools.partial(_write_processed_file, result_df, file_id, exec_key, token), exec_key)
+
+async def save_processed_file(result_df: pd.DataFrame, file_id: str, exec_key: Optional[str] = None) -> None:
+    """提交处理结果的保存任务，返回时结果可能尚未写入；结果超出配额时抛出QuotaExceededError
+
+    结果在后台线程中保存为Parquet快照，导出时再按需转换格式；读取处理结果时会等待写入完成。
+    """
+    if exec_key is not None:
+        pending, pending_key = result_writer.get_pending(f"processed:{file_id}")
+        if pending:
+            if pending_key == exec_key:
+                return
+        else:
+            key_path = get_processed_key_path(file_id)
+            if os.path.exists(key_path):
+                with open(key_path, "r") as f:
+                    if f.read().strip() == exec_key:
+                        return
+    await run_cpu("check_result", check_result_size, result_df)
     
-    return result_df, image_path, error_message
+    if not await get_file_path_by_id(file_id):
+        return
+    _submit_processed_write(result_df, file_id, exec_key)
 
-async def process_dataframe_with_code(df: pd.DataFrame, code: str, file_id: str) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
-    """使用生成的代码处理DataFrame并返回结果和可能的图像路径"""
+async def clear_processed_file(file_id: str) -> None:
+    """删除处理结果文件，之后导出和查看处理结果时回到原始文件
+
+    与保存任务按提交顺序执行，不会被之前尚未写入的结果覆盖。
+    """
+    _submit_processed_write(None, file_id, None)
+
+def _sanitize_result(result_df: pd.DataFrame) -> pd.DataFrame:
+    """将结果中的无穷值和空值替换为None"""
+    result_df = result_df.replace([float('inf'), float('-inf'), np.inf, -np.inf], None)
+    return result_df.where(pd.notnull(result_df), None)
+
+async def process_dataframe_with_code(df: pd.DataFrame, code: str, file_id: str,
+                                      on_save: Optional[Callable[[], None]] = None,
+                                      exec_key: Optional[str] = None,
+                                      schema: Optional[Dict[str, str]] = None) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """使用生成的代码处理DataFrame并返回结果和可能的图像路径，schema为输入表的列类型方案"""
     try:
-        # 使用线程池执行代码
-        loop = asyncio.get_event_loop()
-        result_df, image_path, error = await loop.run_in_executor(
-            executor, 
-            _execute_code_in_thread, 
-            df, 
-            code
-        )
+        # 在独立的执行进程中运行代码
+        result_df, image_path, error = await code_executor.run(df, code, schema)
         
         if error:
             logger.error(f"代码执行错误: {error}")
@@ -126,25 +239,18 @@ async def process_dataframe_with_code(df: pd.DataFrame, code: str, file_id: str)
         
         # 如果有结果DataFrame，保存处理后的文件
         if result_df is not None:
+            if on_save is not None:
+                on_save()
+            
             # 处理特殊浮点值，避免JSON序列化问题
-            result_df = result_df.replace([float('inf'), float('-inf'), np.inf, -np.inf], None)
-            result_df = result_df.where(pd.notnull(result_df), None)
+            result_df = await run_cpu("sanitize", _sanitize_result, result_df)
             
-            # 确定文件类型并保存
-            original_file_path = await get_file_path_by_id(file_id)
-            if original_file_path:
-                file_ext = os.path.splitext(original_file_path)[1]
-                processed_file_path = os.path.join(UPLOAD_DIR, f"{file_id}_processed{file_ext}")
-                
-                if file_ext.lower() == '.csv':
-                    result_df.to_csv(processed_file_path, index=False)
-                else:
-                    result_df.to_excel(processed_file_path, index=False)
-                
-                logger.info(f"处理后的文件已保存: {processed_file_path}")
+            await save_processed_file(result_df, file_id, exec_key)
         
         return result_df, image_path
         
+    except QuotaExceededError:
+        raise
     except Exception as e:
         logger.exception("处理DataFrame时发生错误")
         return None, None
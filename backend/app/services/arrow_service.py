@@ -0,0 +1,81 @@
+import logging
+from typing import Dict, Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.responses import Response
+
+from app.services.cpu_pool import run_cpu
+
+logger = logging.getLogger("arrow_service")
+
+# 表格数据的响应格式
+FORMAT_JSON = "json"
+FORMAT_ARROW = "arrow"
+FORMAT_PARQUET = "parquet"
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+# Accept请求头中的媒体类型 -> 响应格式
+_MEDIA_TYPE_FORMATS: Dict[str, str] = {
+    ARROW_STREAM_MEDIA_TYPE: FORMAT_ARROW,
+    PARQUET_MEDIA_TYPE: FORMAT_PARQUET,
+    "application/x-parquet": FORMAT_PARQUET,
+    "application/json": FORMAT_JSON,
+    "*/*": FORMAT_JSON,
+}
+_FORMAT_MEDIA_TYPES = {FORMAT_ARROW: ARROW_STREAM_MEDIA_TYPE, FORMAT_PARQUET: PARQUET_MEDIA_TYPE}
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    """根据Accept请求头选择响应格式，没有可用的二进制格式时返回json"""
+    best, best_q = FORMAT_JSON, 0.0
+    for item in (accept or "").split(","):
+        parts = item.strip().split(";")
+        fmt = _MEDIA_TYPE_FORMATS.get(parts[0].strip().lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """将DataFrame转换为Arrow表，保留列的数据类型
+
+    数值列直接引用DataFrame的内存；混合类型等无法转换的对象列退回为字符串。
+    """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        logger.info(f"表格含有无法直接转换为Arrow的列，按字符串转换: {str(e)}")
+        converted = df.copy()
+        for col in converted.columns[converted.dtypes == object]:
+            converted[col] = converted[col].map(lambda value: None if pd.isna(value) else str(value))
+        return pa.Table.from_pandas(converted, preserve_index=False)
+
+
+def encode_table(table: pa.Table, fmt: str) -> bytes:
+    """将Arrow表编码为Arrow IPC流或Parquet"""
+    sink = pa.BufferOutputStream()
+    if fmt == FORMAT_ARROW:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink)
+    return sink.getvalue().to_pybytes()
+
+
+async def table_response(table: pa.Table, fmt: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """以二进制格式返回表格，编码在CPU线程池中进行"""
+    body = await run_cpu("encode", encode_table, table, fmt)
+    return Response(content=body, media_type=_FORMAT_MEDIA_TYPES[fmt], headers={"Vary": "Accept", **(headers or {})})
@@ -0,0 +1,127 @@
+import os
+import shutil
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger("blob_store")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+# 内容寻址存储目录：每份内容只保存一次，文件名为内容的SHA-256
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+
+# 确保目录存在
+os.makedirs(BLOB_DIR, exist_ok=True)
+
+# file_id -> 内容哈希，引用文件写入后不会再改变
+_ref_cache: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def get_blob_path(content_hash: str, file_extension: str) -> str:
+    """获取内容对应的blob路径"""
+    return os.path.join(BLOB_DIR, f"{content_hash}{file_extension}")
+
+
+def get_ref_path(file_id: str) -> str:
+    """获取file_id的引用记录文件路径"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}.ref")
+
+
+def store_and_link(tmp_path: str, content_hash: str, file_extension: str, target_path: str) -> bool:
+    """将上传的临时文件放入内容寻址存储，并在target_path创建指向blob的硬链接
+
+    内容已存在时丢弃临时文件，直接复用已有的blob。返回是否复用了已有内容。
+    引用计数以引用记录文件为准（文件系统不支持硬链接时退回为复制，链接数不可靠），
+    调用前应先写入引用记录。
+    """
+    blob_path = get_blob_path(content_hash, file_extension)
+    with _lock:
+        reused = os.path.exists(blob_path)
+        if reused:
+            try:
+                _link(blob_path, target_path)
+                os.remove(tmp_path)
+                return True
+            except FileNotFoundError:
+                # blob恰好被其他进程释放，改为使用本次上传的内容
+                reused = False
+        os.replace(tmp_path, blob_path)
+        _link(blob_path, target_path)
+        return False
+
+
+def write_ref(file_id: str, content_hash: str) -> None:
+    """记录file_id引用的内容哈希"""
+    with open(get_ref_path(file_id), "w") as f:
+        f.write(content_hash)
+    _ref_cache[file_id] = content_hash
+
+
+def read_ref(file_id: str) -> Optional[str]:
+    """读取file_id引用的内容哈希，旧版本上传的文件没有引用记录"""
+    content_hash = _ref_cache.get(file_id)
+    if content_hash is not None:
+        return content_hash
+    try:
+        with open(get_ref_path(file_id), "r") as f:
+            content_hash = f.read().strip()
+    except FileNotFoundError:
+        return None
+    if content_hash:
+        _ref_cache[file_id] = content_hash
+        return content_hash
+    return None
+
+
+def forget_ref(file_id: str) -> None:
+    """移除引用的内存记录"""
+    _ref_cache.pop(file_id, None)
+
+
+def _iter_refs():
+    """遍历所有引用记录，产生 (file_id, 内容哈希)"""
+    for ref_path in Path(UPLOAD_DIR).glob("*.ref"):
+        try:
+            content_hash = ref_path.read_text().strip()
+        except FileNotFoundError:
+            continue
+        if content_hash:
+            yield ref_path.stem, content_hash
+
+
+def get_ref_count(content_hash: str) -> int:
+    """返回引用该内容的file_id数量"""
+    return sum(1 for _, ref_hash in _iter_refs() if ref_hash == content_hash)
+
+
+def get_referenced_hashes() -> Set[str]:
+    """返回仍被file_id引用的内容哈希"""
+    return {content_hash for _, content_hash in _iter_refs()}
+
+
+def release_blob(content_hash: str) -> bool:
+    """在最后一个引用被删除后移除blob及其派生文件，返回是否已移除"""
+    with _lock:
+        if get_ref_count(content_hash) > 0:
+            return False
+        for blob_path in Path(BLOB_DIR).glob(f"{content_hash}*"):
+            try:
+                blob_path.unlink()
+                logger.info(f"已删除无引用的blob: {blob_path}")
+            except FileNotFoundError:
+                pass
+        return True
+
+
+def _link(blob_path: str, target_path: str) -> None:
+    try:
+        os.link(blob_path, target_path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # 文件系统不支持硬链接时退回为复制（此时不再共享存储空间）
+        shutil.copyfile(blob_path, target_path)
@@ -0,0 +1,375 @@
+import os
+import asyncio
+import functools
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+import pandas as pd
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+
+from app.models.chat_models import ChatMessage
+from app.services.agent_service import get_agent, process_dataframe_with_code, save_processed_file, LLM_MODEL
+from app.services.file_service import get_file_path_by_id, load_dataframe
+from app.services.blob_store import read_ref
+from app.services.exec_cache import exec_cache, build_exec_cache_key
+from app.services.result_writer import result_writer
+from app.services.profile_service import get_table_profile, describe_column_stats
+from app.services.response_cache import llm_response_cache, build_response_cache_key
+from app.services.session_service import load_session, get_session_history, append_session_turn, session_lock
+from app.services.lineage_service import get_current_step, load_step_dataframe, add_step
+from app.services.file_cleanup_service import record_file_artifact
+from app.services.json_serializer import dumps, frame_to_records
+from app.services.cpu_pool import run_cpu
+from app.services.dtype_service import get_schema_columns, get_executor_schema
+
+logger = logging.getLogger("chat_service")
+
+# 处理阶段回调，参数为阶段名称: load / llm / exec / save
+PhaseCallback = Optional[Callable[[str], None]]
+
+
+def _notify(on_phase: PhaseCallback, phase: str) -> None:
+    if on_phase is not None:
+        on_phase(phase)
+
+
+def build_system_message(file_path: str, df_info: Dict[str, Any]) -> str:
+    """根据表格概况构建系统提示词"""
+    column_stats_text = "\n".join(describe_column_stats(df_info))
+    system_message = f"""你是一位专业的数据分析师,帮助用户处理表格数据。用户上传的文件为: {os.path.basename(file_path)}。
+
+表格基本信息:
+- 列名: {df_info['columns']}
+- 数据类型: {df_info['dtypes']}
+- 表格大小: {df_info['shape'][0]}行 × {df_info['shape'][1]}列
+- 缺失值统计: {df_info['missing_values']}
+- 列统计:
+{column_stats_text}
+- 数据样例:
+{pd.DataFrame(df_info['sample_data']).to_string(index=False)}
+
+请按照以下要求生成Python代码:
+1. 使用pandas库处理数据,已经预先导入为df变量
+2. 所有处理后的结果必须存储在名为'result'的DataFrame变量中
+3. 如果需要可视化,使用matplotlib库(已预先导入为plt)
+4. 生成的代码必须可以直接运行,不需要额外的导入语句
+5. 代码应简洁且易于理解,添加适当的注释
+6. 不要使用可能影响系统安全的操作(如os、subprocess等)
+
+示例格式:
+```python
+# 处理数据
+result = df.copy()  # 创建一个副本进行操作
+
+# 对特定列进行操作
+result['新列'] = result['现有列'] * 2
+
+# 结果必须存储在名为result的DataFrame中
+```"""
+    return system_message
+
+
+def build_messages(system_message: str, history: List[ChatMessage], message: str) -> List[Any]:
+    """构建LangChain消息列表"""
+    messages = [SystemMessage(content=system_message)]
+    
+    # 添加历史消息
+    for msg in history:
+        if msg.role == "user":
+            messages.append(HumanMessage(content=msg.content))
+        elif msg.role == "assistant":
+            messages.append(AIMessage(content=msg.content))
+    
+    # 添加当前用户消息
+    messages.append(HumanMessage(content=message))
+    return messages
+
+
+def extract_code_blocks(text: str) -> List[Dict[str, str]]:
+    """从Markdown文本中提取代码块"""
+    blocks = []
+    lines = text.split('\n')
+    
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        
+        # 查找代码块开始
+        if line.startswith('```'):
+            language = line[3:].strip()
+            code_lines = []
+            i += 1
+            
+            # 收集代码块内容直到结束标记
+            while i < len(lines) and not lines[i].startswith('```'):
+                code_lines.append(lines[i])
+                i += 1
+                
+            # 添加找到的代码块
+            if i < len(lines):  # 确保找到了结束标记
+                blocks.append({
+                    "language": language,
+                    "code": '\n'.join(code_lines)
+                })
+                
+        i += 1
+        
+    return blocks
+
+
+def extract_python_code(text: str) -> str:
+    """提取回复中的第一个Python代码块"""
+    for block in extract_code_blocks(text):
+        if block.get("language", "").lower() == "python":
+            return block.get("code", "")
+    return ""
+
+
+def _get_content_key(file_id: str, file_path: str) -> str:
+    """获取文件内容的标识：优先使用内容哈希，旧版本上传的文件使用file_id和修改时间"""
+    return read_ref(file_id) or f"{file_id}:{os.path.getmtime(file_path)}"
+
+
+async def _run_generated_code(file_id: str, file_path: str, python_code: str, on_phase: PhaseCallback,
+                             step: Optional[Dict[str, Any]]) -> Tuple[Optional[pd.DataFrame], Optional[str], str]:
+    """在step的结果表（为None时在原始表）上执行代码，返回结果表、图表路径和执行键"""
+    # 步骤结果表以生成它的执行键作为内容标识，多步处理可以逐步命中缓存
+    input_key = step["exec_key"] if step else _get_content_key(file_id, file_path)
+    exec_key = build_exec_cache_key(input_key, python_code)
+    
+    # 缓存的结果表需要解析Parquet，在CPU线程池中读取
+    cached = await run_cpu("exec_cache", exec_cache.get, exec_key)
+    if cached is not None:
+        logger.info(f"命中执行结果缓存: {file_id}")
+        result_df, image_path = cached
+        if result_df is not None:
+            await save_processed_file(result_df, file_id, exec_key)
+        return result_df, image_path, exec_key
+    
+    # 只有需要执行代码时才加载数据，上一步的结果表直接从缓存中按引用取出
+    if step:
+        df = await load_step_dataframe(file_id, step)
+        schema = None
+    else:
+        df = await load_dataframe(file_id, file_path)
+        # 原始表在执行进程中按文件的类型方案转换，category列改为Arrow字符串
+        columns = get_schema_columns(file_id)
+        schema = get_executor_schema(columns) if columns else None
+    
+    # 执行代码并获取结果
+    result_df, image_path = await process_dataframe_with_code(
+        df, python_code, file_id,
+        on_save=lambda: _notify(on_phase, "save"),
+        exec_key=exec_key,
+        schema=schema
+    )
+    if image_path:
+        # 记录图表的归属，文件过期或删除时一并清理
+        await asyncio.get_running_loop().run_in_executor(None, record_file_artifact, file_id, image_path)
+    # 执行结果缓存由后台线程写入，不阻塞响应
+    result_writer.submit(f"exec_cache:{exec_key}",
+                         functools.partial(exec_cache.put, exec_key, result_df, image_path))
+    return result_df, image_path, exec_key
+
+
+async def execute_generated_code(file_id: str, file_path: str, python_code: str, on_phase: PhaseCallback = None,
+                                 use_session: bool = False) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """执行生成的代码，返回结果预览和图表URL
+
+    use_session为True时代码作用于会话当前步骤的结果表，执行结果成为新的步骤；
+    否则作用于原始表。相同的输入表上执行过相同的代码时，直接返回缓存的结果表和图表。
+    """
+    _notify(on_phase, "exec")
+    if use_session:
+        # 从读取当前步骤到记录新步骤期间持有会话锁，并发的对话或撤销不会让结果记到其他步骤之后
+        async with session_lock(file_id):
+            step = get_current_step(load_session(file_id))
+            result_df, image_path, exec_key = await _run_generated_code(file_id, file_path, python_code,
+                                                                        on_phase, step)
+            if result_df is not None:
+                await add_step(file_id, result_df, exec_key, python_code)
+    else:
+        result_df, image_path, _ = await _run_generated_code(file_id, file_path, python_code, on_phase, None)
+    
+    result = None
+    image_url = None
+    # 如果有结果DataFrame,转换为字符串表示预览
+    if result_df is not None:
+        # 只转换预览的前20行，空值和特殊浮点值转换为None
+        result = {
+            "success": True,
+            "preview": await run_cpu("serialize", frame_to_records, result_df.head(20)),
+            "columns": result_df.columns.tolist(),
+            "rows_count": len(result_df)
+        }
+        
+        # 如果生成了图像,提供图像URL
+        if image_path:
+            # 将路径转换为URL
+            image_url = f"/static/images/{os.path.basename(image_path)}"
+    
+    return result, image_url
+
+
+def _should_cache_response(python_code: str, result: Optional[Dict[str, Any]], image_url: Optional[str]) -> bool:
+    """只缓存不含代码或代码成功执行的回复，避免重复返回执行失败的代码"""
+    return not python_code or result is not None or image_url is not None
+
+
+async def prepare_chat(file_id: str, message: str,
+                       history: Optional[List[ChatMessage]] = None) -> Tuple[str, List[Any], str]:
+    """查找文件并根据表格概况构建发送给AI的消息列表，同时返回AI回复的缓存键
+
+    未提供history时使用服务端保存的会话历史，客户端每轮只需发送新的问题。
+    """
+    # 获取文件路径
+    file_path = await get_file_path_by_id(file_id)
+    if not file_path:
+        raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+    
+    # 读取预先计算的表格概况，无需每次都重新分析数据
+    df_info = await get_table_profile(file_id)
+    system_message = build_system_message(file_path, df_info)
+    key_history = history or []
+    if history is None:
+        session = load_session(file_id)
+        history = get_session_history(session)
+        key_history = history
+        if session.get("summary"):
+            # 摘要只在压缩历史时变化，系统提示词前缀在多轮之间保持不变
+            system_message = f"{system_message}\n\n{session['summary']}"
+            key_history = [ChatMessage(role="system", content=session["summary"])] + history
+        step = get_current_step(session)
+        if step:
+            # 代码将作用于上一步的结果，把当前表结构附在本轮问题后面
+            message = (f"{message}\n\n(注意: 当前df是第{step['step']}步处理后的结果,"
+                       f"共{step['rows_count']}行,列名: {step['columns']})")
+    
+    messages = build_messages(system_message, history, message)
+    cache_key = build_response_cache_key(LLM_MODEL, df_info, key_history, message)
+    return file_path, messages, cache_key
+
+
+async def run_chat(file_id: str, message: str, history: Optional[List[ChatMessage]] = None,
+                   on_phase: PhaseCallback = None) -> Dict[str, Any]:
+    """完成一轮对话：构建提示词、调用AI生成代码并执行，返回回复和处理结果"""
+    _notify(on_phase, "load")
+    file_path, messages, cache_key = await prepare_chat(file_id, message, history)
+    
+    # 相同表结构上的相同问题直接复用之前生成的回复
+    ai_response = await llm_response_cache.aget(cache_key)
+    cached = ai_response is not None
+    if cached:
+        logger.info(f"命中AI回复缓存: {file_id}")
+    else:
+        # 获取Agent
+        agent = get_agent()
+        
+        # 调用AI生成代码
+        _notify(on_phase, "llm")
+        response = await agent.ainvoke(messages)
+        ai_response = response.content
+    
+    # 提取Python代码
+    python_code = extract_python_code(ai_response)
+    
+    # 如果找到可执行的Python代码,执行它
+    result = None
+    image_url = None
+    if python_code:
+        result, image_url = await execute_generated_code(file_id, file_path, python_code, on_phase,
+                                                         use_session=history is None)
+    
+    if not cached and _should_cache_response(python_code, result, image_url):
+        await llm_response_cache.aput(cache_key, ai_response)
+    
+    # 客户端未提供历史时由服务端记录本轮对话
+    if history is None:
+        await append_session_turn(file_id, message, ai_response)
+    
+    return {
+        "response": ai_response,
+        "code": python_code if python_code else None,
+        "result": result,
+        "image_url": image_url
+    }
+
+
+# 客户端断开后仍在后台完成的执行任务，保留引用避免被回收
+_detached_tasks: Set[asyncio.Task] = set()
+
+
+def _finish_detached_task(task: asyncio.Task) -> None:
+    _detached_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"客户端断开后执行代码失败: {task.exception()}")
+
+
+async def _replay_cached_response(ai_response: str) -> AsyncIterator[Any]:
+    """将缓存的回复作为一个完整的增量返回"""
+    yield AIMessage(content=ai_response)
+
+
+async def stream_chat(file_id: str, file_path: str, messages: List[Any], cache_key: Optional[str] = None,
+                      session_message: Optional[str] = None) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """流式完成一轮对话，依次产生 (事件名, 数据)
+
+    提供session_message时，回复完成后将本轮对话记入服务端会话。
+
+    - token: AI回复的增量文本（命中缓存时为完整回复）
+    - code: 代码块结束标记到达，代码已开始执行
+    - result: 回复完成且代码执行结束，数据与同步接口的响应相同
+    """
+    cached_response = await llm_response_cache.aget(cache_key) if cache_key else None
+    if cached_response is not None:
+        logger.info(f"命中AI回复缓存: {file_id}")
+        chunks = _replay_cached_response(cached_response)
+    else:
+        chunks = get_agent().astream(messages)
+    
+    ai_response = ""
+    python_code = ""
+    exec_task: Optional[asyncio.Task] = None
+    try:
+        async for chunk in chunks:
+            text = chunk.content
+            if not text:
+                continue
+            ai_response += text
+            yield "token", {"content": text}
+            
+            # 代码块的结束标记一到达就开始执行，无需等待回复全部生成
+            if exec_task is None and "`" in text:
+                python_code = extract_python_code(ai_response)
+                if python_code:
+                    exec_task = asyncio.create_task(execute_generated_code(
+                        file_id, file_path, python_code, use_session=session_message is not None
+                    ))
+                    yield "code", {"code": python_code}
+        
+        result = None
+        image_url = None
+        if exec_task is not None:
+            result, image_url = await exec_task
+        
+        if cache_key and cached_response is None and _should_cache_response(python_code, result, image_url):
+            await llm_response_cache.aput(cache_key, ai_response)
+        
+        if session_message is not None:
+            await append_session_turn(file_id, session_message, ai_response)
+        
+        yield "result", {
+            "response": ai_response,
+            "code": python_code if python_code else None,
+            "result": result,
+            "image_url": image_url
+        }
+    finally:
+        if exec_task is not None and not exec_task.done():
+            # 客户端断开时让执行在后台完成并丢弃结果，避免中途打断保存处理结果和步骤
+            _detached_tasks.add(exec_task)
+            exec_task.add_done_callback(_finish_detached_task)
+
+
+def format_sse_event(event: str, data: Dict[str, Any]) -> str:
+    """格式化为Server-Sent Events消息"""
+    return f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
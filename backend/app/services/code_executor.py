@@ -0,0 +1,321 @@
+import os
+import io
+import uuid
+import pickle
+import asyncio
+import logging
+import traceback
+import contextlib
+import multiprocessing
+from typing import Any, Dict, List, Optional, Set, Tuple
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，无法限制资源
+    resource = None
+
+from app.services.cpu_pool import run_cpu
+from app.services.dtype_service import apply_schema
+
+logger = logging.getLogger("code_executor")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+IMAGES_DIR = os.path.join(STATIC_DIR, "images")
+# 主进程与执行进程之间交换Arrow文件的目录
+EXCHANGE_DIR = os.getenv("CODE_EXEC_EXCHANGE_DIR", os.path.join(BASE_DIR, "uploads", "exec"))
+
+# 执行进程数量
+CODE_EXEC_WORKERS = int(os.getenv("CODE_EXEC_WORKERS", 2))
+# 单次执行的最长墙钟时间（秒），超时后强制结束执行进程
+CODE_EXEC_TIMEOUT = float(os.getenv("CODE_EXEC_TIMEOUT", 60))
+# 单次执行可使用的CPU时间（秒）
+CODE_EXEC_CPU_SECONDS = int(os.getenv("CODE_EXEC_CPU_SECONDS", 30))
+# 每个执行进程的内存上限（MB）
+CODE_EXEC_MEMORY_MB = int(os.getenv("CODE_EXEC_MEMORY_MB", 2048))
+# 进程启动方式，spawn 可避免在多线程的服务进程中 fork
+CODE_EXEC_START_METHOD = os.getenv("CODE_EXEC_START_METHOD", "spawn")
+
+# 确保目录存在
+os.makedirs(IMAGES_DIR, exist_ok=True)
+os.makedirs(EXCHANGE_DIR, exist_ok=True)
+
+
+def _write_arrow(df: pd.DataFrame, path: str) -> bool:
+    """将DataFrame写入Arrow IPC文件，无法转换时返回False"""
+    if not all(isinstance(col, str) for col in df.columns):
+        return False
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return True
+    except Exception:
+        # 混合类型的列等情况无法转换为Arrow
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+
+def _read_arrow(path: str, memory_map: bool = True) -> pd.DataFrame:
+    """读取Arrow IPC文件，默认以内存映射方式读取避免额外拷贝"""
+    source = pa.memory_map(path, "r") if memory_map else pa.OSFile(path, "rb")
+    with source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+# ---------------------------------------------------------------------------
+# 以下函数运行在执行进程中
+# ---------------------------------------------------------------------------
+
+def _worker_init(memory_mb: int) -> None:
+    """执行进程初始化：预先导入pandas/matplotlib并设置内存上限"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+
+    if resource is not None and memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+        except (ValueError, OSError) as e:
+            logger.warning(f"设置执行进程内存上限失败: {str(e)}")
+
+
+def _set_cpu_limit(cpu_seconds: int) -> None:
+    """在已用CPU时间的基础上为本次执行设置CPU时间上限，超出后进程被系统结束"""
+    if resource is None or cpu_seconds <= 0:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _coerce_for_arrow(df: pd.DataFrame) -> pd.DataFrame:
+    """将列名和混合类型的对象列转换为字符串，使结果表可以写入Arrow文件"""
+    converted = df.copy()
+    converted.columns = [str(col) for col in converted.columns]
+    for i in range(converted.shape[1]):
+        if converted.iloc[:, i].dtype == object:
+            converted.iloc[:, i] = converted.iloc[:, i].map(lambda value: None if pd.isna(value) else str(value))
+    return converted
+
+
+def _execute_code(job: Dict[str, Any]) -> Dict[str, Any]:
+    """在执行进程中运行生成的代码"""
+    import matplotlib.pyplot as plt
+
+    response: Dict[str, Any] = {"result_path": None, "image_path": None, "error": None, "stdout": ""}
+    stdout_capture = io.StringIO()
+    try:
+        _set_cpu_limit(job["cpu_seconds"])
+        if job.get("input_path"):
+            df = _read_arrow(job["input_path"])
+        else:
+            df = pickle.loads(job["input_frame"])
+        if job.get("schema"):
+            # Arrow字符串等类型在交换文件中无法完整保留，按文件的类型方案还原
+            df = apply_schema(df, job["schema"])
+
+        plt.close('all')
+        # 执行进程独占，可以安全地重定向标准输出和标准错误
+        with contextlib.redirect_stdout(stdout_capture), contextlib.redirect_stderr(stdout_capture):
+            local_env = {"df": df, "pd": pd, "plt": plt}
+            exec(job["code"], local_env)
+
+        # 检查本地环境中是否有处理后的DataFrame
+        result_df = local_env.get("result")
+        if isinstance(result_df, pd.DataFrame):
+            # 结果只通过Arrow文件返回，服务进程不反序列化生成代码产生的pickle数据
+            if _write_arrow(result_df, job["output_path"]) or \
+                    _write_arrow(_coerce_for_arrow(result_df), job["output_path"]):
+                response["result_path"] = job["output_path"]
+            else:
+                response["error"] = "代码执行错误: 结果表无法转换为Arrow格式，请确保列名为字符串且每列的数据类型一致"
+
+        # 检查是否有图表生成
+        if plt.get_fignums():
+            image_path = os.path.join(job["images_dir"], f"plot_{uuid.uuid4()}.png")
+            plt.savefig(image_path)
+            response["image_path"] = image_path
+    except Exception as e:
+        response["error"] = f"代码执行错误: {str(e)}\n{traceback.format_exc()}"
+    finally:
+        plt.close('all')
+        response["stdout"] = stdout_capture.getvalue()
+    return response
+
+
+def _worker_main(conn, memory_mb: int) -> None:
+    """执行进程主循环：逐个接收任务并返回结果"""
+    _worker_init(memory_mb)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        conn.send(_execute_code(job))
+
+
+# ---------------------------------------------------------------------------
+# 以下代码运行在服务进程中
+# ---------------------------------------------------------------------------
+
+class _Worker:
+    """一个预热好的执行进程及其通信管道"""
+
+    def __init__(self, ctx, memory_mb: int):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, memory_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class CodeExecutorPool:
+    """预热的执行进程池，每个进程同一时间只运行一个任务
+
+    DataFrame通过Arrow IPC文件传递给执行进程（内存映射读取），无法转换为Arrow时才退回为pickle；
+    结果表只能通过Arrow文件返回。
+    超过墙钟时间、异常退出或等待结果时被取消的任务会连同其进程一起被结束，并补充一个新的进程。
+    """
+
+    def __init__(self, size: int, timeout: float, cpu_seconds: int, memory_mb: int, start_method: str):
+        self.size = size
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self._ctx = multiprocessing.get_context(start_method)
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers: List[_Worker] = []
+        # 正在替换执行进程的任务，保留引用避免被回收
+        self._respawning: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        """启动执行进程"""
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        for _ in range(self.size):
+            worker = await loop.run_in_executor(None, _Worker, self._ctx, self.memory_mb)
+            self._workers.append(worker)
+            self._idle.put_nowait(worker)
+        logger.info(f"代码执行进程池已启动，进程数: {self.size}")
+
+    async def shutdown(self) -> None:
+        """停止所有执行进程"""
+        loop = asyncio.get_running_loop()
+        for worker in self._workers:
+            await loop.run_in_executor(None, worker.stop)
+        self._workers.clear()
+        self._idle = None
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        """结束异常的执行进程并启动新的进程"""
+        worker.kill()
+        new_worker = _Worker(self._ctx, self.memory_mb)
+        self._workers = [w for w in self._workers if w is not worker] + [new_worker]
+        return new_worker
+
+    async def _respawn(self, worker: _Worker) -> None:
+        loop = asyncio.get_running_loop()
+        new_worker = await loop.run_in_executor(None, self._replace, worker)
+        if self._idle is not None:
+            self._idle.put_nowait(new_worker)
+
+    def _discard(self, worker: _Worker) -> None:
+        """在独立的任务中替换执行进程，请求被取消时替换也会完成"""
+        task = asyncio.get_running_loop().create_task(self._respawn(worker))
+        self._respawning.add(task)
+        task.add_done_callback(self._respawning.discard)
+
+    async def run(self, df: pd.DataFrame, code: str,
+                  schema: Optional[Dict[str, str]] = None) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
+        """在执行进程中运行代码，返回 (结果DataFrame, 图像路径, 错误信息)
+
+        提供schema（列名 -> 类型名称）时，执行进程读取数据后按它转换列类型。
+        """
+        await self.start()
+        loop = asyncio.get_running_loop()
+        worker = await self._idle.get()
+        # 执行进程处于空闲状态（没有未读取的结果）时才能交给下一个任务
+        idle = True
+
+        job_id = uuid.uuid4().hex
+        input_path = os.path.join(EXCHANGE_DIR, f"{job_id}.in.arrow")
+        output_path = os.path.join(EXCHANGE_DIR, f"{job_id}.out.arrow")
+        job = {"code": code, "output_path": output_path, "images_dir": IMAGES_DIR,
+               "cpu_seconds": self.cpu_seconds, "input_path": None, "input_frame": None, "schema": schema}
+        try:
+            if await run_cpu("exec_input", _write_arrow, df, input_path):
+                job["input_path"] = input_path
+            else:
+                job["input_frame"] = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+            idle = False
+            try:
+                await loop.run_in_executor(None, worker.conn.send, job)
+                ready = await loop.run_in_executor(None, worker.conn.poll, self.timeout)
+                if not ready:
+                    logger.error(f"代码执行超过 {self.timeout} 秒，已结束执行进程")
+                    return None, None, f"代码执行超时（超过{self.timeout:g}秒）"
+                response = worker.conn.recv()
+            except (EOFError, OSError):
+                logger.error("执行进程意外退出，可能超出了CPU时间或内存限制")
+                return None, None, "代码执行超出资源限制，执行已被终止"
+            idle = True
+
+            if response["stdout"]:
+                logger.debug(f"代码输出: {response['stdout']}")
+            if response["error"]:
+                return None, response["image_path"], response["error"]
+
+            result_df = None
+            if response["result_path"]:
+                result_df = await run_cpu("exec_output", _read_arrow, response["result_path"], False)
+            return result_df, response["image_path"], None
+        finally:
+            if not idle:
+                # 超时、进程退出或请求被取消：进程可能仍在运行，之后发回的结果会被下一个任务读到，因此替换它
+                self._discard(worker)
+            elif self._idle is not None:
+                self._idle.put_nowait(worker)
+            for path in (input_path, output_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# 进程内共享的代码执行进程池
+code_executor = CodeExecutorPool(
+    CODE_EXEC_WORKERS,
+    CODE_EXEC_TIMEOUT,
+    CODE_EXEC_CPU_SECONDS,
+    CODE_EXEC_MEMORY_MB,
+    CODE_EXEC_START_METHOD,
+)
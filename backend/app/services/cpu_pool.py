@@ -0,0 +1,136 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger("cpu_pool")
+
+T = TypeVar("T")
+
+# 执行表格解析、清洗和序列化等CPU密集操作的线程数，默认不超过CPU核数
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", min(4, os.cpu_count() or 1)))
+# 单个阶段耗时超过该值（秒）时记录日志
+CPU_STAGE_SLOW_SECONDS = float(os.getenv("CPU_STAGE_SLOW_SECONDS", 1.0))
+# 事件循环延迟的检测间隔（秒）
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+# 事件循环被阻塞超过该时间（秒）时发出警告
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", 0.2))
+
+
+class CPUPool:
+    """在专用线程池中执行pandas等CPU密集操作，并按阶段统计排队和执行耗时
+
+    与默认线程池分开，文件读写和进程通信等阻塞等待不会占用这里的线程。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        # 阶段名 -> 调用次数、排队和执行的总耗时及最长耗时
+        self._stages: Dict[str, Dict[str, float]] = {}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # 首次使用时才创建线程，gunicorn的工作进程在fork之后各自创建
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cpu-pool")
+        return self._executor
+
+    def _record(self, stage: str, wait_seconds: float, run_seconds: float) -> None:
+        with self._lock:
+            stats = self._stages.setdefault(stage, {
+                "count": 0, "wait_seconds": 0.0, "run_seconds": 0.0, "max_run_seconds": 0.0,
+            })
+            stats["count"] += 1
+            stats["wait_seconds"] += wait_seconds
+            stats["run_seconds"] += run_seconds
+            stats["max_run_seconds"] = max(stats["max_run_seconds"], run_seconds)
+        if run_seconds > CPU_STAGE_SLOW_SECONDS:
+            logger.info(f"阶段 {stage} 耗时 {run_seconds:.2f} 秒，排队 {wait_seconds:.2f} 秒")
+
+    async def run(self, stage: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """在线程池中执行func并返回结果，stage为统计使用的阶段名"""
+        submitted = time.perf_counter()
+        timing: Dict[str, float] = {}
+
+        def call() -> T:
+            timing["started"] = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing["finished"] = time.perf_counter()
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), call)
+        finally:
+            if "finished" in timing:
+                self._record(stage, timing["started"] - submitted, timing["finished"] - timing["started"])
+
+    def shutdown(self) -> None:
+        """等待正在执行的任务完成后关闭线程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        """返回线程池大小和各阶段的耗时统计"""
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": int(stats["count"]),
+                    "avg_wait_ms": round(stats["wait_seconds"] / stats["count"] * 1000, 2),
+                    "avg_run_ms": round(stats["run_seconds"] / stats["count"] * 1000, 2),
+                    "max_run_ms": round(stats["max_run_seconds"] * 1000, 2),
+                }
+                for stage, stats in self._stages.items()
+            }
+        return {"workers": self.max_workers, "stages": stages}
+
+
+class LoopLagMonitor:
+    """定期检查事件循环的调度延迟，循环被阻塞超过阈值时记录警告"""
+
+    def __init__(self, interval: float, warn_seconds: float):
+        self.interval = interval
+        self.warn_seconds = warn_seconds
+        self.samples = 0
+        self.warnings = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+
+    async def run(self) -> None:
+        """持续检测直到任务被取消"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.samples += 1
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            if lag > self.warn_seconds:
+                self.warnings += 1
+                logger.warning(f"事件循环被阻塞 {lag:.3f} 秒，超过阈值 {self.warn_seconds:g} 秒")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回事件循环延迟统计"""
+        return {
+            "samples": self.samples,
+            "warnings": self.warnings,
+            "warn_ms": round(self.warn_seconds * 1000, 2),
+            "last_lag_ms": round(self.last_lag_seconds * 1000, 2),
+            "max_lag_ms": round(self.max_lag_seconds * 1000, 2),
+        }
+
+
+# 进程内共享的CPU线程池和事件循环延迟监控
+cpu_pool = CPUPool(CPU_POOL_WORKERS)
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARN_SECONDS)
+
+
+async def run_cpu(stage: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """在CPU线程池中执行func，见CPUPool.run"""
+    return await cpu_pool.run(stage, func, *args, **kwargs)
@@ -0,0 +1,85 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+import pandas as pd
+
+logger = logging.getLogger("dataframe_cache")
+
+# 缓存的内存预算（字节），默认512MB
+DATAFRAME_CACHE_MAX_BYTES = int(os.getenv("DATAFRAME_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+class DataFrameCache:
+    """按 file_id + 文件修改时间缓存已解析的DataFrame，超出内存预算时按LRU淘汰"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> (mtime, DataFrame, 占用字节数)
+        self._entries: "OrderedDict[str, Tuple[float, pd.DataFrame, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, mtime: float) -> Optional[pd.DataFrame]:
+        """获取缓存的DataFrame，文件修改时间不一致时视为未命中"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != mtime:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, mtime: float, df: pd.DataFrame) -> None:
+        """放入缓存，超出预算时淘汰最久未使用的条目"""
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            logger.info(f"DataFrame {key} 占用 {size} 字节，超过缓存预算，不进行缓存")
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (mtime, df, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                evicted_key = next(iter(self._entries))
+                self._remove(evicted_key)
+                self.evictions += 1
+                logger.info(f"已从缓存中淘汰 {evicted_key}")
+
+    def invalidate(self, file_id: str) -> None:
+        """移除与file_id相关的所有缓存条目（包括处理结果等派生表）"""
+        with self._lock:
+            for key in [k for k in self._entries if k == file_id or k.startswith(f"{file_id}_")]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+
+# 进程内共享的DataFrame缓存
+dataframe_cache = DataFrameCache(DATAFRAME_CACHE_MAX_BYTES)
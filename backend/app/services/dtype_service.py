@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from app.services.blob_store import read_ref, BLOB_DIR
+
+logger = logging.getLogger("dtype_service")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+
+# 是否将可无损表示的浮点列压缩为float32；float32参与运算时精度降低，默认关闭
+DTYPE_DOWNCAST_FLOATS = os.getenv("DTYPE_DOWNCAST_FLOATS", "false").lower() == "true"
+# 不同取值个数占非空值个数的比例不超过该值的字符串列在服务进程中转换为category，0表示不转换
+# 生成的代码中category列无法写入新的取值，执行进程中这些列使用Arrow字符串
+DTYPE_CATEGORY_MAX_RATIO = float(os.getenv("DTYPE_CATEGORY_MAX_RATIO", 0.5))
+# 是否将ISO格式(如2024-01-31)的日期字符串列解析为日期
+DTYPE_PARSE_DATES = os.getenv("DTYPE_PARSE_DATES", "true").lower() == "true"
+
+# 类型方案的版本，旧版本（会压缩整数列）的方案在读取时重新推断
+SCHEMA_VERSION = 2
+
+ARROW_STRING = "string[pyarrow]"
+CATEGORY = "category"
+DATETIME = "datetime64[ns]"
+# 判断是否为日期列时检查的样本个数
+_DATE_SAMPLE_SIZE = 100
+_ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{1,2}-\d{1,2}([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?$")
+
+
+def get_schema_path(file_id: str) -> str:
+    """获取列类型方案的保存路径，内容相同的文件共享同一份方案"""
+    content_hash = read_ref(file_id)
+    if content_hash:
+        return os.path.join(BLOB_DIR, f"{content_hash}.schema.json")
+    return os.path.join(UPLOAD_DIR, f"{file_id}.schema.json")
+
+
+def dtype_name(dtype: Any) -> str:
+    """返回列类型的名称，Arrow字符串与普通字符串类型区分开"""
+    if isinstance(dtype, pd.StringDtype) and dtype.storage == "pyarrow":
+        return ARROW_STRING
+    return str(dtype)
+
+
+def _is_float32_exact(series: pd.Series) -> bool:
+    """浮点列的所有取值能否用float32精确表示"""
+    values = series.to_numpy()
+    return bool(np.array_equal(values.astype(np.float32).astype(values.dtype), values, equal_nan=True))
+
+
+def _is_iso_date_column(values: pd.Series) -> bool:
+    """非空取值是否都是可以解析的ISO格式日期字符串"""
+    sample = values.iloc[:_DATE_SAMPLE_SIZE]
+    if not all(_ISO_DATE_PATTERN.match(value) for value in sample):
+        return False
+    try:
+        pd.to_datetime(values, format="ISO8601")
+    except (ValueError, TypeError, OverflowError):
+        return False
+    return True
+
+
+def _infer_column_dtype(series: pd.Series) -> Optional[str]:
+    """为一列选择更紧凑的类型，无需转换时返回None
+
+    整数列保持int64：生成的代码对较窄的整数做运算时会静默溢出。
+    """
+    dtype = series.dtype
+    if not isinstance(dtype, np.dtype):
+        return None
+    if dtype.kind == "i":
+        # 旧版本生成的列式副本中可能保存了较窄的整数列
+        return "int64" if dtype.itemsize < 8 else None
+    if dtype.kind == "f":
+        if DTYPE_DOWNCAST_FLOATS and dtype.itemsize > 4 and _is_float32_exact(series):
+            return "float32"
+        return None
+    if dtype.kind != "O":
+        return None
+
+    values = series.dropna()
+    if values.empty or not all(isinstance(value, str) for value in values):
+        # 混合类型的列保持原样
+        return None
+    if DTYPE_PARSE_DATES and _is_iso_date_column(values):
+        return DATETIME
+    if values.nunique() <= DTYPE_CATEGORY_MAX_RATIO * len(values):
+        return CATEGORY
+    return ARROW_STRING
+
+
+def infer_schema(df: pd.DataFrame) -> Dict[str, str]:
+    """推断每列应使用的类型，返回 列名 -> 类型名称"""
+    schema = {}
+    if not df.columns.is_unique:
+        # 列名重复时无法按列名转换
+        return schema
+    for col in df.columns:
+        if not isinstance(col, str):
+            continue
+        target = _infer_column_dtype(df[col])
+        schema[col] = target or dtype_name(df[col].dtype)
+    return schema
+
+
+def _convert(series: pd.Series, target: str) -> pd.Series:
+    if target == DATETIME and series.dtype == object:
+        return pd.to_datetime(series, format="ISO8601")
+    return series.astype(target)
+
+
+def apply_schema(df: pd.DataFrame, schema: Dict[str, str]) -> pd.DataFrame:
+    """按类型方案转换列，类型已一致的列不做处理，无法转换的列保持原样"""
+    converted = {}
+    for col, target in schema.items():
+        if col not in df.columns or dtype_name(df[col].dtype) == target:
+            continue
+        try:
+            converted[col] = _convert(df[col], target)
+        except (ValueError, TypeError, OverflowError) as e:
+            logger.warning(f"列 {col} 无法转换为 {target}，保持原类型: {str(e)}")
+    if not converted:
+        return df
+    return df.assign(**converted)
+
+
+def build_schema(df: pd.DataFrame) -> Tuple[Dict[str, Any], pd.DataFrame]:
+    """推断类型方案并转换DataFrame，返回方案（含节省内存的统计）和转换后的DataFrame"""
+    columns = infer_schema(df)
+    optimized = apply_schema(df, columns)
+    memory_before = int(df.memory_usage(deep=True).sum())
+    memory_after = int(optimized.memory_usage(deep=True).sum())
+    changes = {
+        col: [dtype_name(df[col].dtype), dtype_name(optimized[col].dtype)]
+        for col in columns
+        if dtype_name(df[col].dtype) != dtype_name(optimized[col].dtype)
+    }
+    schema = {
+        "version": SCHEMA_VERSION,
+        "columns": {col: dtype_name(optimized[col].dtype) for col in columns},
+        "changes": changes,
+        "memory_before": memory_before,
+        "memory_after": memory_after,
+        "saved_bytes": memory_before - memory_after,
+    }
+    return schema, optimized
+
+
+def get_executor_dtype(target: str) -> str:
+    """列在执行进程中的类型名称：category列改为Arrow字符串"""
+    return ARROW_STRING if target == CATEGORY else target
+
+
+def get_executor_schema(columns: Dict[str, str]) -> Dict[str, str]:
+    """执行进程使用的类型方案：category列改为Arrow字符串"""
+    return {col: get_executor_dtype(target) for col, target in columns.items()}
+
+
+def load_schema(file_id: str) -> Optional[Dict[str, Any]]:
+    """读取已保存的类型方案，不存在、无法读取或版本过旧时返回None"""
+    schema_path = get_schema_path(file_id)
+    if not os.path.exists(schema_path):
+        return None
+    try:
+        with open(schema_path, "r", encoding="utf-8") as f:
+            schema = json.load(f)
+    except Exception as e:
+        logger.warning(f"读取类型方案失败 {schema_path}: {str(e)}")
+        return None
+    return schema if schema.get("version") == SCHEMA_VERSION else None
+
+
+def get_schema_columns(file_id: str) -> Optional[Dict[str, str]]:
+    """返回已保存的 列名 -> 类型名称"""
+    schema = load_schema(file_id)
+    return schema["columns"] if schema else None
+
+
+def save_schema(file_id: str, schema: Dict[str, Any]) -> None:
+    """保存类型方案，先写入临时文件再重命名"""
+    schema_path = get_schema_path(file_id)
+    tmp_path = f"{schema_path}.{file_id}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(schema, f, ensure_ascii=False)
+        os.replace(tmp_path, schema_path)
+    except Exception as e:
+        logger.error(f"保存类型方案失败 {schema_path}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def apply_file_schema(file_id: str, df: pd.DataFrame) -> pd.DataFrame:
+    """按文件已保存的类型方案转换DataFrame，还没有方案时原样返回"""
+    columns = get_schema_columns(file_id)
+    return apply_schema(df, columns) if columns else df
+
+
+def optimize_dataframe(file_id: str, df: pd.DataFrame) -> pd.DataFrame:
+    """按文件的类型方案转换DataFrame，还没有方案时根据完整数据推断并保存"""
+    columns = get_schema_columns(file_id)
+    if columns is not None:
+        return apply_schema(df, columns)
+
+    schema, optimized = build_schema(df)
+    save_schema(file_id, schema)
+    logger.info(f"文件 {file_id} 的列类型已优化: {schema['changes']}，"
+                f"内存占用 {schema['memory_before']} -> {schema['memory_after']} 字节")
+    return optimized
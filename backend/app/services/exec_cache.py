@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import pandas as pd
+
+logger = logging.getLogger("exec_cache")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+IMAGES_DIR = os.path.join(STATIC_DIR, "images")
+# 执行结果缓存目录：{key}.json 为条目记录，{key}.parquet 为结果表
+EXEC_CACHE_DIR = os.getenv("EXEC_CACHE_DIR", os.path.join(BASE_DIR, "uploads", "exec_cache"))
+# 缓存的图表文件名前缀，图表放在静态目录中以便直接返回URL
+CACHED_IMAGE_PREFIX = "plot_cache_"
+
+# 执行结果缓存占用的磁盘预算（字节），默认256MB
+EXEC_CACHE_MAX_BYTES = int(os.getenv("EXEC_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# 确保目录存在
+os.makedirs(EXEC_CACHE_DIR, exist_ok=True)
+os.makedirs(IMAGES_DIR, exist_ok=True)
+
+
+def build_exec_cache_key(content_key: str, code: str) -> str:
+    """根据文件内容和代码计算缓存键"""
+    code_hash = hashlib.sha256(code.strip().encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{content_key}:{code_hash}".encode("utf-8")).hexdigest()
+
+
+class ExecutionResultCache:
+    """以 (文件内容, 代码) 为键在磁盘上缓存代码执行结果和图表，超出预算时按LRU淘汰
+
+    条目保存在共享目录中，所有工作进程都能命中；条目记录最后写入，作为条目完整的标志。
+    """
+
+    def __init__(self, cache_dir: str, images_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.images_dir = images_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _result_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _image_path(self, key: str) -> str:
+        return os.path.join(self.images_dir, f"{CACHED_IMAGE_PREFIX}{key}.png")
+
+    def get(self, key: str) -> Optional[Tuple[Optional[pd.DataFrame], Optional[str]]]:
+        """返回缓存的 (结果DataFrame, 图像路径)，未命中时返回None"""
+        if self.max_bytes <= 0:
+            return None
+        meta_path = self._meta_path(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            result_df = pd.read_parquet(self._result_path(key)) if meta["result"] else None
+            image_path = self._image_path(key) if meta["image"] else None
+            if image_path and not os.path.exists(image_path):
+                raise FileNotFoundError(image_path)
+            # 更新修改时间作为最近使用时间
+            os.utime(meta_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"读取执行结果缓存失败 {key}: {str(e)}")
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result_df, image_path
+
+    def put(self, key: str, result_df: Optional[pd.DataFrame], image_path: Optional[str]) -> None:
+        """保存执行结果，结果表无法保存为Parquet时不缓存"""
+        if self.max_bytes <= 0 or (result_df is None and image_path is None):
+            return
+        meta = {"result": result_df is not None, "image": image_path is not None, "created_at": time.time()}
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if result_df is not None:
+                result_path = self._result_path(key)
+                result_df.to_parquet(result_path + tmp_suffix, index=False)
+                os.replace(result_path + tmp_suffix, result_path)
+            if image_path is not None:
+                cached_image_path = self._image_path(key)
+                try:
+                    os.link(image_path, cached_image_path + tmp_suffix)
+                except OSError:
+                    shutil.copyfile(image_path, cached_image_path + tmp_suffix)
+                os.replace(cached_image_path + tmp_suffix, cached_image_path)
+            meta_path = self._meta_path(key)
+            with open(meta_path + tmp_suffix, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + tmp_suffix, meta_path)
+        except Exception as e:
+            # 混合类型的列等情况无法保存为Parquet
+            logger.info(f"执行结果无法缓存 {key}: {str(e)}")
+            for path in (self._result_path(key), self._image_path(key)):
+                if os.path.exists(path + tmp_suffix):
+                    os.remove(path + tmp_suffix)
+            return
+        self.enforce_budget()
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        """列出所有条目的 (最近使用时间, 键, 占用字节数)"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            key = entry.name[:-len(".json")]
+            try:
+                last_used = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            size = 0
+            for path in (entry.path, self._result_path(key), self._image_path(key)):
+                try:
+                    size += os.path.getsize(path)
+                except OSError:
+                    pass
+            entries.append((last_used, key, size))
+        return entries
+
+    def enforce_budget(self) -> int:
+        """淘汰最久未使用的条目直到不超过磁盘预算，返回释放的字节数"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, _, size in entries)
+            reclaimed = 0
+            for _, key, size in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+                reclaimed += size
+                self.evictions += 1
+            if reclaimed:
+                logger.info(f"执行结果缓存已淘汰旧条目，释放 {reclaimed} 字节")
+            return reclaimed
+
+    def _remove(self, key: str) -> None:
+        # 先删除条目记录，其他进程不会再读取到不完整的条目
+        for path in (self._meta_path(key), self._result_path(key), self._image_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, _, size in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# 进程内共享的执行结果缓存
+exec_cache = ExecutionResultCache(EXEC_CACHE_DIR, IMAGES_DIR, EXEC_CACHE_MAX_BYTES)
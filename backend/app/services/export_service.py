@@ -0,0 +1,342 @@
+import os
+import re
+import zlib
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import quote
+import aiofiles
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse, FileResponse as FastAPIFileResponse
+
+from app.services.file_service import (
+    get_file_path_by_id, get_processed_file_path, get_sidecar_path, get_export_render_path,
+    load_dataframe, load_processed_dataframe, UPLOAD_CHUNK_SIZE
+)
+from app.services.json_serializer import dumps, frame_to_records
+from app.services.arrow_service import to_arrow_table, ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE
+from app.services.cpu_pool import run_cpu
+
+logger = logging.getLogger("export_service")
+
+# 导出时每次转换的行数，转换好的部分立即发送给客户端
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 50000))
+# gzip压缩级别
+EXPORT_GZIP_LEVEL = 6
+
+# 导出格式 -> (扩展名, 媒体类型)
+EXPORT_FORMATS: Dict[str, Tuple[str, str]] = {
+    "csv": (".csv", "text/csv"),
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "parquet": (".parquet", PARQUET_MEDIA_TYPE),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+    "arrow": (".arrow", ARROW_STREAM_MEDIA_TYPE),
+}
+# 压缩方式 -> (扩展名, 媒体类型)
+EXPORT_COMPRESSIONS: Dict[str, Tuple[str, str]] = {
+    "gzip": (".gz", "application/gzip"),
+    "zstd": (".zst", "application/zstd"),
+}
+# 这些格式本身已经压缩或无法按块输出，不再额外压缩
+_UNCOMPRESSIBLE_FORMATS = ("xlsx", "parquet")
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _content_disposition(filename: str) -> str:
+    """生成下载文件名的响应头，非ASCII文件名按RFC 5987编码"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _build_filename(filename: Optional[str], default_stem: str, suffix: str) -> str:
+    """确定下载文件名：使用客户端指定的名称，扩展名与导出格式保持一致"""
+    name = os.path.basename((filename or "").strip().replace("\\", "/"))
+    stem = name or default_stem
+    known_extensions = {ext for ext, _ in EXPORT_FORMATS.values()} | {".xls", ".gz", ".zst"}
+    # 去掉客户端文件名中已有的表格或压缩扩展名，如 报告.csv.gz
+    while os.path.splitext(stem)[1].lower() in known_extensions and os.path.splitext(stem)[0]:
+        stem = os.path.splitext(stem)[0]
+    return f"{stem}{suffix}"
+
+
+def _compute_etag(source_path: str, variant: str) -> str:
+    """由数据源文件的版本和导出方式计算ETag，数据或格式变化时ETag随之变化"""
+    stat = os.stat(source_path)
+    token = f"{os.path.basename(source_path)}:{stat.st_mtime_ns}:{stat.st_size}:{variant}"
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+
+def _render_csv(df: pd.DataFrame) -> Iterator[bytes]:
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(index=False, header=start == 0).encode("utf-8")
+
+
+def _render_jsonl(df: pd.DataFrame) -> Iterator[bytes]:
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        records = frame_to_records(df.iloc[start:start + EXPORT_CHUNK_ROWS])
+        yield b"".join(dumps(record) + b"\n" for record in records)
+
+
+class _ChunkSink:
+    """收集Arrow/Parquet写入器输出的字节，每写完一块取出发送"""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data: Any) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _render_arrow_batches(table: pa.Table, fmt: str) -> Iterator[bytes]:
+    """将Arrow表按块写为Arrow IPC流或Parquet（每块一个行组）"""
+    sink = _ChunkSink()
+    stream = pa.PythonFile(sink, mode="w")
+    if fmt == "arrow":
+        writer = pa.ipc.new_stream(stream, table.schema)
+    else:
+        writer = pq.ParquetWriter(stream, table.schema)
+    for start in range(0, table.num_rows, EXPORT_CHUNK_ROWS):
+        writer.write_table(table.slice(start, EXPORT_CHUNK_ROWS))
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
+
+
+def _render_xlsx(df: pd.DataFrame, path: str) -> None:
+    """Excel文件需要完整写入后才能打包，直接写入目标文件"""
+    tmp_path = f"{path}.{os.getpid()}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            df.to_excel(f, index=False, engine="openpyxl")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _compress(chunks: Iterable[bytes], compression: Optional[str]) -> Iterator[bytes]:
+    """逐块压缩，输出的gzip/zstd流可以直接解压"""
+    if compression is None:
+        yield from chunks
+    elif compression == "gzip":
+        # zlib生成的gzip头不含时间戳，相同数据每次压缩的结果相同，续传时内容一致
+        compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    else:
+        # 每块压缩为一个独立的zstd帧，多个帧连接起来仍是合法的zstd流
+        for chunk in chunks:
+            if chunk:
+                yield pa.compress(chunk, codec="zstd", asbytes=True)
+
+
+def _render_chunks(df_or_table: Any, fmt: str, compression: Optional[str]) -> Iterator[bytes]:
+    if fmt == "csv":
+        chunks = _render_csv(df_or_table)
+    elif fmt == "jsonl":
+        chunks = _render_jsonl(df_or_table)
+    else:
+        chunks = _render_arrow_batches(df_or_table, fmt)
+    return _compress(chunks, compression)
+
+
+def _tee_to_file(chunks: Iterable[bytes], path: str) -> Iterator[bytes]:
+    """发送的同时写入渲染文件，完整发送后保存，供续传和再次下载使用"""
+    tmp_path = f"{path}.{os.getpid()}.{id(chunks)}.part"
+    completed = False
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, path)
+        completed = True
+    finally:
+        # 客户端中途断开时丢弃不完整的文件
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_render(chunks: Iterable[bytes], path: str) -> None:
+    for _ in _tee_to_file(chunks, path):
+        pass
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """解析单个字节范围，不支持或无法满足时抛出ValueError，没有Range时返回None"""
+    if not header:
+        return None
+    match = _RANGE_PATTERN.match(header.strip())
+    if match is None:
+        # 多个范围等不支持的形式按完整文件返回
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+    if start > end or start >= size:
+        raise ValueError("无法满足的范围")
+    return start, end
+
+
+async def _iter_file_range(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _file_response(request: Request, path: str, etag: str, media_type: str, filename: str) -> Response:
+    """返回已存在的文件，支持Range续传"""
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": _content_disposition(filename),
+    }
+    size = os.path.getsize(path)
+    range_header = request.headers.get("range")
+    # If-Range与当前版本不一致时，客户端已有的部分已过期，返回完整文件
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != f'"{etag}"':
+        range_header = None
+    try:
+        byte_range = _parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return FastAPIFileResponse(path, media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_iter_file_range(path, start, end), status_code=206,
+                             media_type=media_type, headers=headers)
+
+
+async def export_response(request: Request, file_id: str, fmt: Optional[str] = None,
+                          compression: Optional[str] = None, filename: Optional[str] = None) -> Response:
+    """导出处理结果（没有处理结果时导出原始表格），按需转换格式并逐块发送
+
+    - 未指定格式且无需转换时直接发送已保存的文件
+    - 其他情况按块渲染并以流式响应发送，同时保存渲染结果，续传和再次下载时直接使用
+    - 支持ETag/If-None-Match和单个范围的Range请求
+    """
+    original_file_path = await get_file_path_by_id(file_id)
+    if not original_file_path:
+        raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+    processed_path = await get_processed_file_path(file_id)
+    original_ext = Path(original_file_path).suffix.lower()
+    # 默认导出与原始文件相同的格式，.xls的处理结果导出为.xlsx
+    if fmt is None and (processed_path or compression):
+        fmt = "csv" if original_ext == ".csv" else "xlsx"
+    if fmt is not None and fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+    if compression is not None:
+        if compression not in EXPORT_COMPRESSIONS:
+            raise ValueError(f"不支持的压缩方式: {compression}")
+        if fmt in _UNCOMPRESSIBLE_FORMATS:
+            raise ValueError(f"{fmt} 格式不支持额外压缩")
+
+    default_stem = Path(processed_path or original_file_path).stem
+    sidecar_path = get_sidecar_path(file_id)
+    # 无需转换的情况：原始文件本身，或原始表格的列式副本
+    passthrough = None
+    if processed_path is None and compression is None:
+        if fmt is None:
+            passthrough = original_file_path
+        elif fmt == "parquet" and os.path.exists(sidecar_path):
+            passthrough = sidecar_path
+        elif fmt == original_ext[1:]:
+            passthrough = original_file_path
+
+    source_path = processed_path or (sidecar_path if os.path.exists(sidecar_path) else original_file_path)
+    if passthrough is not None:
+        source_path = passthrough
+        ext = Path(passthrough).suffix.lower()
+        media_type = EXPORT_FORMATS.get(ext[1:], ("", "application/octet-stream"))[1]
+        suffix = ext
+    else:
+        suffix, media_type = EXPORT_FORMATS[fmt]
+        if compression is not None:
+            suffix = f"{suffix}{EXPORT_COMPRESSIONS[compression][0]}"
+            media_type = EXPORT_COMPRESSIONS[compression][1]
+    etag = _compute_etag(source_path, f"{fmt}:{compression}:{passthrough is not None}")
+    download_name = _build_filename(filename, default_stem, suffix)
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+    if passthrough is not None:
+        return _file_response(request, passthrough, etag, media_type, download_name)
+
+    render_path = get_export_render_path(file_id, etag, suffix)
+    if os.path.exists(render_path):
+        return _file_response(request, render_path, etag, media_type, download_name)
+
+    # 读取要导出的数据，原始表格有列式副本时Arrow格式直接从副本读取
+    if fmt in ("arrow", "parquet"):
+        if processed_path is None and os.path.exists(sidecar_path):
+            data = await run_cpu("export", pq.read_table, sidecar_path)
+        else:
+            df = await (load_processed_dataframe(file_id) if processed_path else load_dataframe(file_id))
+            data = await run_cpu("export", to_arrow_table, df)
+    else:
+        data = await (load_processed_dataframe(file_id) if processed_path else load_dataframe(file_id))
+
+    if fmt == "xlsx":
+        await run_cpu("export", _render_xlsx, data, render_path)
+        return _file_response(request, render_path, etag, media_type, download_name)
+    chunks = _render_chunks(data, fmt, compression)
+    if request.headers.get("range"):
+        # 续传请求需要完整的内容才能定位，先渲染到文件
+        await run_cpu("export", _write_render, chunks, render_path)
+        return _file_response(request, render_path, etag, media_type, download_name)
+
+    logger.info(f"开始流式导出 {file_id}: 格式 {fmt}, 压缩 {compression}")
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": _content_disposition(download_name),
+    }
+    # 同步生成器由Starlette在线程池中逐块迭代，不阻塞事件循环
+    return StreamingResponse(_tee_to_file(chunks, render_path), media_type=media_type, headers=headers)
@@ -1,9 +1,23 @@
 import os
+import re
+import json
+import time
 import logging
 import asyncio
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Set, Dict
+from typing import Any, Dict, Iterable, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl 模块，无法选举，每个进程都执行清理
+    fcntl = None
+
+from app.services.file_service import remove_file_artifacts, is_valid_file_id, FILE_ID_REGEX
+from app.services.blob_store import BLOB_DIR, release_blob, read_ref, get_ref_path, get_referenced_hashes
+from app.services.exec_cache import exec_cache, EXEC_CACHE_DIR, CACHED_IMAGE_PREFIX
+from app.services.code_executor import EXCHANGE_DIR
+from app.services.access_store import access_store, ACCESS_DB_PATH, STATE_DIR
 
 logger = logging.getLogger("file_cleanup_service")
 
@@ -13,100 +27,300 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
 IMAGES_DIR = os.path.join(STATIC_DIR, "images")
 
-# 文件访问记录文件路径
-ACCESS_RECORD_FILE = os.path.join(BASE_DIR, "file_access_records.txt")
-
-# 文件访问记录：file_id -> 最后访问时间
-file_access_records: Dict[str, datetime] = {}
-
 # 会话超时时间（小时）
 SESSION_TIMEOUT_HOURS = 2
+# 清理间隔（秒）
+CLEANUP_INTERVAL_SECONDS = int(os.getenv("CLEANUP_INTERVAL_SECONDS", 3600))
+# 无主的临时文件、图表等超过该时间（小时）后删除
+CLEANUP_ORPHAN_MAX_AGE_HOURS = float(os.getenv("CLEANUP_ORPHAN_MAX_AGE_HOURS", 24))
+# 上传目录和图表目录的磁盘配额（字节），超出时按最后访问时间淘汰文件，0为不限制
+CLEANUP_DISK_QUOTA_BYTES = int(os.getenv("CLEANUP_DISK_QUOTA_BYTES", 10 * 1024 * 1024 * 1024))
 
-def load_access_records() -> None:
-    """从文件加载访问记录"""
-    if os.path.exists(ACCESS_RECORD_FILE):
-        try:
-            with open(ACCESS_RECORD_FILE, "r") as f:
-                for line in f:
-                    if line.strip():
-                        parts = line.strip().split(",")
-                        if len(parts) == 2:
-                            file_id, timestamp = parts
-                            try:
-                                file_access_records[file_id] = datetime.fromisoformat(timestamp)
-                            except ValueError:
-                                logger.error(f"无效的时间戳格式: {timestamp}")
-        except Exception as e:
-            logger.error(f"加载文件访问记录时出错: {str(e)}")
-            # 如果加载失败，确保记录字典是空的
-            file_access_records.clear()
-    logger.info(f"已加载 {len(file_access_records)} 条文件访问记录")
-
-def save_access_records() -> None:
-    """将访问记录保存到文件"""
+# 只有持有该锁的工作进程执行清理
+CLEANUP_LOCK_FILE = os.path.join(STATE_DIR, "cleanup.lock")
+# 最近一次清理的结果，所有工作进程都可以读取
+CLEANUP_REPORT_FILE = os.path.join(STATE_DIR, "cleanup_report.json")
+
+# 上传目录中属于某个file_id的文件名以UUID开头
+_FILE_ID_PATTERN = re.compile(rf"^({FILE_ID_REGEX})")
+_ORIGINAL_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+
+# 持有清理锁的文件句柄，进程退出时锁自动释放，由其他进程接替
+_leader_lock_file = None
+
+
+def update_file_access(file_id: str) -> None:
+    """更新文件的最后访问时间（合并后批量写入共享的访问记录）"""
+    access_store.touch(file_id)
+
+
+def record_file_artifact(file_id: str, path: str) -> None:
+    """记录file_id产生的派生文件（如图表），文件过期或删除时一并清理"""
     try:
-        with open(ACCESS_RECORD_FILE, "w") as f:
-            for file_id, timestamp in file_access_records.items():
-                f.write(f"{file_id},{timestamp.isoformat()}\n")
-        logger.info(f"已保存 {len(file_access_records)} 条文件访问记录")
+        access_store.add_artifact(file_id, path)
     except Exception as e:
-        logger.error(f"保存文件访问记录时出错: {str(e)}")
+        logger.error(f"记录派生文件失败 {path}: {str(e)}")
 
-def update_file_access(file_id: str) -> None:
-    """更新文件的最后访问时间"""
-    file_access_records[file_id] = datetime.now()
-    save_access_records()  # 保存到文件
 
-def is_file_expired(file_id: str) -> bool:
-    """检查文件是否已过期"""
-    if file_id not in file_access_records:
+def _acquire_leadership() -> bool:
+    """尝试成为执行清理的工作进程，已持有锁时直接返回True"""
+    global _leader_lock_file
+    if fcntl is None:
+        return True
+    if _leader_lock_file is not None:
         return True
-    
-    last_access = file_access_records[file_id]
-    return datetime.now() - last_access > timedelta(hours=SESSION_TIMEOUT_HOURS)
+    lock_file = open(CLEANUP_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _leader_lock_file = lock_file
+    logger.info(f"工作进程 {os.getpid()} 负责执行文件清理")
+    return True
+
+
+def _disk_usage(directories: Iterable[str]) -> int:
+    """统计目录占用的字节数，硬链接的文件只计算一次，不计算访问记录数据库"""
+    seen: Set = set()
+    total = 0
+    db_path = os.path.abspath(ACCESS_DB_PATH)
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.abspath(path).startswith(db_path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def _unlink(path: Path) -> None:
+    try:
+        path.unlink()
+        logger.info(f"已删除: {path}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"删除失败 {path}: {str(e)}")
+
+
+def purge_file(file_id: str) -> None:
+    """删除file_id的所有文件、派生文件和访问记录，file_id不是合法的文件ID时抛出ValueError"""
+    if not is_valid_file_id(file_id):
+        # 文件按file_id前缀匹配删除，不能接受任意字符串
+        raise ValueError(f"无效的文件ID: {file_id}")
+    # 删除上传目录中的原始文件和处理后的文件，无引用时释放共享内容
+    try:
+        remove_file_artifacts(file_id)
+    except Exception as e:
+        logger.error(f"删除文件失败 {file_id}: {str(e)}")
+
+    # 删除该文件生成的图表
+    for artifact_path in access_store.pop_artifacts(file_id):
+        _unlink(Path(artifact_path))
+    for image_path in Path(IMAGES_DIR).glob(f"plot_{file_id}*"):
+        _unlink(image_path)
+    access_store.forget(file_id)
+
+
+def _purge_and_measure(file_id: str) -> int:
+    """删除file_id的所有文件，返回实际释放的字节数
+
+    只统计删除前后不再有任何路径指向的文件，仍被其他file_id共享的blob不计入。
+    """
+    content_hash = read_ref(file_id)
+    candidates = list(Path(UPLOAD_DIR).glob(f"{file_id}*")) + list(Path(IMAGES_DIR).glob(f"plot_{file_id}*"))
+    candidates += [Path(path) for path in access_store.get_artifact_paths_for(file_id)]
+    if content_hash:
+        candidates += list(Path(BLOB_DIR).glob(f"{content_hash}*"))
+    inodes: Dict[Any, int] = {}
+    for path in candidates:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+    purge_file(file_id)
+
+    for path in candidates:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        inodes.pop((stat.st_dev, stat.st_ino), None)
+    return sum(inodes.values())
+
+
+def _is_old(path: Path, cutoff: float) -> bool:
+    try:
+        return path.stat().st_mtime < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def sweep_orphans(max_age_hours: float) -> int:
+    """删除没有归属或已遗留过久的文件，返回删除的文件数"""
+    cutoff = time.time() - max_age_hours * 3600
+    session_cutoff = time.time() - SESSION_TIMEOUT_HOURS * 3600
+    removed = 0
+
+    # 上传目录：原始文件已不存在的派生文件、没有访问记录的过期文件、中断留下的临时文件
+    tracked_ids = access_store.get_tracked_ids()
+    entries = [path for path in Path(UPLOAD_DIR).iterdir() if path.is_file()]
+    originals = {path.stem for path in entries if path.suffix.lower() in _ORIGINAL_EXTENSIONS}
+    untracked_ids: Set[str] = set()
+    for path in entries:
+        match = _FILE_ID_PATTERN.match(path.name)
+        if match is None:
+            continue
+        file_id = match.group(1)
+        if file_id in originals:
+            # 原始文件是blob的硬链接，修改时间来自最早上传的相同内容，按引用记录的时间判断
+            ref_path = Path(get_ref_path(file_id))
+            age_path = ref_path if ref_path.exists() else path
+            if file_id not in tracked_ids and _is_old(age_path, session_cutoff):
+                untracked_ids.add(file_id)
+            elif path.name.endswith((".tmp", ".part")) and _is_old(path, cutoff):
+                _unlink(path)
+                removed += 1
+        elif _is_old(path, cutoff):
+            _unlink(path)
+            removed += 1
+    for file_id in untracked_ids:
+        logger.info(f"文件没有访问记录且已超过会话时间，删除: {file_id}")
+        purge_file(file_id)
+        removed += 1
+
+    # 执行进程交换目录中因进程崩溃遗留的Arrow文件
+    for path in Path(EXCHANGE_DIR).glob("*.arrow"):
+        if _is_old(path, cutoff):
+            _unlink(path)
+            removed += 1
+
+    # 已没有任何引用的blob及其派生文件，引用以引用记录为准
+    referenced = get_referenced_hashes()
+    for path in Path(BLOB_DIR).iterdir():
+        if path.suffix.lower() in _ORIGINAL_EXTENSIONS and path.stem not in referenced and _is_old(path, cutoff):
+            if release_blob(path.stem):
+                removed += 1
+        elif path.name.endswith(".tmp") and _is_old(path, cutoff):
+            _unlink(path)
+            removed += 1
+
+    # 图表目录：没有记录归属的图表，以及条目已被淘汰的缓存图表
+    artifact_paths = access_store.get_artifact_paths()
+    for path in Path(IMAGES_DIR).glob("plot_*.png"):
+        if path.name.startswith(CACHED_IMAGE_PREFIX):
+            key = path.stem[len(CACHED_IMAGE_PREFIX):]
+            orphaned = not os.path.exists(os.path.join(EXEC_CACHE_DIR, f"{key}.json"))
+        else:
+            orphaned = str(path) not in artifact_paths
+        if orphaned and _is_old(path, cutoff):
+            _unlink(path)
+            removed += 1
+
+    return removed
+
+
+def enforce_disk_quota(quota_bytes: int) -> int:
+    """磁盘占用超出配额时按最后访问时间从早到晚删除文件，返回删除的文件数"""
+    if quota_bytes <= 0:
+        return 0
+    directories = (UPLOAD_DIR, IMAGES_DIR)
+    usage = _disk_usage(directories)
+    if usage <= quota_bytes:
+        return 0
+
+    logger.warning(f"磁盘占用 {usage} 字节超出配额 {quota_bytes} 字节，开始淘汰最久未访问的文件")
+    evicted = 0
+    for file_id in access_store.get_lru():
+        # 从占用中减去释放的字节数，无需每次重新遍历目录
+        usage -= _purge_and_measure(file_id)
+        evicted += 1
+        if usage <= quota_bytes:
+            break
+    return evicted
+
+
+def run_cleanup() -> Dict[str, Any]:
+    """执行一次完整的清理：过期文件、无主文件、执行结果缓存和磁盘配额，返回清理报告"""
+    started = time.time()
+    usage_before = _disk_usage((UPLOAD_DIR, IMAGES_DIR))
+    expired_files: Set[str] = set()
+    cutoff = (datetime.now() - timedelta(hours=SESSION_TIMEOUT_HOURS)).timestamp()
+
+    # 清理过期文件
+    for file_id in access_store.get_expired(cutoff):
+        # 删除访问记录前再次确认仍然过期，其他工作进程刚访问过的文件不会被清理
+        if not access_store.claim_expired(file_id, cutoff):
+            continue
+        expired_files.add(file_id)
+        purge_file(file_id)
+
+    orphans = sweep_orphans(CLEANUP_ORPHAN_MAX_AGE_HOURS)
+    # 执行结果缓存超出磁盘预算时淘汰最久未使用的条目
+    exec_cache.enforce_budget()
+    evicted = enforce_disk_quota(CLEANUP_DISK_QUOTA_BYTES)
+
+    usage_after = _disk_usage((UPLOAD_DIR, IMAGES_DIR))
+    report = {
+        "finished_at": datetime.now().isoformat(),
+        "duration_seconds": round(time.time() - started, 3),
+        "worker_pid": os.getpid(),
+        "expired_files": len(expired_files),
+        "orphans_removed": orphans,
+        "quota_evictions": evicted,
+        "reclaimed_bytes": max(usage_before - usage_after, 0),
+        "disk_usage_bytes": usage_after,
+        "disk_quota_bytes": CLEANUP_DISK_QUOTA_BYTES,
+    }
+    logger.info(f"清理完成: {report}")
+    return report
+
+
+def _save_report(report: Dict[str, Any]) -> None:
+    tmp_path = f"{CLEANUP_REPORT_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f)
+    os.replace(tmp_path, CLEANUP_REPORT_FILE)
+
+
+def get_cleanup_report() -> Optional[Dict[str, Any]]:
+    """读取最近一次清理的报告"""
+    try:
+        with open(CLEANUP_REPORT_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
 
 async def cleanup_expired_files() -> None:
-    """清理过期的文件和相关资源"""
+    """清理过期的文件和相关资源，清理过程需要遍历目录，在线程池中执行"""
     try:
-        expired_files: Set[str] = set()
-        
-        # 检查过期的文件
-        for file_id, last_access in file_access_records.copy().items():
-            if is_file_expired(file_id):
-                expired_files.add(file_id)
-                del file_access_records[file_id]
-        
-        # 清理过期文件
-        for file_id in expired_files:
-            # 删除上传目录中的原始文件和处理后的文件
-            for file_path in Path(UPLOAD_DIR).glob(f"{file_id}*"):
-                try:
-                    file_path.unlink()
-                    logger.info(f"已删除过期文件: {file_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {file_path}: {str(e)}")
-            
-            # 删除相关的图表文件
-            for image_path in Path(IMAGES_DIR).glob(f"plot_{file_id}*"):
-                try:
-                    image_path.unlink()
-                    logger.info(f"已删除过期图表: {image_path}")
-                except Exception as e:
-                    logger.error(f"删除图表失败 {image_path}: {str(e)}")
-        
-        if expired_files:
-            logger.info(f"清理了 {len(expired_files)} 个过期文件")
-            # 保存更新后的访问记录
-            save_access_records()
-    
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(None, run_cleanup)
+        await loop.run_in_executor(None, _save_report, report)
     except Exception as e:
         logger.exception(f"清理过期文件时出错: {str(e)}")
 
+
 async def start_cleanup_scheduler() -> None:
-    """启动定期清理任务"""
-    load_access_records()  # 启动时加载记录
-    logger.info("文件清理调度器已启动，已加载访问记录")
+    """启动定期清理任务
+
+    每个工作进程都会启动调度器，但只有取得清理锁的进程执行清理；
+    该进程退出后，其他进程在下一个周期接替。
+    """
+    logger.info(f"文件清理调度器已启动，当前有 {access_store.count()} 条访问记录")
     while True:
-        await cleanup_expired_files()
-        # 每小时检查一次
-        await asyncio.sleep(3600) 
\ No newline at end of file
+        if _acquire_leadership():
+            await cleanup_expired_files()
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
@@ -1,14 +1,37 @@
 import os
+import re
+import time
+import uuid
+import asyncio
+import hashlib
 import pandas as pd
 import numpy as np
 import logging
 from fastapi import UploadFile
 from pathlib import Path
 import aiofiles
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import OrderedDict
 from typing import Dict, List, Any, Optional, Tuple
 
+from app.services.dataframe_cache import dataframe_cache
+from app.services.blob_store import store_and_link, write_ref, read_ref, forget_ref, release_blob, get_ref_path, BLOB_DIR
+from app.services.access_store import access_store
+from app.services.quota_service import (
+    QuotaExceededError, get_storage_budget, raise_storage_exceeded, check_table_size
+)
+from app.services.json_serializer import frame_to_data, ORIENT_RECORDS
+from app.services.cpu_pool import run_cpu
+from app.services.result_writer import result_writer
+from app.services.dtype_service import apply_file_schema, optimize_dataframe, load_schema, get_executor_schema
+
 logger = logging.getLogger("file_service")
 
+# 上传时生成的文件ID（小写的UUID）
+FILE_ID_REGEX = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+_FILE_ID_PATTERN = re.compile(rf"^{FILE_ID_REGEX}$")
+
 # 获取根目录位置
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
@@ -16,81 +39,652 @@ UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 # 确保上传目录存在
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-async def save_upload_file(file: UploadFile, file_id: str, file_extension: str) -> str:
-    """保存上传的文件到指定目录"""
+# 上传文件大小上限（字节），默认100MB
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))
+# 流式写入上传文件时每次读取的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 读取处理结果时最多等待后台写入多少秒，超过该时间的写入标记视为进程崩溃遗留
+RESULT_WRITE_WAIT_TIMEOUT = float(os.getenv("RESULT_WRITE_WAIT_TIMEOUT", 60))
+# 等待后台写入时检查写入标记的间隔（秒）
+RESULT_WRITE_POLL_INTERVAL = 0.05
+
+class UploadTooLargeError(ValueError):
+    """上传文件超过大小限制"""
+
+async def save_upload_file(file: UploadFile, file_id: str, file_extension: str,
+                           client_id: Optional[str] = None) -> Tuple[str, str]:
+    """分块流式保存上传的文件，返回保存路径和内容的SHA-256哈希
+
+    内容按哈希存入内容寻址存储，相同内容只保存一份，file_id对应的文件是指向它的引用。
+    提供client_id时检查并记录该客户端的存储占用，超出配额时抛出QuotaExceededError。
+    """
     saved_file_path = os.path.join(UPLOAD_DIR, f"{file_id}{file_extension}")
+    tmp_path = f"{saved_file_path}.part"
+    hasher = hashlib.sha256()
+    total_size = 0
+    loop = asyncio.get_running_loop()
+    used_bytes = (await loop.run_in_executor(None, access_store.get_client_usage, client_id))[1] if client_id else 0
+    budget = get_storage_budget(used_bytes) if client_id else None
     
-    async with aiofiles.open(saved_file_path, 'wb') as out_file:
-        # 读取上传的文件内容并写入目标文件
-        content = await file.read()
-        await out_file.write(content)
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out_file:
+            # 每次只读取一个块，边写入边计算哈希并检查大小
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total_size += len(chunk)
+                if total_size > MAX_UPLOAD_SIZE:
+                    raise UploadTooLargeError(f"文件大小超过限制 {MAX_UPLOAD_SIZE // (1024 * 1024)}MB")
+                if budget is not None and total_size > budget:
+                    raise_storage_exceeded(used_bytes, total_size)
+                hasher.update(chunk)
+                await out_file.write(chunk)
+        content_hash = hasher.hexdigest()
+        # 先写入引用记录，清理任务不会把正在链接的blob视为无引用
+        write_ref(file_id, content_hash)
+        reused = store_and_link(tmp_path, content_hash, file_extension, saved_file_path)
+    except BaseException:
+        # 写入失败或超出限制时删除不完整的文件
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if os.path.exists(get_ref_path(file_id)):
+            os.remove(get_ref_path(file_id))
+            forget_ref(file_id)
+        raise
     
-    logger.info(f"文件已保存: {saved_file_path}")
-    return saved_file_path
+    if reused:
+        logger.info(f"文件内容已存在，复用已有存储: {saved_file_path}, SHA-256: {content_hash}")
+    else:
+        logger.info(f"文件已保存: {saved_file_path}, 大小: {total_size} 字节, SHA-256: {content_hash}")
+    
+    try:
+        # 不解析整个文件，只统计行数和读取表头来检查表格大小
+        await run_cpu("check_upload", _check_uploaded_table, saved_file_path)
+    except QuotaExceededError:
+        await loop.run_in_executor(None, remove_file_artifacts, file_id)
+        raise
+    if client_id:
+        await loop.run_in_executor(None, access_store.record_usage, file_id, client_id, total_size)
+    return saved_file_path, content_hash
 
-async def read_file_preview(file_id: str, rows: int = 20) -> Dict[str, Any]:
-    """读取文件预览内容"""
-    # 查找匹配的文件
-    file_path = None
-    for ext in ['.csv', '.xlsx', '.xls']:
-        potential_path = os.path.join(UPLOAD_DIR, f"{file_id}{ext}")
-        if os.path.exists(potential_path):
-            file_path = potential_path
-            break
+def _check_uploaded_table(file_path: str) -> None:
+    """检查上传表格的行数和单元格数是否超出配额"""
+    try:
+        if file_path.lower().endswith('.csv'):
+            rows = count_csv_rows(file_path)
+            columns = len(pd.read_csv(file_path, nrows=0).columns)
+        else:
+            rows = count_excel_rows(file_path)
+            if rows is None:
+                # .xls 无法在不解析的情况下得到行数，读取时再检查
+                return
+            columns = len(pd.read_excel(file_path, nrows=0).columns)
+    except Exception as e:
+        # 无法读取的文件在预览时报告错误
+        logger.warning(f"无法读取表格大小 {file_path}: {str(e)}")
+        return
+    check_table_size(rows, columns, "上传的表格")
+
+# Parquet副本和快照每个行组的行数，分页读取未缓存的表时只读取当前页所在的行组
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+
+# 预览结果和行数的缓存条目上限
+PREVIEW_CACHE_MAX_ENTRIES = 256
+# 排序结果按行数占用内存，只保留少量条目
+SORT_ORDER_CACHE_MAX_ENTRIES = 16
+
+# (缓存键, 数据源修改时间, 行数, 文件类型, 数据格式) -> 预览数据
+_preview_cache: "OrderedDict[Tuple[str, float, int, str, str], Dict[str, Any]]" = OrderedDict()
+# (缓存键, 数据源修改时间) -> 数据行数
+_row_count_cache: "OrderedDict[Tuple[str, float], int]" = OrderedDict()
+# (缓存键, 数据源修改时间, 排序参数) -> 排序后的行位置
+_sort_order_cache: "OrderedDict[Tuple[str, float, str], np.ndarray]" = OrderedDict()
+
+def _memo_put(cache: OrderedDict, key: Tuple, value: Any, max_entries: int = PREVIEW_CACHE_MAX_ENTRIES) -> None:
+    """写入预览缓存，超过上限时淘汰最早的条目"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+def _purge_preview_cache(cache_key: str) -> None:
+    """移除某个文件的预览缓存"""
+    # 清理任务在线程池中调用，先复制键再删除，不在遍历时修改缓存
+    for cache in (_preview_cache, _row_count_cache, _sort_order_cache):
+        for key in [k for k in list(cache) if k[0] == cache_key]:
+            cache.pop(key, None)
+
+def sanitize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """将DataFrame中的空值、无穷值和NaN统一替换为None，便于JSON序列化"""
+    df = df.replace([float('inf'), float('-inf'), np.inf, -np.inf], None)
+    
+    # 将所有NaN、None和pd.NA替换为None
+    df = df.astype(object).replace([pd.NA, pd.NaT, np.nan], None)
+    return df.where(pd.notnull(df), None)
+
+def count_csv_rows(file_path: str) -> int:
+    """按换行符统计CSV的数据行数（不含表头），无需解析文件内容
+
+    字段内含有换行符时结果会偏大，仅用于预览展示。
+    """
+    newline_count = 0
+    last_block = b''
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(UPLOAD_CHUNK_SIZE)
+            if not block:
+                break
+            newline_count += block.count(b'\n')
+            last_block = block
+    if last_block and not last_block.endswith(b'\n'):
+        newline_count += 1
+    return max(newline_count - 1, 0)
+
+def count_excel_rows(file_path: str) -> Optional[int]:
+    """以openpyxl只读模式读取第一个工作表的行数（不含表头），不支持时返回None"""
+    if not file_path.lower().endswith('.xlsx'):
+        return None
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0]
+        max_row = worksheet.max_row
+        if max_row is None:
+            # 文件中没有记录表格尺寸时逐行计数
+            max_row = sum(1 for _ in worksheet.iter_rows(values_only=True))
+        return max(max_row - 1, 0)
+    finally:
+        workbook.close()
+
+def _read_head(file_id: str, source_path: str, is_sidecar: bool, rows: int,
+               rows_count: Optional[int]) -> Tuple[pd.DataFrame, Optional[int]]:
+    """解析前rows行数据并按文件的类型方案转换，rows_count未知时尽量通过元数据统计，无法廉价获取时返回None"""
+    if is_sidecar:
+        parquet_file = pq.ParquetFile(source_path)
+        rows_count = parquet_file.metadata.num_rows
+        # 批次不跨越行组，第一个批次可能不足rows行
+        batches = []
+        collected = 0
+        for batch in parquet_file.iter_batches(batch_size=max(rows, 1)):
+            batches.append(batch)
+            collected += batch.num_rows
+            if collected >= rows:
+                break
+        if batches:
+            head = pa.Table.from_batches(batches).to_pandas().head(rows)
+        else:
+            head = parquet_file.schema_arrow.empty_table().to_pandas()
+    else:
+        if source_path.lower().endswith('.csv'):
+            head = pd.read_csv(source_path, nrows=rows, keep_default_na=True)
+            if rows_count is None:
+                rows_count = count_csv_rows(source_path)
+        else:
+            head = pd.read_excel(source_path, nrows=rows, keep_default_na=True)
+            if rows_count is None:
+                rows_count = count_excel_rows(source_path)
+        if len(head) < rows:
+            # 文件已经全部读完，行数是精确值（估算的行数可能因引号内的换行等而不准确）
+            rows_count = len(head)
+    return apply_file_schema(file_id, head), rows_count
+
+async def _read_preview_head(file_id: str, file_path: str, rows: int) -> Tuple[pd.DataFrame, int]:
+    """只读取前rows行数据，并尽量通过缓存或元数据获取总行数"""
+    sidecar_path = get_sidecar_path(file_id)
+    source_path = sidecar_path if os.path.exists(sidecar_path) else file_path
+    cache_key = get_cache_key(file_id)
+    mtime = os.path.getmtime(source_path)
     
+    # 完整的DataFrame已在缓存中时直接使用
+    df = dataframe_cache.get(cache_key, mtime)
+    if df is not None:
+        return df.head(rows), len(df)
+    
+    count_key = (cache_key, mtime)
+    head, rows_count = await run_cpu("preview", _read_head, file_id, source_path, source_path == sidecar_path,
+                                     rows, _row_count_cache.get(count_key))
+    if rows_count is None:
+        # .xls 无法廉价获取行数，只能完整读取
+        rows_count = len(await load_dataframe(file_id, file_path))
+    _memo_put(_row_count_cache, count_key, rows_count)
+    return head, rows_count
+
+async def read_preview_frame(file_id: str, rows: int = 20) -> Tuple[pd.DataFrame, int]:
+    """读取预览的前rows行DataFrame和总行数"""
+    file_path = await get_file_path_by_id(file_id)
+    if not file_path:
+        raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+    return await _read_preview_head(file_id, file_path, rows)
+
+async def read_file_preview(file_id: str, rows: int = 20, orient: str = ORIENT_RECORDS) -> Dict[str, Any]:
+    """读取文件预览内容，只解析和处理需要展示的前rows行
+
+    orient为records时data是按行的字典列表，为columns时是按列的值列表。
+    """
+    file_path = await get_file_path_by_id(file_id)
     if not file_path:
         raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
     
     # 根据文件类型读取数据
     file_type = Path(file_path).suffix.lower()
     try:
-        if file_type == '.csv':
-            df = pd.read_csv(file_path, keep_default_na=True)
-        else:  # .xlsx 或 .xls
-            df = pd.read_excel(file_path, keep_default_na=True)
-    
-        # 统一处理所有类型的空值、无穷值和NaN值
-        df = df.replace([float('inf'), float('-inf'), np.inf, -np.inf], None)
+        sidecar_path = get_sidecar_path(file_id)
+        source_path = sidecar_path if os.path.exists(sidecar_path) else file_path
+        memo_key = (get_cache_key(file_id), os.path.getmtime(source_path), rows, file_type, orient)
+        preview_data = _preview_cache.get(memo_key)
+        if preview_data is not None:
+            _preview_cache.move_to_end(memo_key)
+            return preview_data
         
-        # 将所有NaN、None和pd.NA替换为None
-        df = df.astype(object).replace([pd.NA, pd.NaT, np.nan], None)
-        df = df.where(pd.notnull(df), None)
+        head, rows_count = await _read_preview_head(file_id, file_path, rows)
         
-        logger.info(f"文件 {file_id} 数据处理完成，行数: {len(df)}, 列数: {len(df.columns)}")
+        logger.info(f"文件 {file_id} 预览处理完成，总行数: {rows_count}, 列数: {len(head.columns)}")
         
         # 构建预览数据
         preview_data = {
-            "columns": df.columns.tolist(),
-            "data": df.head(rows).to_dict(orient="records"),
-            "rows_count": len(df),
+            "columns": head.columns.tolist(),
+            "data": await run_cpu("serialize", frame_to_data, head, orient),
+            "rows_count": rows_count,
             "file_type": file_type[1:]  # 去掉点号
         }
+        _memo_put(_preview_cache, memo_key, preview_data)
         
         return preview_data
     except Exception as e:
         logger.error(f"处理文件 {file_id} 时发生错误: {str(e)}")
         raise Exception(f"读取文件失败: {str(e)}")
 
-async def get_file_path_by_id(file_id: str) -> Optional[str]:
-    """通过文件ID查找文件路径"""
+def read_table_file(file_path: str) -> pd.DataFrame:
+    """根据文件类型解析CSV或Excel文件"""
+    if file_path.lower().endswith('.csv'):
+        return pd.read_csv(file_path, keep_default_na=True)
+    # .xlsx 或 .xls
+    return pd.read_excel(file_path, keep_default_na=True)
+
+def get_cache_key(file_id: str) -> str:
+    """获取文件的缓存键，内容相同的文件共享同一个键"""
+    return read_ref(file_id) or file_id
+
+def get_sidecar_path(file_id: str) -> str:
+    """获取文件对应的列式(Parquet)副本路径，内容相同的文件共享同一个副本"""
+    content_hash = read_ref(file_id)
+    if content_hash:
+        return os.path.join(BLOB_DIR, f"{content_hash}.parquet")
+    return os.path.join(UPLOAD_DIR, f"{file_id}.parquet")
+
+def build_columnar_sidecar(file_id: str, file_path: str) -> Optional[str]:
+    """上传后将原始文件解析一次，按推断的类型方案转换后保存为Parquet副本，后续读取直接使用该副本"""
+    sidecar_path = get_sidecar_path(file_id)
+    if os.path.exists(sidecar_path):
+        # 相同内容此前已经转换过
+        return sidecar_path
+    
+    tmp_path = f"{sidecar_path}.{file_id}.tmp"
+    try:
+        df = optimize_dataframe(file_id, read_table_file(file_path))
+        if not all(isinstance(col, str) for col in df.columns):
+            logger.info(f"文件 {file_id} 含有非字符串列名，跳过生成列式副本")
+            return None
+        
+        # 先写入临时文件再重命名，避免读取到写了一半的副本
+        df.to_parquet(tmp_path, index=False, row_group_size=PARQUET_ROW_GROUP_ROWS)
+        os.replace(tmp_path, sidecar_path)
+        dataframe_cache.put(get_cache_key(file_id), os.path.getmtime(sidecar_path), df)
+        logger.info(f"已生成列式副本: {sidecar_path}")
+        return sidecar_path
+    except Exception as e:
+        # 混合类型的列等情况无法转换为Parquet，继续使用原始文件
+        logger.warning(f"生成文件 {file_id} 的列式副本失败，将继续使用原始文件: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+async def load_dataframe(file_id: str, file_path: Optional[str] = None,
+                         columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """读取文件对应的DataFrame，优先使用进程内缓存和列式副本
+
+    返回的DataFrame在请求之间共享，调用方不得原地修改。
+    读取后按文件的类型方案转换列类型，还没有方案时推断并保存。
+    指定columns时只返回这些列，列式副本未缓存时只读取所需的列。
+    """
+    sidecar_path = get_sidecar_path(file_id)
+    if os.path.exists(sidecar_path):
+        source_path = sidecar_path
+    else:
+        if file_path is None:
+            file_path = await get_file_path_by_id(file_id)
+            if not file_path:
+                raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+        source_path = file_path
+    
+    cache_key = get_cache_key(file_id)
+    mtime = os.path.getmtime(source_path)
+    df = dataframe_cache.get(cache_key, mtime)
+    if df is None:
+        if source_path == sidecar_path:
+            if columns is not None:
+                # 列投影：只读取需要的列，不放入缓存
+                df = await run_cpu("parse", pd.read_parquet, sidecar_path, columns=columns)
+                return await run_cpu("dtypes", apply_file_schema, file_id, df)
+            df = await run_cpu("parse", pd.read_parquet, sidecar_path)
+        else:
+            df = await run_cpu("parse", read_table_file, source_path)
+        check_table_size(df.shape[0], df.shape[1])
+        df = await run_cpu("dtypes", optimize_dataframe, file_id, df)
+        # 统计DataFrame占用的内存需要遍历所有字符串，在线程池中进行
+        await run_cpu("cache", dataframe_cache.put, cache_key, mtime, df)
+    
+    if columns is not None:
+        return df[columns]
+    return df
+
+async def get_table_schema(file_id: str) -> Dict[str, Any]:
+    """获取文件的列类型方案、执行代码时使用的列类型和节省内存的统计，还没有方案时读取一次表格以推断"""
+    schema = load_schema(file_id)
+    if schema is None:
+        await load_dataframe(file_id)
+        schema = load_schema(file_id)
+    if schema is None:
+        raise ValueError("无法推断该文件的列类型")
+    return {**schema, "executor_columns": get_executor_schema(schema["columns"])}
+
+def is_valid_file_id(file_id: str) -> bool:
+    """file_id是否为上传时生成的文件ID格式"""
+    return bool(_FILE_ID_PATTERN.match(file_id))
+
+def find_file_path(file_id: str) -> Optional[str]:
+    """通过文件ID查找文件路径（同步版本，供后台线程使用），file_id格式无效时返回None"""
+    if not is_valid_file_id(file_id):
+        return None
     for ext in ['.csv', '.xlsx', '.xls']:
         file_path = os.path.join(UPLOAD_DIR, f"{file_id}{ext}")
         if os.path.exists(file_path):
             return file_path
     return None
 
-async def export_file(file_id: str, filename: Optional[str] = None) -> str:
-    """导出处理后的文件"""
-    # 查找原始文件的路径
+async def get_file_path_by_id(file_id: str) -> Optional[str]:
+    """通过文件ID查找文件路径"""
+    return find_file_path(file_id)
+
+# 处理结果和步骤结果表优先保存为Parquet，无法保存时退回为pickle；旧版本按原始文件格式保存处理结果
+SNAPSHOT_EXTENSIONS = ('.parquet', '.pkl')
+
+def write_table_snapshot(df: pd.DataFrame, base_path: str) -> str:
+    """将DataFrame保存为base_path加扩展名的快照文件，返回保存路径
+
+    写入临时文件后重命名，读取时不会得到写了一半的文件；混合类型的列等无法保存为Parquet时退回为pickle。
+    """
+    path = f"{base_path}.parquet"
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, index=False, row_group_size=PARQUET_ROW_GROUP_ROWS)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        path = f"{base_path}.pkl"
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+def read_table_snapshot(path: str) -> pd.DataFrame:
+    """读取快照文件，也支持旧版本按原始格式保存的处理结果"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    return read_table_file(path)
+
+def get_processed_base_path(file_id: str) -> str:
+    """获取处理结果文件不含扩展名的路径"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_processed")
+
+def get_processed_key_path(file_id: str) -> str:
+    """记录处理结果文件由哪次执行生成，内容未变化时无需重复写入"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_processed.key")
+
+def get_processed_pending_path(file_id: str) -> str:
+    """处理结果正在后台写入的标记文件，所有工作进程都能看到"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_processed.pending")
+
+def mark_processed_pending(file_id: str) -> str:
+    """写入标记并返回本次写入的令牌，之后提交的写入会替换标记中的令牌"""
+    token = uuid.uuid4().hex
+    pending_path = get_processed_pending_path(file_id)
+    tmp_path = f"{pending_path}.{token}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(token)
+    os.replace(tmp_path, pending_path)
+    return token
+
+def clear_processed_pending(file_id: str, token: str) -> None:
+    """标记中仍是本次写入的令牌时删除标记，已有更新的写入提交时保留"""
+    pending_path = get_processed_pending_path(file_id)
+    try:
+        with open(pending_path, "r") as f:
+            if f.read().strip() != token:
+                return
+        os.remove(pending_path)
+    except FileNotFoundError:
+        pass
+
+async def wait_for_processed_file(file_id: str) -> None:
+    """处理结果正在后台写入时等待写入完成，没有待写入的结果时立即返回
+
+    本进程提交的写入直接查询后台写入线程，其他工作进程提交的写入通过标记文件判断。
+    """
+    pending_path = get_processed_pending_path(file_id)
+    deadline = asyncio.get_running_loop().time() + RESULT_WRITE_WAIT_TIMEOUT
+    while True:
+        pending, _ = result_writer.get_pending(f"processed:{file_id}")
+        if not pending:
+            try:
+                marked_at = os.path.getmtime(pending_path)
+            except FileNotFoundError:
+                return
+            if time.time() - marked_at > RESULT_WRITE_WAIT_TIMEOUT:
+                logger.warning(f"忽略过期的写入标记: {pending_path}")
+                return
+        if asyncio.get_running_loop().time() > deadline:
+            logger.warning(f"等待处理结果写入超时: {file_id}")
+            return
+        await asyncio.sleep(RESULT_WRITE_POLL_INTERVAL)
+
+async def get_processed_file_path(file_id: str) -> Optional[str]:
+    """获取处理结果文件的路径，尚未生成处理结果时返回None
+
+    处理结果正在后台写入时先等待写入完成。
+    """
     original_file_path = await get_file_path_by_id(file_id)
     if not original_file_path:
         raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+    await wait_for_processed_file(file_id)
+    
+    base_path = get_processed_base_path(file_id)
+    for ext in SNAPSHOT_EXTENSIONS + (Path(original_file_path).suffix,):
+        if os.path.exists(f"{base_path}{ext}"):
+            return f"{base_path}{ext}"
+    return None
+
+def remove_processed_files(file_id: str, keep: Optional[str] = None) -> None:
+    """删除处理结果文件（除keep外的所有格式）以及由它渲染的导出文件"""
+    base_path = get_processed_base_path(file_id)
+    for ext in SNAPSHOT_EXTENSIONS + ('.csv', '.xlsx', '.xls'):
+        path = f"{base_path}{ext}"
+        if path != keep and os.path.exists(path):
+            os.remove(path)
+    remove_export_renders(file_id)
+
+def get_export_render_path(file_id: str, etag: str, suffix: str) -> str:
+    """获取已渲染的导出文件的保存路径，文件随file_id一起被清理"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_export_{etag}{suffix}")
+
+def remove_export_renders(file_id: str) -> None:
+    """删除已渲染的导出文件，数据变化后它们不会再被使用"""
+    for path in Path(UPLOAD_DIR).glob(f"{file_id}_export_*"):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+async def load_processed_dataframe(file_id: str) -> pd.DataFrame:
+    """读取处理结果对应的DataFrame，使用与原始文件相同的进程内缓存"""
+    processed_path = await get_processed_file_path(file_id)
+    if not processed_path:
+        raise FileNotFoundError(f"ID为 {file_id} 的文件还没有处理结果")
+    
+    cache_key = f"{file_id}_processed"
+    mtime = os.path.getmtime(processed_path)
+    df = dataframe_cache.get(cache_key, mtime)
+    if df is None:
+        df = await run_cpu("parse", read_table_snapshot, processed_path)
+        # 统计DataFrame占用的内存需要遍历所有字符串，在线程池中进行
+        await run_cpu("cache", dataframe_cache.put, cache_key, mtime, df)
+    return df
+
+def _parse_sort(sort: str, columns: List[str]) -> Tuple[List[str], List[bool]]:
+    """解析排序参数，如 "收入" 或 "-收入,年龄"，前缀 - 表示降序"""
+    by, ascending = [], []
+    for item in sort.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        descending = item.startswith('-')
+        column = item[1:] if descending else item
+        if column not in columns:
+            raise ValueError(f"排序列不存在: {column}")
+        by.append(column)
+        ascending.append(not descending)
+    return by, ascending
+
+def _sort_order(df: pd.DataFrame, by: List[str], ascending: List[bool]) -> np.ndarray:
+    """计算排序后的行位置"""
+    return df.reset_index(drop=True).sort_values(by=by, ascending=ascending, kind="stable").index.to_numpy()
+
+def _read_parquet_rows(path: str, positions: np.ndarray, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """只读取positions所在的行组，按positions的顺序返回这些行，行索引为行位置；指定columns时只读取这些列"""
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    starts = np.cumsum([0] + group_rows)
+    groups = np.searchsorted(starts, positions, side="right") - 1
+    needed = np.unique(groups)
+    if len(needed) == 0:
+        empty = parquet_file.schema_arrow.empty_table()
+        page = (empty.select(columns) if columns else empty).to_pandas()
+    else:
+        table = parquet_file.read_row_groups(needed.tolist(), columns=columns)
+        # 行组拼接后各自的起始位置
+        local_starts = np.cumsum([0] + [group_rows[group] for group in needed])[:-1]
+        local = local_starts[np.searchsorted(needed, groups)] + (positions - starts[groups])
+        page = table.take(pa.array(local)).to_pandas()
+    page.index = pd.Index(positions)
+    return page
+
+def _parquet_row_count(path: str) -> int:
+    return pq.ParquetFile(path).metadata.num_rows
+
+async def select_table_rows(file_id: str, offset: int = 0, limit: int = 100,
+                            columns: Optional[List[str]] = None, sort: Optional[str] = None,
+                            processed: bool = False) -> Tuple[pd.DataFrame, int]:
+    """按窗口选取原始表或处理结果表的数据行，返回当前页的DataFrame和总行数
+
+    表格已在缓存中时直接切片当前页；否则Parquet副本和快照只读取当前页所在的行组和columns指定的列，
+    超出缓存预算的大表翻页时也无需读取整个文件。排序后的行顺序按数据源的修改时间缓存，翻页时无需重新排序，
+    计算行顺序时也只读取排序列。
+    """
+    if processed:
+        source_path = await get_processed_file_path(file_id)
+        if not source_path:
+            raise FileNotFoundError(f"ID为 {file_id} 的文件还没有处理结果")
+        cache_key = f"{file_id}_processed"
+    else:
+        sidecar_path = get_sidecar_path(file_id)
+        source_path = sidecar_path if os.path.exists(sidecar_path) else await get_file_path_by_id(file_id)
+        if not source_path:
+            raise FileNotFoundError(f"找不到ID为 {file_id} 的文件")
+        cache_key = get_cache_key(file_id)
+    try:
+        mtime = os.path.getmtime(source_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"ID为 {file_id} 的文件已被删除")
     
-    # 查找处理后的文件
-    processed_path = os.path.join(UPLOAD_DIR, f"{file_id}_processed{Path(original_file_path).suffix}")
+    df = dataframe_cache.get(cache_key, mtime)
+    windowed = df is None and source_path.endswith('.parquet')
+    if windowed:
+        rows_count = await run_cpu("parse", _parquet_row_count, source_path)
+        table_columns = pq.read_schema(source_path).names
+    else:
+        if df is None:
+            df = await (load_processed_dataframe(file_id) if processed else load_dataframe(file_id))
+        rows_count = len(df)
+        table_columns = df.columns.tolist()
     
-    # 如果没有处理后的文件，返回原始文件
-    if not os.path.exists(processed_path):
-        return original_file_path
+    if columns:
+        missing = [col for col in columns if col not in table_columns]
+        if missing:
+            raise ValueError(f"列不存在: {missing}")
+    
+    if sort:
+        order_key = (cache_key, mtime, sort)
+        order = _sort_order_cache.get(order_key)
+        if order is None:
+            by, ascending = _parse_sort(sort, table_columns)
+            if df is not None:
+                sort_df = df
+            elif processed:
+                # 只读取排序列
+                sort_df = await run_cpu("parse", pd.read_parquet, source_path, columns=by)
+            else:
+                sort_df = await load_dataframe(file_id, columns=by)
+            order = await run_cpu("sort", _sort_order, sort_df, by, ascending)
+            _memo_put(_sort_order_cache, order_key, order, SORT_ORDER_CACHE_MAX_ENTRIES)
+        positions = order[offset:offset + limit]
+    else:
+        positions = np.arange(min(offset, rows_count), min(offset + limit, rows_count))
+    
+    if df is not None:
+        page = df.iloc[positions]
+    else:
+        page = await run_cpu("parse", _read_parquet_rows, source_path, positions, columns or None)
+        if not processed:
+            page = await run_cpu("dtypes", apply_file_schema, file_id, page)
+    
+    if columns:
+        page = page[columns]
+    return page, rows_count
+
+async def read_table_rows(file_id: str, offset: int = 0, limit: int = 100,
+                          columns: Optional[List[str]] = None, sort: Optional[str] = None,
+                          processed: bool = False, orient: str = ORIENT_RECORDS) -> Dict[str, Any]:
+    """按窗口读取原始表或处理结果表的数据行，只转换当前页的数据"""
+    page, rows_count = await select_table_rows(file_id, offset, limit, columns, sort, processed)
+    return {
+        "columns": page.columns.tolist(),
+        "data": await run_cpu("serialize", frame_to_data, page, orient),
+        "offset": offset,
+        "limit": limit,
+        "rows_count": rows_count,
+        "table": "processed" if processed else "original"
+    }
+
+def remove_file_artifacts(file_id: str) -> None:
+    """删除file_id的引用及其处理结果，最后一个引用删除时同时释放共享的内容"""
+    if not is_valid_file_id(file_id):
+        raise ValueError(f"无效的文件ID: {file_id}")
+    content_hash = read_ref(file_id)
+    for file_path in Path(UPLOAD_DIR).glob(f"{file_id}*"):
+        try:
+            file_path.unlink()
+            logger.info(f"已删除文件: {file_path}")
+        except FileNotFoundError:
+            pass
+    forget_ref(file_id)
+    dataframe_cache.invalidate(file_id)
+    _purge_preview_cache(file_id)
+    _purge_preview_cache(f"{file_id}_processed")
     
-    return processed_path 
\ No newline at end of file
+    if content_hash and release_blob(content_hash):
+        dataframe_cache.invalidate(content_hash)
+        _purge_preview_cache(content_hash)
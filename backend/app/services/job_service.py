@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from app.models.chat_models import ChatMessage
+from app.services.admission_service import chat_admission, AdmissionRejected
+from app.services.chat_service import run_chat, format_sse_event
+from app.services.quota_service import QuotaExceededError
+
+logger = logging.getLogger("job_service")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+
+# 任务状态：排队中、运行中、成功、失败
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+TERMINAL_STATES = (JOB_SUCCEEDED, JOB_FAILED)
+
+# SSE推送时检查任务状态的间隔（秒）
+JOB_EVENT_POLL_INTERVAL = 0.5
+# SSE心跳间隔（秒），避免代理因连接空闲而断开
+JOB_EVENT_HEARTBEAT = 15
+# 未结束的任务超过该时间（秒）没有更新时视为已中断（如执行任务的工作进程崩溃或重启）
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", 600))
+
+# 正在运行的任务，保留引用避免被垃圾回收
+_running_tasks: Set[asyncio.Task] = set()
+
+
+def get_job_path(file_id: str, job_id: str) -> str:
+    """获取任务记录文件路径
+
+    任务记录以file_id为前缀保存在上传目录，所有工作进程都能读取，并随文件一起被清理。
+    """
+    return os.path.join(UPLOAD_DIR, f"{file_id}_job_{job_id}.json")
+
+
+def _save_job(job: Dict[str, Any]) -> None:
+    """保存任务记录（写入临时文件后重命名，保证读取到的记录完整）"""
+    job["updated_at"] = datetime.now().isoformat()
+    job_path = get_job_path(job["file_id"], job["job_id"])
+    # 执行任务的进程和推送事件的进程可能同时写入，各自使用独立的临时文件
+    tmp_path = f"{job_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, job_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_job(file_id: str, job_id: str) -> Optional[Dict[str, Any]]:
+    """读取任务记录，不存在时返回None"""
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(get_job_path(file_id, job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+async def _run_job(job: Dict[str, Any], message: str, history: Optional[List[ChatMessage]]) -> None:
+    """在后台执行分析任务并记录各阶段进度"""
+    file_id = job["file_id"]
+
+    def on_phase(phase: str) -> None:
+        job["status"] = JOB_RUNNING
+        job["phase"] = phase
+        _save_job(job)
+
+    try:
+        admitted_at = await chat_admission.acquire(file_id)
+    except AdmissionRejected as e:
+        job.update(status=JOB_FAILED, error=str(e), retry_after=e.retry_after)
+        _save_job(job)
+        return
+
+    try:
+        job["result"] = await run_chat(file_id, message, history, on_phase=on_phase)
+        job["status"] = JOB_SUCCEEDED
+    except FileNotFoundError:
+        job.update(status=JOB_FAILED, error="文件不存在")
+    except QuotaExceededError as e:
+        # 与同步接口返回相同的结构化信息
+        job.update(status=JOB_FAILED, error=str(e), error_detail=e.to_detail())
+    except Exception as e:
+        logger.exception(f"分析任务 {job['job_id']} 执行失败")
+        job.update(status=JOB_FAILED, error=f"处理聊天请求失败: {str(e)}")
+    finally:
+        chat_admission.release(file_id, admitted_at)
+    _save_job(job)
+    logger.info(f"分析任务 {job['job_id']} 已结束，状态: {job['status']}")
+
+
+def create_job(file_id: str, message: str, history: Optional[List[ChatMessage]] = None) -> Dict[str, Any]:
+    """创建分析任务并立即在后台开始执行，返回任务记录"""
+    now = datetime.now().isoformat()
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "file_id": file_id,
+        "status": JOB_QUEUED,
+        "phase": None,
+        "created_at": now,
+        "updated_at": now,
+        "result": None,
+        "error": None,
+        "error_detail": None,
+    }
+    _save_job(job)
+
+    task = asyncio.create_task(_run_job(job, message, history))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return dict(job)
+
+
+def _is_stale(file_id: str, job_id: str) -> bool:
+    """任务记录文件是否超过JOB_STALE_SECONDS没有更新"""
+    if JOB_STALE_SECONDS <= 0:
+        return False
+    try:
+        updated_at = os.path.getmtime(get_job_path(file_id, job_id))
+    except FileNotFoundError:
+        return False
+    return time.time() - updated_at > JOB_STALE_SECONDS
+
+
+async def stream_job_events(file_id: str, job_id: str) -> AsyncIterator[str]:
+    """以Server-Sent Events格式推送任务进度，任务结束后推送最终结果"""
+    last_updated = None
+    idle_seconds = 0.0
+    while True:
+        job = get_job(file_id, job_id)
+        if job is None:
+            yield format_sse_event("error", {"error": "任务不存在"})
+            return
+
+        if job["updated_at"] != last_updated:
+            last_updated = job["updated_at"]
+            idle_seconds = 0.0
+            if job["status"] in TERMINAL_STATES:
+                yield format_sse_event("done", job)
+                return
+            yield format_sse_event("progress", {
+                "job_id": job_id,
+                "status": job["status"],
+                "phase": job["phase"],
+                "updated_at": job["updated_at"],
+            })
+        elif _is_stale(file_id, job_id):
+            # 重新读取最新的记录，任务可能刚刚结束
+            latest = get_job(file_id, job_id)
+            if latest is None:
+                yield format_sse_event("error", {"error": "任务不存在"})
+                return
+            if latest["status"] in TERMINAL_STATES:
+                yield format_sse_event("done", latest)
+                return
+            logger.warning(f"分析任务 {job_id} 超过 {JOB_STALE_SECONDS:g} 秒没有进展，视为已中断")
+            latest.update(status=JOB_FAILED, error="任务长时间没有进展，可能已中断")
+            _save_job(latest)
+            yield format_sse_event("failed", latest)
+            return
+        elif idle_seconds >= JOB_EVENT_HEARTBEAT:
+            idle_seconds = 0.0
+            yield ": keep-alive\n\n"
+
+        await asyncio.sleep(JOB_EVENT_POLL_INTERVAL)
+        idle_seconds += JOB_EVENT_POLL_INTERVAL
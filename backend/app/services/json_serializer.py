@@ -0,0 +1,140 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时使用标准库json，结果相同但速度较慢
+    orjson = None
+
+logger = logging.getLogger("json_serializer")
+
+# 表格数据的两种输出形式：按行的字典列表，或按列的值列表
+ORIENT_RECORDS = "records"
+ORIENT_COLUMNS = "columns"
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def _column_values(series: pd.Series, passthrough: bool = False) -> Any:
+    """将一列转换为可直接JSON序列化的值，空值、NaN和无穷值均为None
+
+    整数、布尔值等原生数值列整列向量化转换；passthrough为True时直接返回numpy数组，
+    由orjson在C代码中序列化，不再逐个创建Python对象。
+    """
+    kind = series.dtype.kind
+    if kind in "iub" and isinstance(series.dtype, np.dtype):
+        values = series.to_numpy()
+        return np.ascontiguousarray(values) if passthrough else values.tolist()
+    if kind == "f" and isinstance(series.dtype, np.dtype):
+        values = series.to_numpy()
+        invalid = ~np.isfinite(values)
+        if not invalid.any():
+            return np.ascontiguousarray(values) if passthrough else values.tolist()
+        values = values.astype(object)
+        values[invalid] = None
+        return values.tolist()
+    if kind == "M" and isinstance(series.dtype, np.dtype):
+        strings = _datetime_strings(series.to_numpy())
+        if strings is not None:
+            return strings
+    # 字符串、分类、带时区的日期和可空扩展类型：转换为对象数组后一次性标记所有空值
+    values = series.to_numpy(dtype=object)
+    missing = pd.isna(values)
+    if missing.any():
+        values[missing] = None
+    return values.tolist()
+
+
+def _datetime_strings(values: np.ndarray) -> Optional[List[Optional[str]]]:
+    """将日期数组格式化为与str(pd.Timestamp)相同的字符串，精度超过微秒时返回None
+
+    在numpy中整列格式化，不为每个值创建Timestamp对象。
+    """
+    missing = np.isnat(values)
+    if missing.all():
+        return [None] * len(values)
+    ticks = values.astype("datetime64[ns]").view("i8")[~missing]
+    if not (ticks % 10**9).any():
+        unit = "s"
+    elif not (ticks % 10**3).any():
+        unit = "us"
+    else:
+        return None
+    strings = np.datetime_as_string(values, unit=unit)
+    # numpy输出ISO格式，将日期和时间之间的"T"替换为空格
+    width = strings.dtype.itemsize // 4
+    strings.view(np.uint32).reshape(len(strings), width)[:, 10] = ord(" ")
+    if not missing.any():
+        return strings.tolist()
+    result = strings.astype(object)
+    result[missing] = None
+    return result.tolist()
+
+
+def frame_to_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """将DataFrame转换为按行的字典列表，与to_dict(orient="records")相同但无需先逐元素清洗"""
+    columns = df.columns.tolist()
+    column_values = [_column_values(df.iloc[:, i]) for i in range(len(columns))]
+    return [dict(zip(columns, row)) for row in zip(*column_values)]
+
+
+def frame_to_columns(df: pd.DataFrame) -> Dict[str, Any]:
+    """将DataFrame转换为按列的值列表，数值列在使用orjson时不做逐元素转换"""
+    passthrough = orjson is not None
+    return {str(col): _column_values(df.iloc[:, i], passthrough) for i, col in enumerate(df.columns)}
+
+
+def frame_to_data(df: pd.DataFrame, orient: str = ORIENT_RECORDS) -> Any:
+    """按指定形式转换表格数据"""
+    if orient == ORIENT_COLUMNS:
+        return frame_to_columns(df)
+    return frame_to_records(df)
+
+
+def _default(obj: Any) -> Any:
+    """处理编码器不支持的类型"""
+    if isinstance(obj, pd.DataFrame):
+        return frame_to_records(obj)
+    if isinstance(obj, pd.Series):
+        return _column_values(obj)
+    if isinstance(obj, np.ndarray):
+        return _column_values(pd.Series(obj))
+    if obj is None or obj is pd.NA or obj is pd.NaT:
+        return None
+    if isinstance(obj, np.generic):
+        value = obj.item()
+        if isinstance(value, float) and not np.isfinite(value):
+            return None
+        return value
+    return str(obj)
+
+
+def _sanitize(data: Any) -> Any:
+    """递归将NaN和无穷值替换为None，仅在没有orjson时使用"""
+    if isinstance(data, dict):
+        return {k: _sanitize(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_sanitize(item) for item in data]
+    if isinstance(data, float) and (np.isnan(data) or np.isinf(data)):
+        return None
+    return data
+
+
+def dumps(content: Any) -> bytes:
+    """序列化为UTF-8编码的JSON，NaN和无穷值输出为null"""
+    if orjson is not None:
+        # orjson本身将NaN和无穷值输出为null，无需再遍历内容
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(_sanitize(content), ensure_ascii=False, allow_nan=False, default=_default).encode("utf-8")
+
+
+class CustomJSONResponse(JSONResponse):
+    """默认的JSON响应，表格数据中的NaN和无穷值输出为null"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
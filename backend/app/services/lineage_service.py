@@ -0,0 +1,128 @@
+import os
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import pandas as pd
+
+from app.services.dataframe_cache import dataframe_cache
+from app.services.file_service import UPLOAD_DIR, write_table_snapshot, read_table_snapshot
+from app.services.agent_service import save_processed_file, clear_processed_file
+from app.services.session_service import load_session, save_session, session_lock
+from app.services.cpu_pool import run_cpu
+
+logger = logging.getLogger("lineage_service")
+
+# 会话中保留的处理步骤数，更早的步骤无法再撤销回去
+CHAT_MAX_STEPS = int(os.getenv("CHAT_MAX_STEPS", 20))
+
+
+def get_current_step(session: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """返回会话当前所在的处理步骤，位于原始表时返回None"""
+    current = session.get("current_step", 0)
+    for step in session.get("steps", []):
+        if step["step"] == current:
+            return step
+    return None
+
+
+def _write_step(result_df: pd.DataFrame, file_id: str, step: int) -> str:
+    """保存步骤结果表，无法保存为Parquet时退回为pickle"""
+    return write_table_snapshot(result_df, os.path.join(UPLOAD_DIR, f"{file_id}_step_{step}"))
+
+
+def _get_step_file(step: Dict[str, Any]) -> str:
+    return os.path.join(UPLOAD_DIR, step["file"])
+
+
+def _remove_step_file(step: Dict[str, Any]) -> None:
+    path = _get_step_file(step)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def load_step_dataframe(file_id: str, step: Dict[str, Any]) -> pd.DataFrame:
+    """读取步骤结果表，优先使用进程内缓存
+
+    返回的DataFrame在请求之间共享，调用方不得原地修改。
+    """
+    cache_key = f"{file_id}_step_{step['step']}"
+    path = _get_step_file(step)
+    mtime = os.path.getmtime(path)
+    df = dataframe_cache.get(cache_key, mtime)
+    if df is None:
+        df = await run_cpu("parse", read_table_snapshot, path)
+        await run_cpu("cache", dataframe_cache.put, cache_key, mtime, df)
+    return df
+
+
+async def add_step(file_id: str, result_df: pd.DataFrame, exec_key: str, code: str) -> Dict[str, Any]:
+    """将代码执行结果记为新的处理步骤，并成为会话的当前步骤
+
+    当前步骤之后的步骤（撤销后留下的分支）会被丢弃。
+    """
+    # 在会话锁内编号，并发的执行不会得到相同的步骤号或覆盖彼此的步骤
+    async with session_lock(file_id):
+        session = load_session(file_id)
+        current = session.get("current_step", 0)
+        steps = session.get("steps", [])
+        for discarded in [step for step in steps if step["step"] > current]:
+            _remove_step_file(discarded)
+        steps = [step for step in steps if step["step"] <= current]
+
+        number = current + 1
+        path = await run_cpu("snapshot", _write_step, result_df, file_id, number)
+        # 结果表直接放入缓存，下一步执行时无需重新读取
+        await run_cpu("cache", dataframe_cache.put, f"{file_id}_step_{number}", os.path.getmtime(path), result_df)
+        step = {
+            "step": number,
+            "file": os.path.basename(path),
+            "exec_key": exec_key,
+            "code": code,
+            "columns": [str(col) for col in result_df.columns],
+            "rows_count": len(result_df),
+            "created_at": datetime.now().isoformat(),
+        }
+        steps.append(step)
+
+        # 超出保留数量时删除最早的步骤
+        while len(steps) > CHAT_MAX_STEPS:
+            _remove_step_file(steps.pop(0))
+
+        session["steps"] = steps
+        session["current_step"] = number
+        save_session(session)
+    return step
+
+
+async def undo_to_step(file_id: str, step_number: Optional[int] = None) -> Dict[str, Any]:
+    """回到指定的处理步骤（默认回到上一步），0表示回到原始表，返回更新后的会话"""
+    async with session_lock(file_id):
+        session = load_session(file_id)
+        current = session.get("current_step", 0)
+        steps = session.get("steps", [])
+        if step_number is None:
+            earlier = [step["step"] for step in steps if step["step"] < current]
+            step_number = earlier[-1] if earlier else 0
+
+        if step_number == 0:
+            await clear_processed_file(file_id)
+        else:
+            target = next((step for step in steps if step["step"] == step_number), None)
+            if target is None:
+                raise ValueError(f"处理步骤不存在: {step_number}")
+            # 处理结果文件与当前步骤保持一致，导出时得到撤销后的结果
+            await save_processed_file(await load_step_dataframe(file_id, target), file_id, target["exec_key"])
+
+        session["current_step"] = step_number
+        save_session(session)
+    logger.info(f"会话 {file_id} 已回到第 {step_number} 步")
+    return session
+
+
+def describe_steps(session: Dict[str, Any]) -> Dict[str, Any]:
+    """整理会话的处理步骤信息"""
+    steps: List[Dict[str, Any]] = [
+        {key: step[key] for key in ("step", "code", "columns", "rows_count", "created_at")}
+        for step in session.get("steps", [])
+    ]
+    return {"file_id": session["file_id"], "current_step": session.get("current_step", 0), "steps": steps}
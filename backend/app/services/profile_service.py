@@ -0,0 +1,142 @@
+import os
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+import pandas as pd
+import numpy as np
+
+from app.services.blob_store import read_ref, BLOB_DIR
+from app.services.file_service import UPLOAD_DIR, load_dataframe, sanitize_frame, get_cache_key
+from app.services.cpu_pool import run_cpu
+from app.services.dtype_service import dtype_name, get_executor_dtype
+
+logger = logging.getLogger("profile_service")
+
+# 常见值统计保留的个数
+TOP_K_VALUES = 5
+# 样例数据行数
+SAMPLE_ROWS = 5
+
+# 表格概况的版本，旧版本（数据类型为服务进程中的category）的概况在读取时重新计算
+PROFILE_VERSION = 2
+
+# 内存中保留的表格概况条数
+PROFILE_CACHE_MAX_ENTRIES = 256
+
+# 缓存键 -> 表格概况
+_profile_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def get_profile_path(file_id: str) -> str:
+    """获取表格概况的保存路径，内容相同的文件共享同一份概况"""
+    content_hash = read_ref(file_id)
+    if content_hash:
+        return os.path.join(BLOB_DIR, f"{content_hash}.profile.json")
+    return os.path.join(UPLOAD_DIR, f"{file_id}.profile.json")
+
+
+def _to_json_value(value: Any) -> Any:
+    """将numpy/pandas标量转换为可JSON序列化的值"""
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isinf(value):
+        return None
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def build_table_profile(df: pd.DataFrame) -> Dict[str, Any]:
+    """计算表格概况：数据类型、缺失值、唯一值个数、取值范围、常见值和样例数据
+
+    数据类型为生成的代码在执行进程中看到的类型，category列报告为Arrow字符串。
+    """
+    column_stats: Dict[str, Dict[str, Any]] = {}
+    for col in df.columns:
+        series = df[col]
+        stats: Dict[str, Any] = {"unique": int(series.nunique(dropna=True))}
+        is_number = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+        if is_number or pd.api.types.is_datetime64_any_dtype(series):
+            stats["min"] = _to_json_value(series.min())
+            stats["max"] = _to_json_value(series.max())
+        else:
+            top_values = series.value_counts(dropna=True).head(TOP_K_VALUES)
+            stats["top_values"] = [[_to_json_value(value), int(count)] for value, count in top_values.items()]
+        column_stats[str(col)] = stats
+
+    return {
+        "version": PROFILE_VERSION,
+        "columns": [str(col) for col in df.columns],
+        "dtypes": {str(col): get_executor_dtype(dtype_name(df[col].dtype)) for col in df.columns},
+        "shape": [int(df.shape[0]), int(df.shape[1])],
+        "missing_values": {str(col): int(count) for col, count in df.isna().sum().items()},
+        "column_stats": column_stats,
+        "sample_data": sanitize_frame(df.head(SAMPLE_ROWS)).to_dict(orient="records"),
+    }
+
+
+async def get_table_profile(file_id: str, df: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+    """获取文件的表格概况，优先使用已保存的结果，不存在时计算一次并保存"""
+    cache_key = get_cache_key(file_id)
+    profile_path = get_profile_path(file_id)
+
+    profile = _profile_cache.get(cache_key)
+    if profile is not None and os.path.exists(profile_path):
+        _profile_cache.move_to_end(cache_key)
+        return profile
+
+    if os.path.exists(profile_path):
+        try:
+            with open(profile_path, "r", encoding="utf-8") as f:
+                profile = json.load(f)
+            if profile.get("version") == PROFILE_VERSION:
+                _remember(cache_key, profile)
+                return profile
+            logger.info(f"表格概况版本过旧，将重新计算 {profile_path}")
+        except Exception as e:
+            logger.warning(f"读取表格概况失败，将重新计算 {profile_path}: {str(e)}")
+
+    if df is None:
+        df = await load_dataframe(file_id)
+    profile = await run_cpu("profile", build_table_profile, df)
+
+    # 先写入临时文件再重命名，避免其他进程读取到不完整的内容
+    tmp_path = f"{profile_path}.{file_id}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, profile_path)
+        logger.info(f"已保存表格概况: {profile_path}")
+    except Exception as e:
+        logger.error(f"保存表格概况失败 {profile_path}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _remember(cache_key, profile)
+    return profile
+
+
+def describe_column_stats(profile: Dict[str, Any]) -> List[str]:
+    """将列统计信息整理为提示词中的文本行"""
+    lines = []
+    for col, stats in profile.get("column_stats", {}).items():
+        parts = [f"唯一值{stats['unique']}个"]
+        if "min" in stats:
+            parts.append(f"范围 {stats['min']} ~ {stats['max']}")
+        if stats.get("top_values"):
+            top_values = ", ".join(f"{value}({count})" for value, count in stats["top_values"])
+            parts.append(f"常见值: {top_values}")
+        lines.append(f"  - {col}: {'; '.join(parts)}")
+    return lines
+
+
+def _remember(cache_key: str, profile: Dict[str, Any]) -> None:
+    _profile_cache[cache_key] = profile
+    _profile_cache.move_to_end(cache_key)
+    while len(_profile_cache) > PROFILE_CACHE_MAX_ENTRIES:
+        _profile_cache.popitem(last=False)
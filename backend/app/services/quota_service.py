@@ -0,0 +1,155 @@
+import os
+import logging
+import threading
+import ipaddress
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Union
+import pandas as pd
+from fastapi import Request
+
+logger = logging.getLogger("quota_service")
+
+# 每个客户端可保存的上传文件总字节数，默认1GB，0为不限制
+QUOTA_CLIENT_MAX_BYTES = int(os.getenv("QUOTA_CLIENT_MAX_BYTES", 1024 * 1024 * 1024))
+# 单个表格的最大行数和单元格数，0为不限制
+QUOTA_MAX_ROWS = int(os.getenv("QUOTA_MAX_ROWS", 5_000_000))
+QUOTA_MAX_CELLS = int(os.getenv("QUOTA_MAX_CELLS", 100_000_000))
+# 代码执行结果（处理结果文件）在内存中的最大字节数，默认256MB，0为不限制
+QUOTA_MAX_RESULT_BYTES = int(os.getenv("QUOTA_MAX_RESULT_BYTES", 256 * 1024 * 1024))
+
+# 客户端标识的最大长度
+CLIENT_ID_MAX_LENGTH = 128
+# 可信反向代理的地址或网段（逗号分隔），只有来自这些地址的请求才使用X-Client-Id和X-Forwarded-For请求头
+QUOTA_TRUSTED_PROXIES = os.getenv("QUOTA_TRUSTED_PROXIES", "")
+
+# 各类配额被拒绝的次数
+_rejections: Dict[str, int] = defaultdict(int)
+_lock = threading.Lock()
+
+
+class QuotaExceededError(Exception):
+    """请求超出资源配额
+
+    超出单次请求的大小限制时状态码为413，客户端存储空间已满时为507。
+    """
+
+    def __init__(self, quota: str, message: str, limit: int, actual: int, status_code: int = 413):
+        super().__init__(message)
+        self.quota = quota
+        self.limit = limit
+        self.actual = actual
+        self.status_code = status_code
+        with _lock:
+            _rejections[quota] += 1
+        logger.warning(f"超出配额 {quota}: {actual} > {limit}")
+
+    def to_detail(self) -> Dict[str, Any]:
+        """返回结构化的错误信息"""
+        return {
+            "error": "quota_exceeded",
+            "quota": self.quota,
+            "message": str(self),
+            "limit": self.limit,
+            "actual": self.actual,
+        }
+
+
+def _parse_trusted_proxies(value: str) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning(f"忽略无效的可信代理地址: {item}")
+    return networks
+
+
+_trusted_proxies = _parse_trusted_proxies(QUOTA_TRUSTED_PROXIES)
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in _trusted_proxies)
+
+
+def get_client_id(request: Request) -> str:
+    """获取客户端标识，默认使用连接的对端地址
+
+    请求由可信反向代理转发时，优先使用代理设置的X-Client-Id请求头，
+    否则从X-Forwarded-For中由近及远取第一个不是可信代理的地址。客户端可以伪造这些请求头，
+    因此直接连接的请求不使用它们。
+    """
+    host = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(host):
+        return host
+
+    client_id = request.headers.get("x-client-id", "").strip()
+    if client_id:
+        return client_id[:CLIENT_ID_MAX_LENGTH]
+    forwarded_for = [addr.strip() for addr in request.headers.get("x-forwarded-for", "").split(",") if addr.strip()]
+    for addr in reversed(forwarded_for):
+        if not _is_trusted_proxy(addr):
+            return addr[:CLIENT_ID_MAX_LENGTH]
+    return forwarded_for[0][:CLIENT_ID_MAX_LENGTH] if forwarded_for else host
+
+
+def get_storage_budget(used_bytes: int) -> Optional[int]:
+    """返回客户端还能保存的字节数，不限制时返回None"""
+    if QUOTA_CLIENT_MAX_BYTES <= 0:
+        return None
+    return QUOTA_CLIENT_MAX_BYTES - used_bytes
+
+
+def raise_storage_exceeded(used_bytes: int, incoming_bytes: int) -> None:
+    raise QuotaExceededError(
+        "client_bytes",
+        f"存储空间不足: 已使用 {used_bytes // (1024 * 1024)}MB, 上限 {QUOTA_CLIENT_MAX_BYTES // (1024 * 1024)}MB",
+        QUOTA_CLIENT_MAX_BYTES,
+        used_bytes + incoming_bytes,
+        status_code=507,
+    )
+
+
+def check_table_size(rows: int, columns: int, label: str = "表格") -> None:
+    """检查表格的行数和单元格数"""
+    if QUOTA_MAX_ROWS > 0 and rows > QUOTA_MAX_ROWS:
+        raise QuotaExceededError("max_rows", f"{label}行数 {rows} 超过上限 {QUOTA_MAX_ROWS}", QUOTA_MAX_ROWS, rows)
+    cells = rows * columns
+    if QUOTA_MAX_CELLS > 0 and cells > QUOTA_MAX_CELLS:
+        raise QuotaExceededError("max_cells", f"{label}单元格数 {cells} 超过上限 {QUOTA_MAX_CELLS}",
+                                 QUOTA_MAX_CELLS, cells)
+
+
+def check_result_size(result_df: pd.DataFrame) -> None:
+    """检查代码执行结果的大小"""
+    check_table_size(len(result_df), len(result_df.columns), "处理结果")
+    if QUOTA_MAX_RESULT_BYTES > 0:
+        size = int(result_df.memory_usage(deep=True).sum())
+        if size > QUOTA_MAX_RESULT_BYTES:
+            raise QuotaExceededError(
+                "max_result_bytes",
+                f"处理结果占用 {size // (1024 * 1024)}MB, 超过上限 {QUOTA_MAX_RESULT_BYTES // (1024 * 1024)}MB",
+                QUOTA_MAX_RESULT_BYTES,
+                size,
+            )
+
+
+def quota_stats() -> Dict[str, Any]:
+    """返回配额设置和被拒绝的次数"""
+    with _lock:
+        rejections = dict(_rejections)
+    return {
+        "limits": {
+            "client_bytes": QUOTA_CLIENT_MAX_BYTES,
+            "max_rows": QUOTA_MAX_ROWS,
+            "max_cells": QUOTA_MAX_CELLS,
+            "max_result_bytes": QUOTA_MAX_RESULT_BYTES,
+        },
+        "rejections": rejections,
+    }
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("response_cache")
+
+# 进程内缓存的AI回复条数
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024))
+# 缓存的有效期（秒），0表示不使用缓存
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 24 * 3600))
+# 多个工作进程共享的SQLite缓存文件，为空时只使用进程内缓存
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "")
+
+# 问题末尾不影响含义的标点
+_TRAILING_PUNCTUATION = "?？.。!！~～"
+
+
+def normalize_question(message: str) -> str:
+    """规范化用户问题：统一全角/半角和大小写，合并空白，去掉末尾标点"""
+    text = unicodedata.normalize("NFKC", message).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION).strip()
+
+
+def build_response_cache_key(model: str, df_info: Dict[str, Any], history: List[Any], message: str) -> str:
+    """根据模型、表结构（列名和数据类型）、历史消息和规范化后的问题计算缓存键
+
+    只使用表结构而不使用数据内容，结构相同的不同文件可以复用生成的代码。
+    """
+    schema = [[col, df_info["dtypes"].get(col)] for col in df_info["columns"]]
+    history_items = [[msg.role, msg.content] for msg in history]
+    payload = json.dumps(
+        [model, schema, history_items, normalize_question(message)],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """缓存AI针对相同问题和表结构生成的回复，按TTL过期并按LRU淘汰
+
+    配置了SQLite文件时，条目同时写入SQLite，所有工作进程共享命中结果。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        # key -> (写入时间, AI回复)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def _get_db(self) -> Optional[sqlite3.Connection]:
+        """打开SQLite连接，失败时退回为只使用进程内缓存"""
+        if not self.db_path:
+            return None
+        if self._db is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+                db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_response_cache ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_llm_response_cache_accessed "
+                    "ON llm_response_cache (accessed_at)"
+                )
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                logger.error(f"打开AI回复缓存数据库失败 {self.db_path}: {str(e)}")
+                self.db_path = ""
+                return None
+        return self._db
+
+    def get(self, key: str) -> Optional[str]:
+        """获取缓存的AI回复，已过期时视为未命中"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+
+            db = self._get_db()
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT response, created_at FROM llm_response_cache WHERE key = ? AND created_at >= ?",
+                        (key, now - self.ttl),
+                    ).fetchone()
+                    if row is not None:
+                        db.execute("UPDATE llm_response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                        db.commit()
+                        self._remember(key, row[1], row[0])
+                        self.hits += 1
+                        return row[0]
+                except sqlite3.Error as e:
+                    logger.warning(f"读取AI回复缓存失败: {str(e)}")
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        """放入缓存，超出条数上限时淘汰最久未使用的条目"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            db = self._get_db()
+            if db is None:
+                return
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO llm_response_cache (key, response, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, response, now, now),
+                )
+                db.execute("DELETE FROM llm_response_cache WHERE created_at < ?", (now - self.ttl,))
+                db.execute(
+                    "DELETE FROM llm_response_cache WHERE key NOT IN ("
+                    "SELECT key FROM llm_response_cache ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"写入AI回复缓存失败: {str(e)}")
+
+    async def aget(self, key: str) -> Optional[str]:
+        """在事件循环中获取缓存的AI回复，使用SQLite时在线程池中查询"""
+        if not self.db_path:
+            return self.get(key)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aput(self, key: str, response: str) -> None:
+        """在事件循环中放入缓存，使用SQLite时在线程池中写入"""
+        if not self.db_path:
+            self.put(key, response)
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, response)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            db = self._get_db()
+            if db is not None:
+                db.execute("DELETE FROM llm_response_cache")
+                db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "shared": bool(self.db_path),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remember(self, key: str, created_at: float, response: str) -> None:
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# 进程内共享的AI回复缓存
+llm_response_cache = ResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_DB)
@@ -0,0 +1,103 @@
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger("result_writer")
+
+
+class ResultWriter:
+    """在专用的后台线程中按提交顺序执行写入任务，调用方无需等待写入完成
+
+    同一key尚未开始的任务会被之后提交的任务替换，只写入最新的数据；
+    正在执行的任务不受影响，新任务在它之后执行。
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        # key -> (写入函数, 标签)，尚未开始执行的任务
+        self._jobs: Dict[str, Tuple[Callable[[], None], Optional[str]]] = {}
+        # 正在执行的任务的 (key, 标签)
+        self._running: Optional[Tuple[str, Optional[str]]] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.submitted = 0
+        self.completed = 0
+        self.superseded = 0
+        self.failed = 0
+        self.write_seconds = 0.0
+
+    def _ensure_thread(self) -> None:
+        # 首次提交时才启动线程，gunicorn的工作进程在fork之后各自启动
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, key: str, write: Callable[[], None], tag: Optional[str] = None) -> None:
+        """提交写入任务，tag用于判断待写入的是否已是相同的数据"""
+        with self._lock:
+            self.submitted += 1
+            if key in self._jobs:
+                self.superseded += 1
+            else:
+                self._queue.put(key)
+            self._jobs[key] = (write, tag)
+            self._ensure_thread()
+
+    def get_pending(self, key: str) -> Tuple[bool, Optional[str]]:
+        """返回key是否有尚未完成的写入，以及最新任务的标签"""
+        with self._lock:
+            if key in self._jobs:
+                return True, self._jobs[key][1]
+            if self._running is not None and self._running[0] == key:
+                return True, self._running[1]
+        return False, None
+
+    def _run(self) -> None:
+        while True:
+            key = self._queue.get()
+            if key is None:
+                break
+            with self._lock:
+                job = self._jobs.pop(key, None)
+                if job is None:
+                    continue
+                self._running = (key, job[1])
+            started = time.perf_counter()
+            try:
+                job[0]()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"后台写入失败 {key}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._running = None
+                    self.write_seconds += time.perf_counter() - started
+
+    def close(self, timeout: float = 30) -> None:
+        """写完已提交的任务后停止线程"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"后台写入在 {timeout} 秒内未完成，剩余 {self._queue.qsize()} 个任务")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回后台写入统计"""
+        with self._lock:
+            pending = len(self._jobs) + (1 if self._running is not None else 0)
+        return {
+            "pending": pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "superseded": self.superseded,
+            "failed": self.failed,
+            "write_seconds": round(self.write_seconds, 3),
+        }
+
+
+# 进程内共享的后台写入线程
+result_writer = ResultWriter()
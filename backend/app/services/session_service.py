@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import uuid
+import asyncio
+import logging
+import weakref
+from pathlib import Path
+from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl 模块，只在进程内加锁
+    fcntl = None
+
+from app.models.chat_models import ChatMessage
+
+logger = logging.getLogger("session_service")
+
+# 获取根目录位置
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+
+# 会话历史的token预算（估算值），超出后压缩较早的对话
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", 4000))
+# 压缩后保留的历史占预算的比例。一次压缩到预算以下较多，之后多轮对话的前缀保持不变，便于模型服务复用提示词缓存
+CHAT_HISTORY_COMPACT_RATIO = 0.5
+# 摘要中保留的较早问题条数
+SUMMARY_MAX_QUESTIONS = 20
+
+# 等待其他工作进程释放会话锁时的检查间隔（秒）
+SESSION_LOCK_POLL_INTERVAL = 0.02
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数：中日韩字符每个约一个token，其余字符约四个一个token"""
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def get_session_path(file_id: str) -> str:
+    """获取会话记录文件路径，会话随文件一起被清理"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_session.json")
+
+
+def get_session_lock_path(file_id: str) -> str:
+    """会话的锁文件，修改会话的工作进程在读取前加锁"""
+    return os.path.join(UPLOAD_DIR, f"{file_id}_session.lock")
+
+
+# file_id -> 进程内的会话锁，没有协程使用时自动释放
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+# file_id -> 持有会话锁的任务
+_session_lock_owners: Dict[str, "asyncio.Task"] = {}
+
+
+@asynccontextmanager
+async def session_lock(file_id: str) -> AsyncIterator[None]:
+    """修改会话期间持有的锁，读取、修改和保存会话都应在锁内完成
+
+    进程内的协程使用asyncio.Lock排队，工作进程之间使用锁文件上的flock互斥。
+    同一任务已持有锁时（如执行代码期间记录新步骤）直接进入。
+    """
+    task = asyncio.current_task()
+    if _session_lock_owners.get(file_id) is task:
+        yield
+        return
+    lock = _session_locks.get(file_id)
+    if lock is None:
+        lock = _session_locks[file_id] = asyncio.Lock()
+    async with lock:
+        if fcntl is None:
+            _session_lock_owners[file_id] = task
+            try:
+                yield
+            finally:
+                _session_lock_owners.pop(file_id, None)
+            return
+        with open(get_session_lock_path(file_id), "a") as lock_file:
+            # 非阻塞地轮询，等待其他进程时不占用事件循环和线程
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    await asyncio.sleep(SESSION_LOCK_POLL_INTERVAL)
+            _session_lock_owners[file_id] = task
+            try:
+                yield
+            finally:
+                _session_lock_owners.pop(file_id, None)
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _new_session(file_id: str) -> Dict[str, Any]:
+    now = datetime.now().isoformat()
+    return {"file_id": file_id, "summary": None, "summary_questions": [], "history": [],
+            "steps": [], "current_step": 0, "created_at": now, "updated_at": now}
+
+
+def load_session(file_id: str) -> Dict[str, Any]:
+    """读取文件的会话记录，不存在时返回空会话"""
+    try:
+        with open(get_session_path(file_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _new_session(file_id)
+    except json.JSONDecodeError as e:
+        logger.error(f"会话记录损坏，将重新开始会话 {file_id}: {str(e)}")
+        return _new_session(file_id)
+
+
+def save_session(session: Dict[str, Any]) -> None:
+    """保存会话记录（写入临时文件后重命名，保证读取到的记录完整）"""
+    session["updated_at"] = datetime.now().isoformat()
+    session_path = get_session_path(session["file_id"])
+    tmp_path = f"{session_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, session_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def reset_session(file_id: str) -> None:
+    """清空文件的会话及其处理步骤"""
+    async with session_lock(file_id):
+        _remove_session_files(file_id)
+
+
+def _remove_session_files(file_id: str) -> None:
+    for path in [Path(get_session_path(file_id))] + list(Path(UPLOAD_DIR).glob(f"{file_id}_step_*")):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def get_session_history(session: Dict[str, Any]) -> List[ChatMessage]:
+    """返回会话中保留的历史消息"""
+    return [ChatMessage(**msg) for msg in session["history"]]
+
+
+def _compact(session: Dict[str, Any]) -> None:
+    """历史超出预算时移除最早的若干轮对话，并将其中的问题记入摘要"""
+    history = session["history"]
+    total = sum(estimate_tokens(msg["content"]) for msg in history)
+    if total <= CHAT_HISTORY_MAX_TOKENS:
+        return
+
+    target = CHAT_HISTORY_MAX_TOKENS * CHAT_HISTORY_COMPACT_RATIO
+    dropped_questions = []
+    # 按轮（用户消息及其后的回复）移除，至少保留最近一轮
+    while total > target and len(history) > 2:
+        msg = history.pop(0)
+        total -= estimate_tokens(msg["content"])
+        if msg["role"] == "user":
+            dropped_questions.append(msg["content"])
+        while history and history[0]["role"] != "user" and len(history) > 2:
+            total -= estimate_tokens(history.pop(0)["content"])
+
+    if dropped_questions:
+        earlier = session.get("summary_questions", []) + dropped_questions
+        session["summary_questions"] = earlier[-SUMMARY_MAX_QUESTIONS:]
+        session["summary"] = "更早的对话中用户依次提出过以下需求:\n" + "\n".join(
+            f"- {question}" for question in session["summary_questions"]
+        )
+        logger.info(f"会话 {session['file_id']} 的历史已压缩，移除了 {len(dropped_questions)} 轮对话")
+
+
+async def append_session_turn(file_id: str, message: str, response: str) -> Dict[str, Any]:
+    """将一轮对话记入会话，超出预算时压缩较早的历史"""
+    async with session_lock(file_id):
+        # 在锁内重新读取最新的会话，其他请求或工作进程可能刚刚写入过
+        session = load_session(file_id)
+        session["history"].append({"role": "user", "content": message})
+        session["history"].append({"role": "assistant", "content": response})
+        _compact(session)
+        save_session(session)
+    return session
@@ -0,0 +1,92 @@
+"""比较表格JSON序列化的旧路径与向量化路径的耗时
+
+用法（在backend目录下）: python benchmarks/json_serializer_benchmark.py [行数 ...]
+"""
+import os
+import sys
+import json
+import time
+from typing import Any, Callable, List
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.file_service import sanitize_frame  # noqa: E402
+from app.services.json_serializer import dumps, frame_to_records, frame_to_columns, orjson  # noqa: E402
+
+REPEAT = 5
+
+
+def legacy_render(content: Any) -> bytes:
+    """原CustomJSONResponse.render的实现"""
+    def json_safe_default(obj):
+        if pd.isna(obj) or obj is pd.NA or obj is None:
+            return None
+        if isinstance(obj, float) and (np.isnan(obj) or np.isinf(obj)):
+            return None
+        return str(obj)
+
+    def sanitize_content(data):
+        if isinstance(data, dict):
+            return {k: sanitize_content(v) for k, v in data.items()}
+        elif isinstance(data, list):
+            return [sanitize_content(item) for item in data]
+        elif isinstance(data, float) and (np.isnan(data) or np.isinf(data)):
+            return None
+        return data
+
+    return json.dumps(sanitize_content(content), ensure_ascii=False, allow_nan=False,
+                      default=json_safe_default).encode("utf-8")
+
+
+def build_frame(rows: int) -> pd.DataFrame:
+    """构造与test.csv类似、含缺失值和无穷值的表格"""
+    rng = np.random.default_rng(0)
+    income = rng.normal(15000, 3000, rows)
+    income[::17] = np.nan
+    income[::101] = np.inf
+    names = np.array(["张三", "李四", "王五", "赵六", None], dtype=object)
+    return pd.DataFrame({
+        "姓名": names[rng.integers(0, len(names), rows)],
+        "年龄": rng.integers(18, 65, rows),
+        "职业": pd.Categorical(rng.choice(["程序员", "设计师", "教师", "医生"], rows)),
+        "收入": income,
+        "入职日期": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 2000, rows), unit="D"),
+    })
+
+
+def timeit(func: Callable[[], bytes]) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(sizes: List[int]) -> None:
+    print(f"编码器: {'orjson ' + orjson.__version__ if orjson else '标准库json'}, 每项取{REPEAT}次中的最短耗时")
+    print(f"{'行数':>8} {'旧路径(ms)':>12} {'records(ms)':>12} {'columns(ms)':>12} {'加速比':>8}")
+    for rows in sizes:
+        df = build_frame(rows)
+
+        def legacy() -> bytes:
+            return legacy_render({"data": sanitize_frame(df).to_dict(orient="records")})
+
+        def records() -> bytes:
+            return dumps({"data": frame_to_records(df)})
+
+        def columns() -> bytes:
+            return dumps({"data": frame_to_columns(df)})
+
+        # 两条路径输出的数据必须一致
+        assert json.loads(legacy()) == json.loads(records())
+        legacy_time, records_time, columns_time = timeit(legacy), timeit(records), timeit(columns)
+        print(f"{rows:>8} {legacy_time * 1000:>12.2f} {records_time * 1000:>12.2f} "
+              f"{columns_time * 1000:>12.2f} {legacy_time / records_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [20, 1000, 100000])
@@ -0,0 +1,45 @@
+import os
+import sys
+from typing import Callable, Iterator, List
+
+import pytest
+
+# 测试从backend目录导入app包
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+
+SAMPLE_CSV = (
+    "姓名,年龄,职业,收入\n"
+    "张三,28,程序员,15000\n"
+    "李四,35,设计师,12000\n"
+    "王五,42,经理,25000\n"
+    "赵六,23,学生,5000\n"
+    "钱七,31,销售,18000\n"
+).encode("utf-8")
+
+
+@pytest.fixture(scope="session")
+def client() -> Iterator[TestClient]:
+    """整个测试会话共用一个应用实例，启动和关闭时执行应用的lifespan"""
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def upload(client: TestClient) -> Iterator[Callable[..., str]]:
+    """上传表格并返回file_id，测试结束后删除上传的文件"""
+    file_ids: List[str] = []
+
+    def _upload(content: bytes = SAMPLE_CSV, filename: str = "sample.csv") -> str:
+        response = client.post("/api/files/upload", files={"file": (filename, content, "text/csv")})
+        assert response.status_code == 200, response.text
+        file_ids.append(response.json()["file_id"])
+        return file_ids[-1]
+
+    yield _upload
+    for file_id in file_ids:
+        client.delete(f"/api/files/{file_id}")
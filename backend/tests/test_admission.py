@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from app.services.admission_service import AdmissionController, AdmissionRejected, chat_admission
+
+
+def _controller(max_concurrency: int = 1, max_per_key: int = 1, max_queue: int = 4,
+                queue_timeout: float = 1.0) -> AdmissionController:
+    return AdmissionController(max_concurrency, max_per_key, max_queue, queue_timeout)
+
+
+def test_waiters_are_admitted_in_order_after_release():
+    async def scenario():
+        controller = _controller()
+        started = await controller.acquire("a")
+        order = []
+
+        async def wait(key: str):
+            await controller.acquire(key)
+            order.append(key)
+
+        waiters = [asyncio.create_task(wait(key)) for key in ("b", "c")]
+        await asyncio.sleep(0)
+        assert controller.stats()["queue_depth"] == 2
+
+        controller.release("a", started)
+        # 许可在release时直接交给队首的请求
+        assert controller.stats()["queue_depth"] == 1
+        await asyncio.wait_for(waiters[0], 1)
+        assert order == ["b"]
+        assert not waiters[1].done()
+        controller.release("b")
+        await asyncio.wait_for(waiters[1], 1)
+        assert order == ["b", "c"]
+        assert controller.stats()["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def scenario():
+        controller = _controller(max_queue=1)
+        await controller.acquire("a")
+        waiter = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await controller.acquire("c")
+        assert excinfo.value.retry_after >= 1
+        assert controller.stats()["rejected"] == 1
+
+        controller.release("a")
+        await waiter
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue():
+    async def scenario():
+        controller = _controller(queue_timeout=0.05)
+        await controller.acquire("a")
+
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await controller.acquire("b")
+        assert excinfo.value.retry_after >= 1
+        stats = controller.stats()
+        assert stats["timed_out"] == 1
+        assert stats["queue_depth"] == 0
+        assert stats["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        controller = _controller()
+        await controller.acquire("a")
+        waiter = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.stats()["queue_depth"] == 0
+        controller.release("a")
+        assert controller.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_per_key_limit_does_not_block_other_keys():
+    async def scenario():
+        controller = _controller(max_concurrency=2, max_per_key=1)
+        await controller.acquire("a")
+        same_key = asyncio.create_task(controller.acquire("a"))
+        await asyncio.sleep(0)
+
+        # 另一个文件的请求不需要排在同一文件的请求后面
+        await asyncio.wait_for(controller.acquire("b"), 0.1)
+        assert not same_key.done()
+
+        controller.release("b")
+        await asyncio.sleep(0)
+        assert not same_key.done()
+        controller.release("a")
+        await same_key
+
+    asyncio.run(scenario())
+
+
+def test_releaser_releases_only_once():
+    async def scenario():
+        controller = _controller(max_concurrency=2, max_per_key=2)
+        await controller.acquire("a")
+        started = await controller.acquire("a")
+        release = controller.releaser("a", started)
+
+        release()
+        release()
+        assert controller.stats()["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_chat_endpoint_returns_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(chat_admission, "max_concurrency", 0)
+    monkeypatch.setattr(chat_admission, "max_queue", 0)
+
+    response = client.post("/api/chat/00000000-0000-0000-0000-000000000000", json={"message": "hi"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,50 @@
+import os
+from pathlib import Path
+
+from app.services.blob_store import BLOB_DIR, get_blob_path, get_ref_count, read_ref, release_blob
+from app.services.file_cleanup_service import purge_file
+
+from conftest import SAMPLE_CSV
+
+
+def _blob_files(content_hash: str):
+    return sorted(path.name for path in Path(BLOB_DIR).glob(f"{content_hash}*"))
+
+
+def test_identical_uploads_share_one_blob(upload):
+    first = upload()
+    second = upload()
+
+    content_hash = read_ref(first)
+    assert content_hash is not None
+    assert read_ref(second) == content_hash
+    assert get_ref_count(content_hash) == 2
+    assert os.path.exists(get_blob_path(content_hash, ".csv"))
+
+
+def test_different_content_gets_its_own_blob(upload):
+    first = upload()
+    second = upload(SAMPLE_CSV + "孙八,29,教师,9000\n".encode("utf-8"))
+
+    assert read_ref(first) != read_ref(second)
+
+
+def test_blob_is_kept_until_the_last_reference_is_purged(client, upload):
+    first = upload()
+    second = upload()
+    content_hash = read_ref(first)
+
+    # 仍有引用时不会释放
+    assert release_blob(content_hash) is False
+
+    purge_file(first)
+    assert get_ref_count(content_hash) == 1
+    assert _blob_files(content_hash)
+    assert client.get(f"/api/files/preview/{second}").status_code == 200
+
+    response = client.delete(f"/api/files/{second}")
+    assert response.status_code == 200
+    assert get_ref_count(content_hash) == 0
+    # 原始文件及其派生的列式副本、类型方案和概况一并删除
+    assert _blob_files(content_hash) == []
+    assert not list(Path(BLOB_DIR).parent.glob(f"{second}*"))
@@ -0,0 +1,82 @@
+import pandas as pd
+
+from app.services.dataframe_cache import DataFrameCache
+
+
+def _frame(rows: int = 1000) -> pd.DataFrame:
+    return pd.DataFrame({"a": range(rows), "b": [float(i) for i in range(rows)]})
+
+
+def _size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def test_evicts_least_recently_used_when_over_byte_budget():
+    df = _frame()
+    size = _size(df)
+    cache = DataFrameCache(max_bytes=int(size * 2.5))
+
+    cache.put("a", 1.0, df)
+    cache.put("b", 1.0, df)
+    # 访问a后b成为最久未使用的条目
+    assert cache.get("a", 1.0) is df
+    cache.put("c", 1.0, df)
+
+    assert cache.get("b", 1.0) is None
+    assert cache.get("a", 1.0) is df
+    assert cache.get("c", 1.0) is df
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] == size * 2
+    assert stats["evictions"] == 1
+
+
+def test_evicts_as_many_entries_as_needed_for_a_large_frame():
+    small = _frame(100)
+    large = _frame(1000)
+    cache = DataFrameCache(max_bytes=_size(large) + _size(small))
+
+    for key in ("a", "b", "c"):
+        cache.put(key, 1.0, small)
+    cache.put("large", 1.0, large)
+
+    assert cache.get("large", 1.0) is large
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.stats()["evictions"] == 2
+
+
+def test_frame_larger_than_budget_is_not_cached():
+    df = _frame()
+    cache = DataFrameCache(max_bytes=_size(df) - 1)
+
+    cache.put("a", 1.0, df)
+
+    assert cache.get("a", 1.0) is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_replacing_an_entry_does_not_double_count_bytes():
+    df = _frame()
+    cache = DataFrameCache(max_bytes=_size(df) * 10)
+
+    cache.put("a", 1.0, df)
+    cache.put("a", 2.0, df)
+
+    assert cache.stats()["bytes"] == _size(df)
+    assert cache.get("a", 1.0) is None
+    assert cache.get("a", 2.0) is df
+
+
+def test_invalidate_removes_derived_entries_only():
+    df = _frame(10)
+    cache = DataFrameCache(max_bytes=_size(df) * 10)
+    for key in ("f1", "f1_processed", "f1_step_1", "f10"):
+        cache.put(key, 1.0, df)
+
+    cache.invalidate("f1")
+
+    assert cache.get("f1", 1.0) is None
+    assert cache.get("f1_processed", 1.0) is None
+    assert cache.get("f1_step_1", 1.0) is None
+    assert cache.get("f10", 1.0) is df
+    assert cache.stats()["bytes"] == _size(df)
@@ -0,0 +1,102 @@
+import pandas as pd
+
+from app.services.agent_service import save_processed_file
+
+from conftest import SAMPLE_CSV
+
+
+def _export(client, file_id: str, headers=None, **params):
+    return client.get(f"/api/files/export/{file_id}", params=params, headers=headers or {})
+
+
+def test_original_file_is_sent_with_etag(client, upload):
+    file_id = upload()
+
+    response = _export(client, file_id)
+
+    assert response.status_code == 200
+    assert response.content == SAMPLE_CSV
+    assert response.headers["ETag"].startswith('"')
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+
+def test_matching_if_none_match_returns_304(client, upload):
+    file_id = upload()
+    etag = _export(client, file_id).headers["ETag"]
+
+    response = _export(client, file_id, {"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_range_requests_return_partial_content(client, upload):
+    file_id = upload()
+    size = len(SAMPLE_CSV)
+
+    response = _export(client, file_id, {"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.content == SAMPLE_CSV[:10]
+    assert response.headers["Content-Range"] == f"bytes 0-9/{size}"
+
+    response = _export(client, file_id, {"Range": "bytes=-5"})
+    assert response.status_code == 206
+    assert response.content == SAMPLE_CSV[-5:]
+
+    response = _export(client, file_id, {"Range": "bytes=10-"})
+    assert response.status_code == 206
+    assert response.content == SAMPLE_CSV[10:]
+
+
+def test_unsatisfiable_range_returns_416(client, upload):
+    file_id = upload()
+    size = len(SAMPLE_CSV)
+
+    response = _export(client, file_id, {"Range": f"bytes={size}-"})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{size}"
+
+
+def test_stale_if_range_returns_the_whole_file(client, upload):
+    file_id = upload()
+
+    response = _export(client, file_id, {"Range": "bytes=0-9", "If-Range": '"stale"'})
+
+    assert response.status_code == 200
+    assert response.content == SAMPLE_CSV
+
+
+def test_rendered_export_can_be_resumed(client, upload):
+    file_id = upload()
+    full = _export(client, file_id, format="jsonl")
+    assert full.status_code == 200
+    etag = full.headers["ETag"]
+
+    head = _export(client, file_id, {"Range": "bytes=0-19", "If-Range": etag}, format="jsonl")
+    tail = _export(client, file_id, {"Range": "bytes=20-", "If-Range": etag}, format="jsonl")
+
+    assert head.status_code == tail.status_code == 206
+    assert head.headers["ETag"] == tail.headers["ETag"] == etag
+    assert head.content + tail.content == full.content
+
+
+def test_range_before_the_export_is_rendered(client, upload):
+    file_id = upload()
+
+    response = _export(client, file_id, {"Range": "bytes=0-0"}, format="jsonl", compression="gzip")
+
+    assert response.status_code == 206
+    assert response.content == b"\x1f"
+
+
+def test_etag_changes_when_the_processed_result_changes(client, upload):
+    file_id = upload()
+    etag = _export(client, file_id, format="csv").headers["ETag"]
+
+    client.portal.call(save_processed_file, pd.DataFrame({"a": [1, 2]}), file_id, "test-exec-key")
+    response = _export(client, file_id, {"If-None-Match": etag}, format="csv")
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.content.decode("utf-8-sig").splitlines() == ["a", "1", "2"]
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from app.services.file_cleanup_service import purge_file
+from app.services.file_service import UPLOAD_DIR, find_file_path, remove_file_artifacts
+
+# 按前缀删除时会匹配到其他文件或共享目录的ID
+INVALID_FILE_IDS = ["f", "exec", "file_access", "blobs", "*", "00000000-0000-0000-0000-00000000000"]
+
+
+def _uploads():
+    return sorted(path.name for path in Path(UPLOAD_DIR).iterdir())
+
+
+@pytest.mark.parametrize("file_id", INVALID_FILE_IDS)
+def test_delete_rejects_invalid_file_id(client, upload, file_id):
+    file_id_kept = upload()
+    before = _uploads()
+
+    response = client.delete(f"/api/files/{file_id}")
+
+    assert response.status_code == 400
+    assert _uploads() == before
+    assert find_file_path(file_id_kept) is not None
+
+
+@pytest.mark.parametrize("file_id", INVALID_FILE_IDS)
+def test_services_refuse_invalid_file_id(file_id):
+    assert find_file_path(file_id) is None
+    with pytest.raises(ValueError):
+        purge_file(file_id)
+    with pytest.raises(ValueError):
+        remove_file_artifacts(file_id)
+
+
+def test_delete_removes_the_upload(client, upload):
+    file_id = upload()
+
+    assert client.delete(f"/api/files/{file_id}").status_code == 200
+    assert find_file_path(file_id) is None
+    assert not list(Path(UPLOAD_DIR).glob(f"{file_id}*"))
@@ -0,0 +1,101 @@
+import asyncio
+
+import pandas as pd
+
+from app.services import chat_service
+from app.services.blob_store import read_ref
+from app.services.exec_cache import build_exec_cache_key
+from app.services.lineage_service import add_step, load_step_dataframe
+from app.services.session_service import load_session
+
+
+def _frame(step: int) -> pd.DataFrame:
+    return pd.DataFrame({"step": [step] * step})
+
+
+def _add_steps(client, file_id: str, count: int) -> None:
+    for number in range(1, count + 1):
+        client.portal.call(add_step, file_id, _frame(number), f"key{number}", f"code{number}")
+
+
+def _processed_rows(client, file_id: str):
+    response = client.get(f"/api/files/{file_id}/rows", params={"table": "processed"})
+    return response.status_code, response.json().get("rows_count")
+
+
+def test_steps_are_numbered_and_become_current(client, upload):
+    file_id = upload()
+    _add_steps(client, file_id, 2)
+
+    body = client.get(f"/api/chat/{file_id}/steps").json()
+    assert body["current_step"] == 2
+    assert [step["step"] for step in body["steps"]] == [1, 2]
+    assert [step["rows_count"] for step in body["steps"]] == [1, 2]
+
+    step = load_session(file_id)["steps"][1]
+    df = client.portal.call(load_step_dataframe, file_id, step)
+    assert df["step"].tolist() == [2, 2]
+
+
+def test_undo_moves_back_and_updates_the_processed_table(client, upload):
+    file_id = upload()
+    _add_steps(client, file_id, 3)
+
+    body = client.post(f"/api/chat/{file_id}/steps/undo").json()
+    assert body["current_step"] == 2
+    assert _processed_rows(client, file_id) == (200, 2)
+
+    body = client.post(f"/api/chat/{file_id}/steps/undo", params={"step": 0}).json()
+    assert body["current_step"] == 0
+    assert _processed_rows(client, file_id)[0] == 404
+
+    assert client.post(f"/api/chat/{file_id}/steps/undo", params={"step": 9}).status_code == 400
+
+
+def test_new_step_after_undo_discards_the_branch(client, upload):
+    file_id = upload()
+    _add_steps(client, file_id, 3)
+    client.post(f"/api/chat/{file_id}/steps/undo", params={"step": 1})
+
+    client.portal.call(add_step, file_id, _frame(5), "key5", "code5")
+
+    steps = load_session(file_id)["steps"]
+    assert [step["step"] for step in steps] == [1, 2]
+    assert steps[1]["exec_key"] == "key5"
+    df = client.portal.call(load_step_dataframe, file_id, steps[1])
+    assert len(df) == 5
+
+
+def test_concurrent_steps_get_distinct_numbers(client, upload):
+    file_id = upload()
+
+    async def add_concurrently():
+        await asyncio.gather(*[add_step(file_id, _frame(number), f"key{number}", f"code{number}")
+                               for number in range(1, 6)])
+
+    client.portal.call(add_concurrently)
+
+    session = load_session(file_id)
+    assert [step["step"] for step in session["steps"]] == [1, 2, 3, 4, 5]
+    assert session["current_step"] == 5
+
+
+def test_concurrent_turns_chain_on_the_previous_step(client, upload):
+    file_id = upload()
+
+    async def run_turns():
+        file_path = await chat_service.get_file_path_by_id(file_id)
+        codes = [f"result = df.assign(x{number}=1)" for number in range(4)]
+        await asyncio.gather(*[chat_service.execute_generated_code(file_id, file_path, code, use_session=True)
+                               for code in codes])
+
+    client.portal.call(run_turns)
+
+    steps = load_session(file_id)["steps"]
+    assert [step["step"] for step in steps] == [1, 2, 3, 4]
+    # 每一步都作用于上一步的结果：列数逐步增加，执行缓存键沿步骤串联
+    assert [len(step["columns"]) for step in steps] == [5, 6, 7, 8]
+    previous_key = read_ref(file_id)
+    for step in steps:
+        assert step["exec_key"] == build_exec_cache_key(previous_key, step["code"])
+        previous_key = step["exec_key"]
@@ -0,0 +1,86 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from app.services import file_service
+from app.services.dataframe_cache import dataframe_cache
+
+# 行数足够多，列式副本按较小的行组写入后分成多个行组
+ROWS = 50
+TABLE_CSV = ("id,score,group\n" + "".join(
+    f"{i},{(i * 37) % 11},{'abc'[i % 3]}\n" for i in range(ROWS)
+)).encode("utf-8")
+
+
+def _expected() -> pd.DataFrame:
+    return pd.DataFrame({
+        "id": range(ROWS),
+        "score": [(i * 37) % 11 for i in range(ROWS)],
+        "group": ["abc"[i % 3] for i in range(ROWS)],
+    })
+
+
+@pytest.fixture(params=["cached", "windowed"])
+def table_id(request, monkeypatch, upload):
+    """cached: 表格在DataFrame缓存中；windowed: 缓存预算为0，只按行组读取列式副本"""
+    monkeypatch.setattr(file_service, "PARQUET_ROW_GROUP_ROWS", 8)
+    file_id = upload(TABLE_CSV, "table.csv")
+    if request.param == "windowed":
+        assert pq.ParquetFile(file_service.get_sidecar_path(file_id)).metadata.num_row_groups > 1
+        monkeypatch.setattr(dataframe_cache, "max_bytes", 0)
+        dataframe_cache.clear()
+    return file_id
+
+
+def test_pages_cover_the_table_in_order(client, table_id):
+    ids = []
+    for offset in range(0, ROWS, 12):
+        body = client.get(f"/api/files/{table_id}/rows", params={"offset": offset, "limit": 12}).json()
+        assert body["rows_count"] == ROWS
+        assert body["columns"] == ["id", "score", "group"]
+        ids += [row["id"] for row in body["data"]]
+    assert ids == list(range(ROWS))
+
+
+def test_offset_past_the_end_returns_no_rows(client, table_id):
+    body = client.get(f"/api/files/{table_id}/rows", params={"offset": ROWS + 10}).json()
+    assert body["data"] == []
+    assert body["rows_count"] == ROWS
+
+
+def test_columns_are_projected(client, table_id):
+    body = client.get(f"/api/files/{table_id}/rows",
+                      params={"offset": 10, "limit": 3, "columns": "group,id", "orient": "columns"}).json()
+    assert body["columns"] == ["group", "id"]
+    assert body["data"] == {"group": ["b", "c", "a"], "id": [10, 11, 12]}
+
+
+def test_sorted_pages_match_pandas(client, table_id):
+    expected = _expected().sort_values(["score", "id"], ascending=[False, True], kind="stable")
+    ids = []
+    for offset in (0, 20, 40):
+        body = client.get(f"/api/files/{table_id}/rows",
+                          params={"offset": offset, "limit": 20, "sort": "-score,id"}).json()
+        ids += [row["id"] for row in body["data"]]
+    assert ids == expected["id"].tolist()
+
+
+def test_sort_order_is_reused_across_pages(client, table_id):
+    client.get(f"/api/files/{table_id}/rows", params={"limit": 5, "sort": "group"})
+    cached_orders = [key for key in file_service._sort_order_cache if key[2] == "group"]
+    assert len(cached_orders) == 1
+
+    body = client.get(f"/api/files/{table_id}/rows", params={"offset": 5, "limit": 5, "sort": "group"}).json()
+    assert [row["group"] for row in body["data"]] == ["a"] * 5
+    assert [key for key in file_service._sort_order_cache if key[2] == "group"] == cached_orders
+
+
+@pytest.mark.parametrize("params", [{"sort": "missing"}, {"columns": "id,missing"}])
+def test_unknown_columns_are_rejected(client, table_id, params):
+    response = client.get(f"/api/files/{table_id}/rows", params=params)
+    assert response.status_code == 400
+
+
+def test_processed_table_without_result_is_not_found(client, table_id):
+    response = client.get(f"/api/files/{table_id}/rows", params={"table": "processed"})
+    assert response.status_code == 404